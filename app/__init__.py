@@ -3,13 +3,28 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.api import kiosk, stats
+from .auth_helpers import ACCESS_TOKEN_LIFETIME
+from .blacklist import TokenBlacklist
+from .cache import TTLCache
+from .hashing import PasswordHasher
+from .images import ImageProcessor
+from .mail_templates import MailTemplates
+from .mailer import create_mailer
+from .outbox import outbox_stats
+from .telemetry import VisitBuffer
 from .config import config
+from .utils.etag import NotModified, not_modified_handler
+from .utils.serialization import response_class
 
 from .api import members, auth, events, admin, mail, jobs
 from .db import setup_db
 
 
 def create_app():
+    # Fetch config object
+    env = os.getenv("API_ENV", "default")
+    app_config = config[env]
+
     app = FastAPI(
         title="TDCTL-API",
         version="0.1",
@@ -17,6 +32,8 @@ def create_app():
         Everything related to Tromsøstudentenes Dataforening""",
         contact={"name": "td", "email": "td@list.uit.no"},
         docs_url="/",
+        # encodes the content returned by handlers, hot paths return serialized json, see utils/serialization.py
+        default_response_class=response_class(app_config.JSON_RESPONSE),
     )
 
     # CORS Middleware
@@ -26,11 +43,55 @@ def create_app():
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        # pagination cursors and image versions are returned in headers
+        expose_headers=["X-Next-Cursor", "X-Image-Version"],
     )
 
-    # Fetch config object
-    env = os.getenv("API_ENV", "default")
-    app.config = config[env]
+    app.config = app_config
+
+    # cached serialized event listings, see events.cached_listing
+    app.event_cache = TTLCache(app.config.EVENT_CACHE_SIZE, app.config.EVENT_CACHE_TTL)
+    # member documents by id, see auth_helpers.current_member
+    app.member_cache = TTLCache(app.config.MEMBER_CACHE_SIZE, app.config.MEMBER_CACHE_TTL)
+    # verified access token payloads, entries are also checked against the token exp
+    app.token_cache = TTLCache(app.config.TOKEN_CACHE_SIZE, ACCESS_TOKEN_LIFETIME.total_seconds())
+    # blacklisted refresh tokens, see app/blacklist.py
+    app.token_blacklist = TokenBlacklist(app.config.TOKEN_BLACKLIST_REFRESH)
+    # registration qr pdfs by register_id, see events.registration_qr_pdf
+    app.qr_cache = TTLCache(app.config.QR_CACHE_SIZE, app.config.QR_CACHE_TTL)
+    # process pool for password hashing, see app/hashing.py
+    app.password_hasher = PasswordHasher(
+        app.config.PASSWORD_HASH_METHOD, app.config.PASSWORD_HASH_WORKERS, app.config.PASSWORD_HASH_MAX_PENDING)
+    app.add_event_handler("shutdown", app.password_hasher.shutdown)
+    # process pool rendering uploaded images, see app/images.py
+    app.image_processor = ImageProcessor(app.config.IMAGE_WORKERS)
+    app.add_event_handler("shutdown", app.image_processor.shutdown)
+    # mail templates compiled once, reloaded on change in development
+    app.mail_templates = MailTemplates(reload=app.config.ENV == 'development')
+    # batched mail sending for mails sent during a request, other mails go through the outbox
+    app.mailer = create_mailer(app.config, deadline=app.config.MAIL_REQUEST_DEADLINE)
+
+    # page and unique visits written in batches, flushed on shutdown, see app/telemetry.py
+    app.visit_buffer = VisitBuffer(lambda: app.db, app.config.STATS_BUFFER_SIZE,
+                                   app.config.STATS_FLUSH_SIZE, app.config.STATS_FLUSH_INTERVAL)
+    app.add_event_handler("shutdown", app.visit_buffer.close)
+
+    # name -> function returning current values, exposed through /api/stats/metrics
+    app.metrics = {
+        "event_cache": app.event_cache.stats,
+        "member_cache": app.member_cache.stats,
+        "token_cache": app.token_cache.stats,
+        "qr_cache": app.qr_cache.stats,
+        "password_hasher": app.password_hasher.stats,
+        "image_processor": app.image_processor.stats,
+        "token_blacklist": app.token_blacklist.stats,
+        "mailer": app.mailer.stats,
+        "outbox": lambda: outbox_stats(app.db),
+        "visit_buffer": app.visit_buffer.stats,
+    }
+
+    # conditional GET, see utils/etag.check_etag
+    app.add_exception_handler(NotModified, not_modified_handler)
 
     # Routers
     app.include_router(members.router, prefix="/api/member", tags=["members"])
@@ -49,7 +110,5 @@ def create_app():
     )
 
     setup_db(app)
-    # Set tokens to expire at at "exp"
-    app.db.tokens.create_index("exp", expireAfterSeconds=0)
 
     return app
@@ -3,11 +3,11 @@ from uuid import UUID, uuid4
 from pydantic import Field
 from pydantic.main import BaseModel
 from pydantic.types import PositiveInt
-from werkzeug.security import generate_password_hash
 from app.utils.validation import validate_password, validate_uuid
 from ..db import get_database
+from ..hashing import get_password_hasher
 from ..models import AccessTokenPayload, AdminMemberUpdate, MemberInput, PenaltyInput, Role, Status
-from ..auth_helpers import authorize_admin
+from ..auth_helpers import authorize_admin, invalidate_members
 from ..utils import passwordError
 
 router = APIRouter()
@@ -28,6 +28,7 @@ def give_existing_user_admin_privileges(request: Request, id: str, token: Access
 
     if not results:
         raise HTTPException(500)
+    invalidate_members(request, [member["id"]])
     return Response(status_code=201)
     
 @router.post('/')
@@ -38,7 +39,7 @@ def create_admin_user(request: Request, newAdmin: MemberInput, token: AccessToke
         raise HTTPException(409, 'E-mail is already in use.')
     if not validate_password(newAdmin.password):
         raise HTTPException(400, passwordError)
-    pwd = generate_password_hash(newAdmin.password)
+    pwd = get_password_hasher(request).hash_sync(newAdmin.password)
 
     uid = uuid4()
     additionalFields = {
@@ -86,6 +87,7 @@ def update_member(request: Request, id: str, memberData: AdminMemberUpdate, toke
 
     if not result:
         raise HTTPException(500, "Unexpected error while updating member")
+    invalidate_members(request, [member["id"]])
 
     return Response(status_code=201)
 
@@ -106,6 +108,7 @@ def delete_member(request: Request, id: str, token: AccessTokenPayload = Depends
 
     if not result:
         raise HTTPException(500)
+    invalidate_members(request, [member["id"]])
 
     return Response(status_code=200)
 
@@ -124,5 +127,6 @@ def set_member_penalty(request: Request, id:str, penalty_input: PenaltyInput, to
 
     if not result:
         raise HTTPException(500, "Unexpected error while updating penalty")
+    invalidate_members(request, [member["id"]])
 
     return Response(status_code=200)
@@ -1,35 +1,58 @@
+import logging
 from uuid import UUID
-from fastapi import APIRouter, Request, Response, HTTPException, Depends
-from werkzeug.security import check_password_hash, generate_password_hash
+from fastapi import APIRouter, BackgroundTasks, Request, Response, HTTPException, Depends
 
-from ..db import get_database
-from ..auth_helpers import create_token, create_refresh_token, decode_token, blacklist_token, delete_auth_cookies, is_blacklisted, authorize, set_auth_cookies
+from ..db import get_async_database, get_database
+from ..hashing import PasswordHasher, get_password_hasher, needs_rehash
+from ..auth_helpers import create_token, create_refresh_token, decode_token, blacklist_token, delete_auth_cookies, is_blacklisted, authorize, set_auth_cookies, invalidate_members
 from ..models import Credentials, Status, MemberDB, RefreshTokenPayload, AccessTokenPayload, ChangePasswordPayload
 from ..utils import validate_password, passwordError
 
 router = APIRouter()
 
 
+async def rehash_password(db, hasher: PasswordHasher, member_id: UUID, old_hash: str, password: str):
+    """
+    Replaces the password hash of member with one using the configured hash method. Runs after the
+    response is sent and is opportunistic, it is skipped when the hasher is busy and retried on a later login
+    """
+    try:
+        new_hash = await hasher.hash(password)
+    except HTTPException:
+        logging.warning(f"Skipped rehashing the password of {member_id}, the password hasher is busy")
+        return
+    # only replaces the hash verified on login, a password changed in the meantime is kept
+    await db.members.update_one({'id': member_id, 'password': old_hash}, {"$set": {'password': new_hash}})
+
+
 @router.post("/login", responses={401: {"model": None}})
-def login(request: Request, credentials: Credentials, response: Response):
+async def login(request: Request, credentials: Credentials, response: Response, background_tasks: BackgroundTasks):
     credential_exception = HTTPException(401, "Invalid e-mail or password")
-    db = get_database(request)
-    member = db.members.find_one({'email': credentials.email.lower()})
+    db = get_async_database(request)
+    member = await db.members.find_one({'email': credentials.email.lower()})
 
     if not member:
         raise HTTPException(401, 'Invalid e-mail')
         #raise credential_exception
     member = MemberDB.model_validate(member)
 
-    if not check_password_hash(member.password, credentials.password):
+    # hashing runs in a process pool, keeping login bursts from starving other requests
+    hasher = get_password_hasher(request)
+    if not await hasher.verify(member.password, credentials.password):
         raise credential_exception
 
+    # upgrade hashes created with other parameters than configured after the response is sent,
+    # keeping the cost of later logins predictable
+    if needs_rehash(member.password, hasher.method):
+        background_tasks.add_task(rehash_password, db, hasher, member.id, member.password, credentials.password)
+
     if member.status != Status.active:
         # activate members on login
-        db.members.find_one_and_update(
+        await db.members.find_one_and_update(
             {'id': member.id},
             {"$set": {'status': f'{Status.active}'}}
         )
+        invalidate_members(request, [member.id])
 
     token = create_token(member, request.app.config)
     refresh_token = create_refresh_token(member, request.app.config)
@@ -47,7 +70,7 @@ def logout(request: Request, response: Response):
             refresh_token, request.app.config))
     except:
         raise HTTPException(401, "Refresh token is invalid")
-    blacklist_token(token, request.app.db)
+    blacklist_token(token, request)
     
     delete_auth_cookies(response)
     response.status_code = 200
@@ -63,7 +86,7 @@ def renew(request: Request, response: Response):
     tokenPayload = RefreshTokenPayload.model_validate(
         decode_token(refresh_token, request.app.config))
 
-    if is_blacklisted(tokenPayload, request.app.db):
+    if is_blacklisted(tokenPayload, request):
         raise HTTPException(401, 'Refresh token is blacklisted')
     user = request.app.db.members.find_one({'id': UUID(tokenPayload.user_id)})
     if not user:
@@ -74,7 +97,7 @@ def renew(request: Request, response: Response):
     token = create_token(user, request.app.config)
     refresh_token = create_refresh_token(user, request.app.config)
     set_auth_cookies(response, token, refresh_token)
-    blacklist_token(tokenPayload, request.app.db)
+    blacklist_token(tokenPayload, request)
     response.status_code = 200
 
     return response
@@ -87,13 +110,14 @@ def change_password(passwords: ChangePasswordPayload, request: Request, token: A
     if not user:
         raise HTTPException(401, 'User not found')
 
-    if not check_password_hash(user.password, passwords.password):
+    hasher = get_password_hasher(request)
+    if not hasher.verify_sync(user.password, passwords.password):
         raise HTTPException(403, 'Wrong password')
 
     if not validate_password(passwords.newPassword):
         raise HTTPException(400, passwordError)
 
-    new_password = generate_password_hash(passwords.newPassword)
+    new_password = hasher.hash_sync(passwords.newPassword)
     result = db.members.find_one_and_update(
         {'id': user.id},
         {"$set": {'password': new_password}})
@@ -1,39 +1,76 @@
 from datetime import datetime, timedelta, timezone
-import os
-import shutil
-from fastapi import APIRouter, Response, Request, HTTPException, Depends, BackgroundTasks, Query
+from typing import Literal, Optional
+from fastapi import APIRouter, Response, Request, HTTPException, Depends, Query
+from fastapi.concurrency import run_in_threadpool
 from fastapi.datastructures import UploadFile
 from fastapi.param_functions import File
 from pydantic import ValidationError
-from starlette.responses import FileResponse
 from uuid import uuid4, UUID
 from app.utils.event_utils import *
+from app.utils.etag import REVALIDATE, check_etag, document_etag, is_not_modified, make_etag, not_modified_response
+from app.utils.export import csv_export, ndjson_export, xlsx_export
+from app.utils.pagination import MAX_PAGE_SIZE, decode_cursor, keyset_filter, ndjson_response, page_cursor
+from app.utils.qr import qr_etag, render_qr_pdf
+from app.utils.serialization import json_bytes, json_response, validate_many
 from app.utils.validation import validate_image_file_type, validate_uuid
-from ..auth_helpers import authorize, authorize_admin, optional_authentication
-from ..db import get_database, get_image_path, get_qr_path, get_export_path
+from ..auth_helpers import authorize, authorize_admin, optional_authentication, current_member, invalidate_members
+from ..db import get_async_database, get_image_path
 from ..models import *
-from .utils import get_event_or_404, penalize
-import pandas as pd
-from .mail import send_mail
+from .utils import get_event_or_404, get_event_header_or_404, get_event_with_participant_or_404, \
+    get_event_with_counts_or_404, penalize, penalize_members
+from .. import registrations
+from ..images import ImageStore, image_response, upload_image
+from ..mail_templates import get_mail_templates
+from ..concurrency import KeyedLock, MAX_UPDATE_RETRIES, version_filter, with_version_bump
 from ..models import MailPayload
-import asyncio
-from pymongo import UpdateOne
-import qrcode as qr
-from fpdf import FPDF
 
 
 router = APIRouter()
-lock = asyncio.Lock()
+# serializes read-modify-write admin operations on the same event within this process,
+# version checks on the event keep them correct across processes
+event_locks = KeyedLock()
+
+
+def listing_scope(token: Optional[AccessTokenPayload]):
+    """ Listings differ only between admins and everyone else """
+    return "admin" if token and token.role == Role.admin else "public"
+
+
+async def cached_listing(request: Request, key, produce):
+    """
+    Returns the serialized result of produce from the event listing cache, calling produce on a miss.
+    produce returns the response content and headers.
+    Cached responses skip both the query and model validation, and carry an etag of the body
+    so clients revalidating an unchanged listing get a 304
+    """
+    cache = request.app.event_cache
+    cached = cache.get(key)
+    if cached is None:
+        generation = cache.generation
+        content, headers = await produce()
+        body = json_bytes(content)
+        headers = {**headers, "ETag": make_etag(body), "Cache-Control": REVALIDATE}
+        cached = (body, headers)
+        cache.set(key, cached, generation)
+    body, headers = cached
+    if is_not_modified(request, headers["ETag"]):
+        return not_modified_response(headers["ETag"], headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def invalidate_event_listings(request: Request):
+    """ Must be called after writes changing fields shown in event listings """
+    request.app.event_cache.invalidate()
 
 
 @router.post('/')
-def create_event(request: Request, newEvent: EventInput, token: AccessTokenPayload = Depends(authorize_admin)):
+async def create_event(request: Request, newEvent: EventInput, token: AccessTokenPayload = Depends(authorize_admin),
+                       member: Optional[dict] = Depends(current_member)):
     # TODO better format handling and date date-time handling
-    db = get_database(request)
+    db = get_async_database(request)
     # validates event date and registrationOpningDate
     validate_event_dates(newEvent)
 
-    member = db.members.find_one({'id': UUID(token.user_id)})
     if member == None:
         raise HTTPException(500, "Problem caller not found")
     host_email = member["email"]
@@ -41,39 +78,45 @@ def create_event(request: Request, newEvent: EventInput, token: AccessTokenPaylo
     eid = uuid4()
     additionalFields = {
         'eid': eid,
-        'participants': [],
+        **registrations.storage_fields(request.app.config),
         'posts': [],
         'registeredPenalties': [],
-        'host': host_email
+        'host': host_email,
+        'version': 0,
     }
     if newEvent.bindingRegistration:
         additionalFields['confirmed'] = False
 
     event = newEvent.model_dump()
     event.update(additionalFields)
-    event = db.events.insert_one(event)
+    event = await db.events.insert_one(event)
+    invalidate_event_listings(request)
 
     return {'eid': eid.hex}
 
 
 @router.get('/')
-def get_all_event_ids(request: Request, token: AccessTokenPayload = Depends(optional_authentication)):
+async def get_all_event_ids(request: Request, token: AccessTokenPayload = Depends(optional_authentication)):
     '''
     returns all public events and if user is admin all events are returned
     '''
-    db = get_database(request)
+    db = get_async_database(request)
     search_filter = {"public": {"$eq": True}}
     if token and token.role == Role.admin:
         search_filter = {}
-    return [str(event['eid']) for event in db.events.find(search_filter)]
+
+    async def produce():
+        return [str(event['eid']) async for event in db.events.find(search_filter, {'eid': 1})], {}
+
+    return await cached_listing(request, ('all', listing_scope(token)), produce)
 
 
 @router.get('/upcoming')
-def get_upcoming_events(request: Request, token: AccessTokenPayload = Depends(optional_authentication)):
+async def get_upcoming_events(request: Request, token: AccessTokenPayload = Depends(optional_authentication)):
     '''
     Provides public upcoming events to regular members and return all events to admin
     '''
-    db = get_database(request)
+    db = get_async_database(request)
     # allows ongoing events to still be visible for users
     now = datetime.now() - timedelta(hours=4)
 
@@ -88,16 +131,18 @@ def get_upcoming_events(request: Request, token: AccessTokenPayload = Depends(op
     if token and token.role == Role.admin:
         search_filter = {'date': {"$gt": date}}
 
-    upcoming_events = db.events.find(search_filter)
+    async def produce():
+        upcoming_events = db.events.find(search_filter, {'participants': 0})
+        return validate_many(Event, [event async for event in upcoming_events]), {}
 
-    return [Event.model_validate(event) for event in upcoming_events]
+    return await cached_listing(request, ('upcoming', listing_scope(token)), produce)
 
 
 @router.get('/past-events/count')
-def get_past_events_count(request: Request,
+async def get_past_events_count(request: Request,
                           token: AccessTokenPayload = Depends(optional_authentication)):
     """Get count of past events"""
-    db = get_database(request)
+    db = get_async_database(request)
 
     # Get current UTC datetime
     current_datetime = datetime.now()
@@ -113,16 +158,12 @@ def get_past_events_count(request: Request,
         }
 
     # Count the number of documents that match the filter
-    count = db.events.count_documents(search_filter)
-    return {"count": count}
+    async def produce():
+        return {"count": await db.events.count_documents(search_filter)}, {}
 
-@router.get('/past-events')
-def get_past_events(request: Request, token: AccessTokenPayload = Depends(optional_authentication),
-                    skip: int = Query(0, ge=0)):
-    """ Get last  events that have passed """
-    # TODO: Expand endpoint to accept custom amount?
-    db = get_database(request)
+    return await cached_listing(request, ('past-count', listing_scope(token)), produce)
 
+def past_events_filter(token: Optional[AccessTokenPayload]):
     # Get todays date
     now = datetime.now()
     date_str = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -133,32 +174,76 @@ def get_past_events(request: Request, token: AccessTokenPayload = Depends(option
         "$and": [{'date': {'$lt': date}}, {"public": {"$eq": True}}]}
     if token and token.role == Role.admin:
         search_filter = {'date': {"$lt": date}}
+    return search_filter
+
+
+# eid breaks ties between events at the same date, making the order usable for keyset pagination
+PAST_EVENTS_SORT = [('date', -1), ('eid', -1)]
+
+
+@router.get('/past-events')
+async def get_past_events(request: Request, token: AccessTokenPayload = Depends(optional_authentication),
+                    cursor: Optional[str] = None, limit: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+                    skip: int = Query(0, ge=0)):
+    """
+    Get last events that have passed, newest first. \n
+    cursor: X-Next-Cursor header of the previous page, omit for the first page.
+    The header is not set on the last page \n
+    skip: offset based paging for older clients, deep pages get slower than with cursor
+    """
+    db = get_async_database(request)
 
-    fixed_limit = 10
-    # Get the last events
+    search_filter = past_events_filter(token)
+    if cursor:
+        search_filter = {"$and": [search_filter, keyset_filter(
+            PAST_EVENTS_SORT, decode_cursor(cursor, len(PAST_EVENTS_SORT)))]}
+
+    # reads one event more than requested to know whether there is a next page
     pipeline = [
         {"$match": search_filter},
-        {"$sort": {"date": -1}},
-        {"$skip": skip},
-        {"$limit": fixed_limit},
+        {"$sort": dict(PAST_EVENTS_SORT)},
+        *([{"$skip": skip}] if skip and not cursor else []),
+        {"$limit": limit + 1},
+        {"$project": {"participants": 0}},
     ]
 
-    res = db.events.aggregate(pipeline)
+    async def produce():
+        res = await db.events.aggregate(pipeline)
 
-    if res == []:
-        raise HTTPException(404, "No past events found")
+        if not res:
+            raise HTTPException(500)
+
+        events, next_cursor = page_cursor([e async for e in res], PAST_EVENTS_SORT, limit)
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+        return validate_many(Event, events), headers
+
+    key = ('past', listing_scope(token), cursor, limit, skip)
+    return await cached_listing(request, key, produce)
 
-    if not res:
-        raise HTTPException(500)
 
-    return [Event.model_validate(event) for event in res]
+@router.get('/past-events/stream')
+async def stream_past_events(request: Request, token: AccessTokenPayload = Depends(optional_authentication),
+                             cursor: Optional[str] = None):
+    """ Streams all past events after cursor (all if omitted), newest first, as newline delimited json """
+    db = get_async_database(request)
+
+    search_filter = past_events_filter(token)
+    if cursor:
+        search_filter = {"$and": [search_filter, keyset_filter(
+            PAST_EVENTS_SORT, decode_cursor(cursor, len(PAST_EVENTS_SORT)))]}
+
+    async def events():
+        async for event in db.events.find(search_filter, {'participants': 0}).sort(PAST_EVENTS_SORT):
+            yield Event.model_validate(event)
+
+    return ndjson_response(events())
 
 
 @router.get('/joined-events')
-def get_joined_events(request: Request, token: AccessTokenPayload = Depends(authorize)):
+async def get_joined_events(request: Request, token: AccessTokenPayload = Depends(authorize),
+                            member: Optional[dict] = Depends(current_member)):
     """ Returns all (upcoming) events user has joined """
-    db = get_database(request)
-    member = db.members.find_one({'id': UUID(token.user_id)})
+    db = get_async_database(request)
     if not member:
         raise HTTPException(404, "User could not be found")
 
@@ -178,9 +263,16 @@ def get_joined_events(request: Request, token: AccessTokenPayload = Depends(auth
         {"$unwind": "$participants"},
         {"$match": {"participants.id": {"$eq": member["id"]}}}
     ]
-    res = db.events.aggregate(pipeline)
+    res = await db.events.aggregate(pipeline)
+    joined = [e async for e in res]
+
+    # events storing participants in the registrations collection
+    registered_eids = await registrations.registered_event_ids(db, member["id"])
+    if registered_eids:
+        res = db.events.find({**search_filter, 'eid': {'$in': registered_eids}}, {'participants': 0})
+        joined += [e async for e in res]
 
-    return [EventUserView.model_validate(e) for e in res]
+    return json_response(validate_many(EventUserView, joined))
 
 
 # custom uuid validation as eid: UUID will not allow users to copy eids into swagger as they are not formatted correctly
@@ -188,12 +280,15 @@ def get_joined_events(request: Request, token: AccessTokenPayload = Depends(auth
 
 
 @router.get('/{id}/image', dependencies=[Depends(validate_uuid)])
-def get_event_picture(request: Request, id: str):
-    image_path = get_image_path(request)
-    file_name = f"{image_path}/{UUID(id).hex}.png"
-    if not os.path.exists(file_name):
-        raise HTTPException(404, "picture not found")
-    return FileResponse(file_name)
+def get_event_picture(request: Request, id: str, size: Literal['small', 'medium', 'large'] = 'large',
+                      image_format: Optional[Literal['avif', 'webp', 'jpeg', 'png']] = Query(None, alias='format'),
+                      v: Optional[str] = None):
+    """
+    Event picture resized to size, in the requested format or the best format the Accept header allows.
+    Requested with v set to the X-Image-Version of the image, the response can be cached as immutable
+    """
+    store = ImageStore(get_image_path(request))
+    return image_response(request, store, UUID(id).hex, size, image_format, v)
 
 
 @router.post('/{id}/image', dependencies=[Depends(validate_uuid)])
@@ -201,24 +296,16 @@ def upload_event_picture(request: Request, id: str, image: UploadFile = File(...
     if not validate_image_file_type(image.content_type):
         raise HTTPException(400, "Unsupported file type")
 
-    image_path = get_image_path(request)
-
-    if not os.path.isdir(image_path):
-        os.mkdir(image_path)
-
-    picturePath = f"{image_path}/{UUID(id).hex}.png"
-
-    with open(picturePath, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
+    upload_image(request, ImageStore(get_image_path(request)), UUID(id).hex, image.file)
 
     return Response(status_code=200)
 
 
 @router.put('/{id}', dependencies=[Depends(validate_uuid)])
-def update_event(request: Request, id: str, eventUpdate: EventUpdate, AccessTokenPayload=Depends(authorize_admin)):
+async def update_event(request: Request, id: str, eventUpdate: EventUpdate, AccessTokenPayload=Depends(authorize_admin)):
     """ To unset an optional field set the value to null """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
 
     # exclude_unset allows null to be included allowing for optional fields to be updated to be null i.e not present
     values = eventUpdate.model_dump(exclude_unset=True)
@@ -237,60 +324,74 @@ def update_event(request: Request, id: str, eventUpdate: EventUpdate, AccessToke
 
     # check if update does not remove required fields i.e a valid update
     try:
-        EventDB.model_validate({**event, **values})
+        EventHeader.model_validate({**event, **values})
     except ValidationError:
         raise HTTPException(
             400, "Cannot remove field as this is required filed for all events")
 
-    result = db.events.find_one_and_update(
+    result = await db.events.find_one_and_update(
         {'eid': UUID(id)},
-        {"$set": values})
+        with_version_bump({"$set": values}))
 
     if not result:
         raise HTTPException(500, "Unexpected error when updating event")
 
+    invalidate_event_listings(request)
     return Response(status_code=200)
 
 
 @router.delete('/{id}', dependencies=[Depends(validate_uuid)])
-def delete_event_by_id(request: Request, id: str, AccessTokenPayload=Depends(authorize_admin)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+async def delete_event_by_id(request: Request, id: str, AccessTokenPayload=Depends(authorize_admin)):
+    db = get_async_database(request)
+    event = await db.events.find_one_and_delete(
+        {'eid': UUID(id)}, projection={'eid': 1, 'participantStorage': 1})
 
-    res = db.events.find_one_and_delete({'eid': event["eid"]})
+    if not event:
+        raise HTTPException(404, "Event could not be found")
 
-    if not res:
-        raise HTTPException(500, "Unexpected error when deleting event")
+    invalidate_event_listings(request)
+    await registrations.delete_event_participants(db, event)
 
     return Response(status_code=200)
 
 
 @router.get('/{id}', dependencies=[Depends(validate_uuid)])
-def get_event_by_id(request: Request, id: str, token: AccessTokenPayload = Depends(optional_authentication)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+async def get_event_by_id(request: Request, response: Response, id: str,
+                          token: AccessTokenPayload = Depends(optional_authentication)):
+    db = get_async_database(request)
     role = None
 
     if token:
         role = token.role
-    if event["public"] == False and role != Role.admin:
+
+    # participants are only read if the client's copy is outdated
+    event = await get_event_header_or_404(db, id)
+    if role != Role.admin and event["public"] == False:
         # only allow admin members acces to unpublished events
         raise HTTPException(
             403, "Insufficient privileges to access this resource")
 
+    # the version covers the participants as well, see registrations.touch_event
+    check_etag(request, response, document_etag(request, "event", event["eid"], event["version"],
+                                                 listing_scope(token)))
+
+    # the etag headers are only added by FastAPI to returned content, not to returned responses
+    headers = dict(response.headers)
     if role == Role.admin:
-        return EventDB.model_validate(event)
+        event["participants"] = await registrations.get_participants(db, event)
+        return json_response(EventAdminView.model_validate(event), headers=headers)
 
-    return EventUserView.model_validate(event)
+    return json_response(EventUserView.model_validate(event), headers=headers)
 
 
 @router.get('/{id}/participants', dependencies=[Depends(validate_uuid)])
-def get_event_participants(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+async def get_event_participants(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
+    db = get_async_database(request)
+    event = await get_event_or_404(db, id)
 
     if token.role == Role.admin:
-        return [Participant.model_validate(p) for p in event['participants']]
+        # already validated as participants by get_event_or_404
+        return json_response(event['participants'])
 
     if event["maxParticipants"] != None:
         # only return the list when events are open i.e no cap
@@ -301,38 +402,30 @@ def get_event_participants(request: Request, id: str, token: AccessTokenPayload
 
 
 @router.get('/{id}/options', dependencies=[Depends(validate_uuid)])
-def get_event_options(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
+async def get_event_options(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
     """ Get event options for requesting user """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-
-    # Get event (if user is joined)
-    user_event = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": UUID(token.user_id)}}})
+    db = get_async_database(request)
+    # Get participant entry (if user is joined)
+    event, userData = await get_event_with_participant_or_404(db, id, UUID(token.user_id))
 
     # Check whether user exists in event
-    if not user_event or 'participants' not in user_event:
+    if not userData:
         raise HTTPException(400, "User not joined event!")
 
-    # Get user data and return
-    userData = user_event['participants'][0]
+    # Return user data
     return {'food': userData['food'], 'transportation': userData['transportation'],
             'dietaryRestrictions': userData['dietaryRestrictions']}
 
 
 @router.put('/{id}/update-options', dependencies=[Depends(validate_uuid)])
-def update_event_options(request: Request, id: str, payload: JoinEventPayload, token: AccessTokenPayload = Depends(authorize)):
+async def update_event_options(request: Request, id: str, payload: JoinEventPayload, token: AccessTokenPayload = Depends(authorize)):
     """ Update options for given event """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-    member = db.members.find_one({'id': UUID(token.user_id)})
-
-    # Get event (if user is joined)
-    user_event = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": UUID(token.user_id)}}})
+    db = get_async_database(request)
+    member_id = UUID(token.user_id)
+    event, participant = await get_event_with_participant_or_404(db, id, member_id)
 
     # Check whether user exists in event
-    if not user_event or 'participants' not in user_event:
+    if not participant:
         raise HTTPException(400, "User not joined event!")
 
     # Can validate whether payload entries are
@@ -344,12 +437,9 @@ def update_event_options(request: Request, id: str, payload: JoinEventPayload, t
 
     # Create a dictionary with the payload
     values = payload.model_dump(exclude_unset=True)
-    update_dict = {f"""participants.$.{
-        key}""": value for key, value in values.items()}
 
     # Update db field
-    res = db.events.update_one(
-        {"eid": event["eid"], "participants.id": member["id"]}, {"$set": update_dict})
+    res = await registrations.update_participant(db, event, member_id, values)
 
     # Return error if user was not in event
     if not res:
@@ -357,34 +447,13 @@ def update_event_options(request: Request, id: str, payload: JoinEventPayload, t
 
 
 @router.post('/{id}/join', dependencies=[Depends(validate_uuid)])
-def join_event(request: Request, id: str, payload: JoinEventPayload, token: AccessTokenPayload = Depends(authorize)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-    member = db.members.find_one({'id': UUID(token.user_id)})
+async def join_event(request: Request, id: str, payload: JoinEventPayload, token: AccessTokenPayload = Depends(authorize),
+                     member: Optional[dict] = Depends(current_member)):
+    db = get_async_database(request)
 
     if not member:
         raise HTTPException(400, "User could not be found")
 
-    if event_has_started(event):
-        raise HTTPException(400, "Cannot join event after it started")
-
-    # admin can join all events
-    if member["role"] != Role.admin:
-        if not valid_registration(event["registrationOpeningDate"]):
-            raise HTTPException(403, "Event registration is not open")
-
-        if event["public"] == False:
-            raise HTTPException(403, "Event is not public")
-
-    check_participant = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": member["id"]}}})
-
-    try:
-        check_participant['participants']
-        raise HTTPException(400, "User already joined")
-    except KeyError:
-        pass
-
     participantData = {
         'food': payload.food,
         'transportation': payload.transportation,
@@ -397,29 +466,63 @@ def join_event(request: Request, id: str, payload: JoinEventPayload, token: Acce
     new_fields = {**member, **participantData}
     participant = Participant.model_validate(new_fields)
 
-    # find pos in query to have the newest list when inserting
-    pos = len(event["participants"])
-    if member["penalty"] < 2:
-        # members below penalty limit gets moved in front of penalized users
-        pos -= num_of_deprioritized_participants(event["participants"])
-
-    db.events.update_one(
-        {'eid': event['eid']},
-        {"$push": {
-            "participants": {
-                "$each": [participant.model_dump()],
-                "$position": pos}
-        }
-        })
+    # all join requirements are part of the filter, making the check and the insert a single atomic
+    # update. Concurrent joins can therefore neither join twice nor be inserted at a stale position
+    now = datetime.now()
+    join_filter = {
+        'eid': UUID(id),
+        'date': {'$gt': now},
+    }
+    # admin can join all events
+    if member["role"] != Role.admin:
+        join_filter['public'] = True
+        # None also matches events without registrationOpeningDate
+        join_filter['$or'] = [{'registrationOpeningDate': None},
+                              {'registrationOpeningDate': {'$lt': now}}]
 
-    return Response(status_code=200)
+    # members below penalty limit gets moved in front of penalized users
+    deprioritized = member["penalty"] >= 2
+    storage = request.app.config.PARTICIPANT_STORAGE
+    res = await registrations.insert_participant(db, storage, join_filter, participant.model_dump(), deprioritized)
+
+    if res == registrations.JOINED:
+        return Response(status_code=200)
+
+    if res == registrations.ALREADY_JOINED:
+        raise HTTPException(400, "User already joined")
+
+    # the join was rejected, read the event to find out why
+    event = await get_event_or_404(db, id)
+
+    if registrations.storage_of(event) != storage:
+        # event was created with another participant storage than new events use
+        res = await registrations.insert_participant(
+            db, registrations.storage_of(event), join_filter, participant.model_dump(), deprioritized)
+        if res == registrations.JOINED:
+            return Response(status_code=200)
+
+    if event_has_started(event):
+        raise HTTPException(400, "Cannot join event after it started")
+
+    if member["role"] != Role.admin:
+        if not valid_registration(event["registrationOpeningDate"]):
+            raise HTTPException(403, "Event registration is not open")
+
+        if event["public"] == False:
+            raise HTTPException(403, "Event is not public")
+
+    if any(p["id"] == member["id"] for p in event["participants"]):
+        raise HTTPException(400, "User already joined")
+
+    # event changed between the update and the read
+    raise HTTPException(409, "Event was updated while joining, please try again")
 
 
 @router.post('/{id}/leave', dependencies=[Depends(validate_uuid)])
-async def leave_event(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-    member = db.members.find_one({'id': UUID(token.user_id)})
+async def leave_event(request: Request, id: str, token: AccessTokenPayload = Depends(authorize),
+                      member: Optional[dict] = Depends(current_member)):
+    db = get_async_database(request)
+    event = await get_event_or_404(db, id)
     penalty = should_penalize(event, token.user_id)
 
     if not member:
@@ -428,69 +531,46 @@ async def leave_event(request: Request, id: str, token: AccessTokenPayload = Dep
     if event_has_started(event):
         raise HTTPException(400, "Cannot leave event after it started")
 
-    participant = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": member["id"]}}})
+    participant = await registrations.find_participant(db, event, member["id"])
 
     if not participant:
         raise HTTPException(400, "User not joined event!")
 
-    try:
-        participant['participants']
-    except KeyError:
-        raise HTTPException(400, "User not joined event!")
-
     if penalty:
-        res = db.events.update_one(
+        res = await db.events.update_one(
             {'eid': event["eid"]},
-            {"$addToSet": {"registeredPenalties": member["id"]}}
+            with_version_bump({"$addToSet": {"registeredPenalties": member["id"]}})
         )
         # Only give penalty if addToSet added a new entry
         if res.modified_count != 0:
+            invalidate_event_listings(request)
             await penalize(db, member["id"])
+            invalidate_members(request, [member["id"]])
 
-    res = db.events.update_one({'eid': event['eid']}, {
-        "$pull": {"participants": {"id": member["id"]}}})
-
-    if res == None:
-        raise HTTPException(500, "Unexpected error updating database in leave")
+    await registrations.delete_participant(db, event, member["id"])
 
     return Response(status_code=200)
 
 
 @router.get('/{id}/joined', dependencies=[Depends(validate_uuid)])
-def is_joined_event(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-
-    # uses event["eid"] instead of casting eid -> UUID
-    user = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": UUID(token.user_id)}}})
+async def is_joined_event(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
+    db = get_async_database(request)
+    _, participant = await get_event_with_participant_or_404(db, id, UUID(token.user_id))
 
-    if not user:
-        return {'joined': False}
-
-    try:
-        user['participants'][0]
-        return {'joined': True}
-    except KeyError:
-        return {'joined': False}
+    return {'joined': participant is not None}
 
 
 @router.get('/{id}/confirmed', dependencies=[Depends(validate_uuid)])
-def is_confirmed(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
+async def is_confirmed(request: Request, id: str, token: AccessTokenPayload = Depends(authorize)):
     """ Returns whether user is confirmed to event """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-
-    # Get event (if user is joined)
-    user_event = db.events.find_one({"eid": event['eid']}, {'participants': {
-        '$elemMatch': {'id': UUID(token.user_id)}}})
+    db = get_async_database(request)
+    # Get participant entry (if user is joined)
+    event, userData = await get_event_with_participant_or_404(db, id, UUID(token.user_id))
 
     # Check whether user exists in event
-    if not user_event or 'participants' not in user_event:
+    if not userData:
         raise HTTPException(400, "User not joined event!")
 
-    userData = user_event['participants'][0]
     # Check whether event has been confirmed
     if not event.get('confirmed'):
         raise HTTPException(400, 'Event has not been confirmed yet')
@@ -500,103 +580,96 @@ def is_confirmed(request: Request, id: str, token: AccessTokenPayload = Depends(
 
 
 @router.delete('/{id}/removeParticipant/{uid}', dependencies=[Depends(validate_uuid)])
-def remove_participant(request: Request, id: str, uid: str, token: AccessTokenPayload = Depends(authorize_admin)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-    member = db.members.find_one({'id': UUID(uid)})
+async def remove_participant(request: Request, id: str, uid: str, token: AccessTokenPayload = Depends(authorize_admin)):
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
+    member = await db.members.find_one({'id': UUID(uid)})
 
     if not member:
         raise HTTPException(404, "User could not be found")
 
-    participant = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": member["id"]}}})
-
-    if not participant:
+    if not await registrations.delete_participant(db, event, member["id"]):
         raise HTTPException(400, "User not joined event!")
 
-    try:
-        participant['participants']
-    except KeyError:
-        raise HTTPException(400, "User not joined event!")
-
-    db.events.update_one({'eid': event['eid']}, {
-                         "$pull": {"participants": {"id": member["id"]}}})
-
     return Response(status_code=200)
 
 
 @router.put('/{id}/updateParticipantsOrder/', dependencies=[Depends(validate_uuid)])
 async def reorder_participants(request: Request, id: str, position_update: ParticipantPosUpdate, token: AccessTokenPayload = Depends(authorize_admin)):
-    # blocks all request meaning no changes to the event when reordering
-    # TODO find a more scaleable solution
-    async with lock:
-        db = get_database(request)
-        event = get_event_or_404(db, id)
-        participants = event["participants"]
-        num_penalties = num_of_deprioritized_participants(participants)
-        # start index of where penalized user should be
-        pen_start_pos = len(participants) - 1 - num_penalties
-
-        if not validate_pos_update(participants, position_update.updateList):
-            raise HTTPException(
-                400, "Not valid: got invalid or outdated participant list")
-
-        for participant in position_update.updateList:
-            participant = participant.model_dump()
-            for i, p in enumerate(participants):
-                if p["id"] == participant["id"]:
-                    new_pos = participant["pos"]
-                    # Checks if a penalized member is moved in front of a non penalized member
-                    if p["penalty"] >= 2 and new_pos <= pen_start_pos:
-                        raise HTTPException(
-                            400, "User with penalty can't be rearranged")
-
-                    # no need to swap same index
-                    if new_pos == i:
-                        continue
-                    # swaps current pos with new pos
-                    participants[i], participants[new_pos] = participants[new_pos], participants[i]
-                    break
-
-        if event["maxParticipants"]:
-            for i, p in enumerate(participants):
-                # ensure fields exist
-                p = Participant.model_validate(p).model_dump()
-                if p["confirmed"] and i >= event["maxParticipants"]:
+    db = get_async_database(request)
+    async with event_locks(UUID(id)):
+        for _ in range(MAX_UPDATE_RETRIES):
+            event = await get_event_or_404(db, id)
+            participants = reorder_participant_list(event, position_update)
+
+            # only written if the event is unchanged since it was read, otherwise reorder the fresh list
+            if await registrations.set_participant_order(db, event, participants):
+                return Response(status_code=200)
+
+    raise HTTPException(409, "Event was updated while reordering, please try again")
+
+
+def reorder_participant_list(event, position_update: ParticipantPosUpdate):
+    """ Returns the participant list of event with position_update applied """
+    participants = event["participants"]
+    num_penalties = num_of_deprioritized_participants(participants)
+    # start index of where penalized user should be
+    pen_start_pos = len(participants) - 1 - num_penalties
+
+    if not validate_pos_update(participants, position_update.updateList):
+        raise HTTPException(
+            400, "Not valid: got invalid or outdated participant list")
+
+    for participant in position_update.updateList:
+        participant = participant.model_dump()
+        for i, p in enumerate(participants):
+            if p["id"] == participant["id"]:
+                new_pos = participant["pos"]
+                # Checks if a penalized member is moved in front of a non penalized member
+                if p["penalty"] >= 2 and new_pos <= pen_start_pos:
                     raise HTTPException(
-                        400, "Confirmed user cannot be moved to a non confirmed spot")
+                        400, "User with penalty can't be rearranged")
 
-        res = db.events.find_one_and_update(
-            {'eid': event["eid"]}, {"$set": {"participants": participants}})
+                # no need to swap same index
+                if new_pos == i:
+                    continue
+                # swaps current pos with new pos
+                participants[i], participants[new_pos] = participants[new_pos], participants[i]
+                break
 
-        if res == None:
-            HTTPException(
-                500, "Unexpected error when updating participants list")
+    if event["maxParticipants"]:
+        for i, p in enumerate(participants):
+            # ensure fields exist
+            p = Participant.model_validate(p).model_dump()
+            if p["confirmed"] and i >= event["maxParticipants"]:
+                raise HTTPException(
+                    400, "Confirmed user cannot be moved to a non confirmed spot")
 
-        return Response(status_code=200)
+    return participants
 
 
 @router.get('/{id}/confirm-message', dependencies=[Depends(validate_uuid)])
 async def get_confirmation_message(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
 
     try:
-        content = get_default_confirmation(event)
+        content = get_default_confirmation(get_mail_templates(request), event)
         return {'message': content}
     except FileNotFoundError:
         raise HTTPException(500, "Error fetching default confirm message")
 
 
 @router.post('/{id}/mail', dependencies=[Depends(validate_uuid)])
-async def send_notification_mail(request: Request, id: str, m: EventMailMessage, background_tasks: BackgroundTasks, token: AccessTokenPayload = Depends(authorize_admin)):
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+async def send_notification_mail(request: Request, id: str, m: EventMailMessage, token: AccessTokenPayload = Depends(authorize_admin)):
+    db = get_async_database(request)
+    event = await get_event_with_counts_or_404(db, id)
+    counts = event["participantCounts"]
 
-    if len(event["participants"]) == 0:
+    if counts["participants"] == 0:
         raise HTTPException(400, "No participants in event")
 
-    if m.confirmedOnly and num_of_confirmed_participants(event["participants"]) == 0:
+    if m.confirmedOnly and counts["confirmed"] == 0:
         raise HTTPException(400, "No confirmed participants in event")
 
     if len(m.subject) > 50:
@@ -605,61 +678,64 @@ async def send_notification_mail(request: Request, id: str, m: EventMailMessage,
     if len(m.msg) > 5000:
         raise HTTPException(400, "Email message is too long")
 
-    pipeline = [
-        {"$match": {"eid": event["eid"]}},
-        {"$unwind": {"path": "$participants"}},
-        {"$group": {"_id": "$participants.email"}},
-    ]
+    participantsToMail = await registrations.get_participants(db, event, fields=['email', 'confirmed'])
 
     # Only send mail to confirmed participants if specified
     if m.confirmedOnly:
-        pipeline += [{"$match": {"participants.confirmed": True}}]
+        participantsToMail = [p for p in participantsToMail if p.get("confirmed")]
 
-    participantsToMail = db.events.aggregate(pipeline)
-    mailingList = [p["_id"] for p in participantsToMail]
+    # dict preserves order while removing duplicate emails
+    mailingList = list(dict.fromkeys(p["email"] for p in participantsToMail))
 
-    if request.app.config.ENV == "production":
-        background_tasks.add_task(send_emails, mailingList, m.subject, m.msg)
+    await send_emails(db, mailingList, m.subject, m.msg)
 
     return Response(status_code=202)
 
 
 @router.post('/{id}/confirm', dependencies=[Depends(validate_uuid)])
-async def confirmation(request: Request, id: str, m: EventConfirmMessage, background_tasks: BackgroundTasks, token: AccessTokenPayload = Depends(authorize_admin)):
-    async with lock:
-        db = get_database(request)
-        event = get_event_or_404(db, id)
-        num_confs = num_of_confirmed_participants(event["participants"])
+async def confirmation(request: Request, id: str, m: EventConfirmMessage, token: AccessTokenPayload = Depends(authorize_admin)):
+    db = get_async_database(request)
+    async with event_locks(UUID(id)):
+        for _ in range(MAX_UPDATE_RETRIES):
+            event = await get_event_with_counts_or_404(db, id)
+            num_confs = event["participantCounts"]["confirmed"]
 
-        if event["bindingRegistration"] == False:
-            raise HTTPException(
-                400, "Events without bindingRegistration should not send out confirmations")
+            if event["bindingRegistration"] == False:
+                raise HTTPException(
+                    400, "Events without bindingRegistration should not send out confirmations")
 
-        if event_has_started(event):
-            raise HTTPException(
-                400, "Cannot send confirmation after event start")
+            if event_has_started(event):
+                raise HTTPException(
+                    400, "Cannot send confirmation after event start")
 
-        if event["public"] == False:
-            raise HTTPException(
-                400, "Cannot send confirmation to a unpublished event")
+            if event["public"] == False:
+                raise HTTPException(
+                    400, "Cannot send confirmation to a unpublished event")
 
-        if not valid_registration(event["registrationOpeningDate"]):
-            raise HTTPException(
-                400, "Cannot send confirmations before registration is opened")
+            if not valid_registration(event["registrationOpeningDate"]):
+                raise HTTPException(
+                    400, "Cannot send confirmations before registration is opened")
+
+            if m.msg != None and len(m.msg) > 5000:
+                raise HTTPException(400, "Email message is too long")
+
+            participants = await registrations.get_participants(db, event, fields=['email', 'confirmed'])
 
-        if m.msg != None and len(m.msg) > 5000:
-            raise HTTPException(400, "Email message is too long")
+            # the participant list read above is only used if the event has not changed since the read
+            result = await db.events.find_one_and_update(
+                version_filter(event),
+                with_version_bump({"$set": {"confirmed": True}}))
 
-        result = db.events.find_one_and_update(
-            {'eid': UUID(id)},
-            {"$set": {"confirmed": True}})
+            if result:
+                break
+        else:
+            raise HTTPException(409, "Event was updated while confirming, please try again")
 
-        if not result:
-            raise HTTPException(500, "Unexpected error when updating event")
+        invalidate_event_listings(request)
 
         # all users joined gets confirmed if maxParticipants is not set
         # maxIdx-> which array position is
-        maxIdx = len(event["participants"])
+        maxIdx = event["participantCounts"]["participants"]
         if event["maxParticipants"] != None:
             maxIdx = event["maxParticipants"]
 
@@ -667,50 +743,32 @@ async def confirmation(request: Request, id: str, m: EventConfirmMessage, backgr
         if confirmationPositions == 0:
             raise HTTPException(
                 400, "All participants have received confirmation ")
-        # Aggregate all participants emails to send confirmation email
+        # Collect the emails of the first unconfirmed participants to send confirmation email
         # doesn't needs to filter out penalty < 2 as these should be at the bottom of the list
-        # includeArrayIndex preserves the original position making sure the aggregation always gets returned in correct order
-        # meaning $limit excludes penalized participants
-        pipeline = [
-            {"$match": {"eid": event["eid"]}},
-            {"$unwind": {"path": "$participants", "includeArrayIndex": "arrayIndex"}},
-            {"$match": {"participants.confirmed": {"$ne": True}}},
-            {"$sort": {"arrayIndex": 1}},
-            {"$limit": confirmationPositions},
-            {"$group": {"_id": "$participants.email"}},
-        ]
-        confirmedParticipants = db.events.aggregate(pipeline)
-
-        mailingList = [p['_id'] for p in confirmedParticipants]
+        # the participant list is in order, meaning the limit excludes penalized participants
+        unconfirmed = [p for p in participants if p.get("confirmed") != True]
+        mailingList = list(dict.fromkeys(
+            p["email"] for p in unconfirmed[:confirmationPositions]))
         # tags participants with confirmed
-        result = db.events.update_many(
-            {"eid": event["eid"]},
-            {"$set": {"participants.$[element].confirmed": True}},
-            array_filters=[{"element.email": {"$in": mailingList}}],
-        )
-        if not result:
-            raise HTTPException(
-                500, "Unexpected error when updating participants")
+        await registrations.confirm_participants(db, event, mailingList)
 
         # Use default confirmation email if no message is supplied
-        content = m.msg if m.msg != None else get_default_confirmation(event)
+        content = m.msg if m.msg != None else get_default_confirmation(get_mail_templates(request), event)
 
-        # Send email to all participants
-        if request.app.config.ENV == 'production':
-            background_tasks.add_task(
-                send_emails, mailingList, f"Bekreftelse {event['title']}", content)
+        # Send email to all participants, a participant is only sent one confirmation per event
+        await send_emails(db, mailingList, f"Bekreftelse {event['title']}", content, key_prefix=f"confirm:{event['eid']}")
 
         return Response(status_code=200)
 
 
 @router.put('/{id}/register', dependencies=[Depends(validate_uuid)])
-def update_attendance(request: Request, id: str, payload: SetAttendancePayload, token: AccessTokenPayload = Depends(authorize)):
+async def update_attendance(request: Request, id: str, payload: SetAttendancePayload, token: AccessTokenPayload = Depends(authorize)):
     """ 
     Update attendance of member. Only admin can update others' attendance.
     Non-admin: supply event register id in url
     admin: supply event eid in url
     """
-    db = get_database(request)
+    db = get_async_database(request)
     isAdmin = token.role == 'admin'
     isSelfUpdate = payload.member_id == None
 
@@ -720,11 +778,11 @@ def update_attendance(request: Request, id: str, payload: SetAttendancePayload,
 
     # On self update, find event associated with register id
     if isSelfUpdate:
-        event = db.events.find_one({'register_id': UUID(id)})
-        member = db.members.find_one({'id': UUID(token.user_id)})
+        event = await db.events.find_one({'register_id': UUID(id)}, {'participants': 0})
+        member = await db.members.find_one({'id': UUID(token.user_id)})
     else:
-        event = get_event_or_404(db, id)
-        member = db.members.find_one({'id': UUID(payload.member_id)})
+        event = await get_event_header_or_404(db, id)
+        member = await db.members.find_one({'id': UUID(payload.member_id)})
 
     # Verify event is valid
     if isSelfUpdate and not event:
@@ -738,33 +796,21 @@ def update_attendance(request: Request, id: str, payload: SetAttendancePayload,
     if not isAdmin and not event_starts_in(event, 1):
         raise HTTPException(403, "Cannot register attendance yet")
 
-    # Get participant entry for event with member
-    user_event = db.events.find_one({"eid": event["eid"]}, {"participants": {
-        "$elemMatch": {"id": member["id"]}}})
+    # Update attendance, fails if user has not joined event
+    joined = await registrations.update_participant(db, event, member["id"], {'attended': payload.attendance})
 
     # Verify user is joined event
-    if not user_event or 'participants' not in user_event:
+    if not joined:
         raise HTTPException(400, "User not joined event")
 
-    # Update attendance
-    res = db.events.update_one(
-        {'eid': event['eid'], 'participants': {
-            '$elemMatch': {'id': member['id']}
-        }},
-        {'$set': {'participants.$.attended': payload.attendance}}
-    )
-
-    if not res:
-        raise HTTPException(500)
-
     return Response(status_code=200)
 
 
 @router.post('/{id}/register-absence', dependencies=[Depends(validate_uuid)])
 async def register_absence(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
     """ Give all members absent on binding event a penalty """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
 
     if not event["bindingRegistration"]:
         raise HTTPException(400, "Cannot penalize on non-binding events")
@@ -775,25 +821,15 @@ async def register_absence(request: Request, id: str, token: AccessTokenPayload
     if not event["confirmed"]:
         raise HTTPException(400, "Cannot penalize unconfirmed event")
 
-    # Aggregate all participants that are confirmed, but not attended,
-    # and group them by ids
-    pipeline = [
-        {"$match": {"eid": event["eid"]}},
-        {"$unwind": {"path": "$participants"}},
-        {"$match": {"$and": [
-            {"participants.confirmed": {"$eq": True}},
-            {"participants.attended": {"$ne": True}}
-        ]}},
-        {"$group": {"_id": "$participants.id"}},
-    ]
-    absent = list(db.events.aggregate(pipeline))
+    # All participants that are confirmed, but not attended
+    participants = await registrations.get_participants(db, event, fields=['confirmed', 'attended'])
+    absent_ids = list(dict.fromkeys(
+        p["id"] for p in participants
+        if p.get("confirmed") == True and p.get("attended") != True))
 
-    if not absent or len(absent) == 0:
+    if len(absent_ids) == 0:
         raise HTTPException(400, "No members to penalize")
 
-    # Get ids
-    absent_ids = [p["_id"] for p in absent]
-
     # Get already penalized ids
     penalized_ids = event["registeredPenalties"]
 
@@ -806,197 +842,104 @@ async def register_absence(request: Request, id: str, token: AccessTokenPayload
     if len(to_penalize) == 0:
         raise HTTPException(400, "Members already penalized")
 
-    # Add penalty to selected
-    updates = []
-    for m_id in to_penalize:
-        # Add penalty to member and all event participant entries
-        await penalize(db, m_id)
-        # Add id to registeredPenalties on event
-        updates.append(UpdateOne(
-            {"eid": event["eid"]},
-            {"$addToSet": {"registeredPenalties": m_id}}
-        ))
+    # Add penalty to member and all event participant entries of selected
+    await penalize_members(db, to_penalize)
+    invalidate_members(request, to_penalize)
 
-    # Write to event db
-    res = db.events.bulk_write(updates)
+    # Add ids to registeredPenalties on event
+    res = await db.events.update_one(
+        {"eid": event["eid"]},
+        with_version_bump({"$addToSet": {"registeredPenalties": {"$each": to_penalize}}})
+    )
 
     if not res:
         raise HTTPException(500)
 
+    invalidate_event_listings(request)
+
     return Response(status_code=200)
 
 
+# registration qr pdfs are only served to admins, clients must revalidate with the etag
+QR_HEADERS = {'Content-Disposition': 'attachment; filename="QR.pdf"', 'Cache-Control': 'private, no-cache'}
+
+
+async def registration_qr_pdf(request: Request, event):
+    """ Returns (etag, pdf) of the registration qr of event, rendered once per process """
+    etag = qr_etag(event['title'], event['register_id'])
+    cache = request.app.qr_cache
+    cached = cache.get(event['register_id'])
+    # the etag changes with the title, which makes the cached pdf outdated
+    if cached and cached[0] == etag:
+        return cached
+    generation = cache.generation
+    pdf = await run_in_threadpool(render_qr_pdf, event['title'], event['register_id'])
+    cache.set(event['register_id'], (etag, pdf), generation)
+    return etag, pdf
+
+
 @router.post('/{id}/qr', dependencies=[Depends(validate_uuid)])
-def create_registration_qr(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
+async def create_registration_qr(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
     """ Generate a registration QR code for event """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
 
-    # Check whether QR already has been created
-    rid_created = 'register_id' in event and event['register_id']
-    filepath = f'{get_qr_path(request)}/{event["eid"].hex}.pdf'
-    if rid_created and os.path.exists(filepath):
+    # Check whether QR already has been created, it is rendered again from the register id on GET
+    if event.get('register_id'):
         raise HTTPException(400, "Event QR already created")
 
     # Generate new unique id for attendance registration
-    # Only if rid has not yet been created
+    # Only if rid has not yet been created, also when requests for the same event race
     register_id = uuid4()
 
-    res = db.events.update_one(
-        {'eid': UUID(id)},
-        {'$set': {'register_id': register_id}}
+    res = await db.events.update_one(
+        {'eid': UUID(id), 'register_id': None},
+        with_version_bump({'$set': {'register_id': register_id}})
     )
 
-    if not res:
-        raise HTTPException(500)
+    if res.matched_count == 0:
+        raise HTTPException(400, "Event QR already created")
+
+    invalidate_event_listings(request)
 
-    # Create directory if not present
-    path = get_qr_path(request)
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    # Generate qr code
-    url = f'https://td-uit.no/event/{register_id}/register/'
-    img = qr.make(url)
-    qr_path = path
-    img_path = f'{qr_path}/{register_id.hex}.png'
-    img.save(img_path)
-
-    # Create PDF
-    pdf = FPDF()
-    pdf.add_page()
-
-    # Add title
-    title = event['title']
-    title_h = pdf.h * 0.05
-    pdf.set_font('helvetica', size=26)
-    pdf.multi_cell(0, title_h, text=title, align='C', max_line_height=title_h)
-
-    # Get width and heigh to display image
-    w, h = img.size
-    pdf_w = pdf.w * 0.8
-    pdf_h = pdf_w * h / w
-    y = title_h + pdf.h * 0.08
-
-    # Add QR code
-    pdf.image(img_path, x=pdf.w * 0.1, y=y, w=pdf_w, h=pdf_h)
-
-    # Add new line of text below the image
-    pdf.set_xy(0, y + pdf_h + pdf.h * 0.05)
-    pdf.set_font('helvetica', size=10)
-    pdf.cell(0, 20, text=url, align='C')
-
-    # Save PDF
-    pdf_path = f'{qr_path}/{event["eid"].hex}.pdf'
-    pdf.output(pdf_path)
-
-    # Clean up QR image
-    os.remove(img_path)
+    event['register_id'] = register_id
+    etag, pdf = await registration_qr_pdf(request, event)
 
     # Send qr PDF
-    headers = {'Content-Disposition': 'attachment; filename="QR.pdf"'}
-    return FileResponse(pdf_path, headers=headers, status_code=201)
+    return Response(pdf, status_code=201, media_type="application/pdf", headers={**QR_HEADERS, "ETag": etag})
 
 
 @router.get('/{id}/qr', dependencies=[Depends(validate_uuid)])
-def get_registration_qr(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
+async def get_registration_qr(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
     """ Get qr code link to registration page of event """
-    db = get_database(request)
-    event = get_event_or_404(db, id)
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
 
     if not event['register_id']:
         raise HTTPException(400, "Event not open for registration")
 
-    path = f'{get_qr_path(request)}/{event["eid"].hex}.pdf'
-    if not os.path.isfile(path):
-        raise HTTPException(404, "Could not find QR code")
+    # the etag is known without rendering the pdf
+    etag = qr_etag(event['title'], event['register_id'])
+    if is_not_modified(request, etag):
+        return not_modified_response(etag, QR_HEADERS)
+
+    etag, pdf = await registration_qr_pdf(request, event)
     # Send qr PDF
-    headers = {'Content-Disposition': 'attachment; filename="QR.pdf"'}
-    return FileResponse(path, headers=headers)
+    return Response(pdf, media_type="application/pdf", headers={**QR_HEADERS, "ETag": etag})
 
 
 @router.get('/{id}/export', dependencies=[Depends(validate_uuid)])
-async def exportEvent(background_tasks: BackgroundTasks, request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin)):
-    if not os.path.exists(get_export_path(request)):
-        os.makedirs(get_export_path(request))
-
-    filename = f"{id}.xlsx"
-    export_dir = get_export_path(request)
-    path = f"{export_dir}/{filename}"
-
-    db = get_database(request)
-    event = get_event_or_404(db, id)
-
-    participants = [Participant(
-        **p).model_copy().model_dump(exclude={'id'}) for p in event['participants']]
-
-    event_details = [{'Title': event['title'], 'date': event['date'], 'address': event['address'], 'price': event['price'],
-                      'maxParticipants': event['maxParticipants'], 'duration': event['duration'], 'transportation': str(event['transportation']), 'food': str(event['food'])}]
-
-    event_header = [{event['title']}]
-
-    event_data = [{'Total participants': len(event['participants']),
-                   'Total to eat': len([p for p in event['participants'] if p['food'] == True]),
-                   'Total to transportation':  len(
-        [p for p in event['participants'] if p['transportation'] == True])}]
-
-    # Create dataframe
-    df_title = pd.DataFrame(event_header)
-    df_event_data = pd.DataFrame(event_data)
-    df_participants = pd.DataFrame(
-        data=participants, )
-    df_event_ditails = pd.DataFrame(data=event_details)
-
-    # Write dataframes to file
-    writer = pd.ExcelWriter(path, engine='xlsxwriter')
-    df_title.to_excel(writer, sheet_name='Event',
-                      startrow=0, startcol=0, index=False, header=False)
-    df_event_ditails.to_excel(writer, sheet_name='Event',
-                              startrow=3, startcol=0, index=False, header=True)
-    df_event_data.to_excel(writer, sheet_name='Event',
-                           startrow=8, startcol=0, index=False,)
-    df_participants.to_excel(writer, sheet_name='Event',
-                             startrow=13, startcol=0, index=False)
-
-    # Set some cascading
-    workbook = writer.book
-    worksheet = writer.sheets['Event']
-
-    title_format = workbook.add_format({'bold': True, 'font_size': 20})
-    table_header_format = workbook.add_format({'bg_color': 'gray'})
-    participants_accept_format = workbook.add_format({'bg_color': '#b3dfc1'})
-    participants_accept_format2 = workbook.add_format({'bg_color': '#bfe2ca'})
-    participants_wait_format = workbook.add_format({'bg_color': '#e6b9b8'})
-    participants_wait_format2 = workbook.add_format({'bg_color': '#f2dddc'})
-
-    worksheet.set_row(0, 25, title_format)
-    worksheet.set_column(0, 8, 18, None)
-
-    worksheet.set_row(4, 15, table_header_format)
-    worksheet.set_row(9, 15, table_header_format)
-
-    pos_in_waitinglist = len(event["participants"])
-    if event["maxParticipants"]:
-        pos_in_waitinglist = event["maxParticipants"]
-
-    # 0 indexed
-    participant_list_start_pos = 14
-    accept_color_pair = (participants_accept_format,
-                         participants_accept_format2)
-    wait_color_pair = (participants_wait_format, participants_wait_format2)
-    for col in range(0, len(participants)):
-        current_row = participant_list_start_pos + col
-        color_scheme = accept_color_pair
-        if col >= pos_in_waitinglist:
-            # set red color when user is in waiting list
-            color_scheme = wait_color_pair
-        # switch color version every other row
-        color_version = color_scheme[col % 2]
-        worksheet.set_row(current_row, current_row, cell_format=color_version)
-
-    # Cleanup file created after request is done
-    writer.close()
-    background_tasks.add_task(os.remove, path)
-
-    headers = {'Content-Disposition': 'attachment; filename="Book.xlsx"'}
-    return FileResponse(path, headers=headers)
+async def exportEvent(request: Request, id: str, token: AccessTokenPayload = Depends(authorize_admin),
+                      file_format: Literal['xlsx', 'csv', 'ndjson'] = Query('xlsx', alias='format')):
+    """
+    Exports event details and the participant list as xlsx, or only the participants as csv or ndjson.
+    Participants are streamed from the database, the whole list is never held in memory
+    """
+    db = get_async_database(request)
+    event = await get_event_header_or_404(db, id)
+
+    if file_format == 'csv':
+        return csv_export(db, event, "Participants")
+    if file_format == 'ndjson':
+        return ndjson_export(db, event, "Participants")
+    return await xlsx_export(db, event, "Book")
@@ -1,35 +1,41 @@
-from fastapi import APIRouter, Request, HTTPException, Depends, Response
+from fastapi import APIRouter, Request, HTTPException, Depends, Response, Query
 from ..db import get_database, get_JobImage_path
 from ..models import JobItem, JobItemPayload, AccessTokenPayload, UpdateJob
 from app.utils.validation import validate_image_file_type, validate_uuid
 from ..auth_helpers import authorize_admin
+from ..images import ImageStore, image_response, upload_image
+from app.utils.etag import check_etag, document_etag
+from app.utils.serialization import json_response, validate_many
 from fastapi.datastructures import UploadFile
 from fastapi.param_functions import File
 from pydantic import ValidationError
-import os
-import shutil
 from datetime import datetime
+from typing import Literal, Optional
 from uuid import UUID, uuid4
-from starlette.responses import FileResponse
 
 
 router = APIRouter()
 
 
 @router.get('/')
-def get_jobs(request: Request):
+def get_jobs(request: Request, response: Response):
     db = get_database(request)
+    # the listing changes with the ids and versions of the jobs, read those first
+    # so clients with the current listing are answered without reading the jobs
+    versions = [(job['id'], job.get('version')) for job in db.jobs.find({}, {'_id': 0, 'id': 1, 'version': 1})]
+    check_etag(request, response, document_etag(request, "jobs", None, None, versions))
     jobs = db.jobs.find()
-    return [JobItem.model_validate(job) for job in jobs]
+    return json_response(validate_many(JobItem, jobs), headers=dict(response.headers))
 
 
 @router.get('/{id}')
-def get_job_by_id(request: Request, id: str):
+def get_job_by_id(request: Request, response: Response, id: str):
     db = get_database(request)
     job = db.jobs.find_one({'id': UUID(id)})
     if job == None:
         raise HTTPException(404, "No such job with this id")
-    return JobItem.model_validate(job)
+    check_etag(request, response, document_etag(request, "job", job['id'], job.get('version')))
+    return json_response(JobItem.model_validate(job), headers=dict(response.headers))
 
 
 @router.post('/')
@@ -40,7 +46,8 @@ def create_job(request: Request, job: JobItemPayload, token: AccessTokenPayload
     item['id'] = jid
     item['published_date'] = datetime.now()
     _job = JobItem.model_validate(item)
-    retval = db.jobs.insert_one(_job.model_dump())
+    # incremented on every update, see utils/etag.document_etag
+    retval = db.jobs.insert_one({**_job.model_dump(), 'version': 0})
     if not retval:
         raise HTTPException(500, "Job could not be created")
 
@@ -75,7 +82,7 @@ def update_job(request: Request, id: str, job: UpdateJob, token: AccessTokenPayl
             400, "Cannot remove field as this is required filed for all jobs")
 
     res = db.jobs.find_one_and_update(
-        {'id': UUID(id)},  {'$set': _job})
+        {'id': UUID(id)},  {'$set': _job, '$inc': {'version': 1}})
 
     if not res:
         raise HTTPException(500, "Error updating job")
@@ -84,12 +91,12 @@ def update_job(request: Request, id: str, job: UpdateJob, token: AccessTokenPayl
 
 
 @router.get('/{id}/image', dependencies=[Depends(validate_uuid)])
-def get_job_picture(request: Request, id: str):
-    image_path = get_JobImage_path(request)
-    file_name = f"{image_path}/{UUID(id).hex}.png"
-    if not os.path.exists(file_name):
-        raise HTTPException(404, "picture not found")
-    return FileResponse(file_name)
+def get_job_picture(request: Request, id: str, size: Literal['small', 'medium', 'large'] = 'large',
+                    image_format: Optional[Literal['avif', 'webp', 'jpeg', 'png']] = Query(None, alias='format'),
+                    v: Optional[str] = None):
+    """ Job picture, see get_event_picture """
+    store = ImageStore(get_JobImage_path(request))
+    return image_response(request, store, UUID(id).hex, size, image_format, v)
 
 
 @router.post('/{id}/image', dependencies=[Depends(validate_uuid)])
@@ -97,14 +104,6 @@ def upload_job_picture(request: Request, id: str, image: UploadFile = File(...),
     if not validate_image_file_type(image.content_type):
         raise HTTPException(400, "Unsupported file type")
 
-    jobImage_path = get_JobImage_path(request)
-
-    if not os.path.isdir(jobImage_path):
-        os.mkdir(jobImage_path)
-
-    picturePath = f"{jobImage_path}/{UUID(id).hex}.png"
-
-    with open(picturePath, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
+    upload_image(request, ImageStore(get_JobImage_path(request)), UUID(id).hex, image.file)
 
     return Response(status_code=200)
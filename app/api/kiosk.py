@@ -1,9 +1,10 @@
 from datetime import datetime
+from typing import Optional
 from uuid import UUID, uuid4
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 
-from app.auth_helpers import authorize, authorize_admin, authorize_kiosk_admin
+from app.auth_helpers import authorize, authorize_admin, authorize_kiosk_admin, current_member
 from app.db import get_database
 
 from ..models import AccessTokenPayload, KioskSuggestionPayload, Role
@@ -16,10 +17,10 @@ def add_suggestion(
     request: Request,
     newSuggestion: KioskSuggestionPayload,
     token: AccessTokenPayload = Depends(authorize),
+    member: Optional[dict] = Depends(current_member),
 ):
     db = get_database(request)
 
-    member = db.members.find_one({"id": UUID(token.user_id)})
     if member is None:
         raise HTTPException(404)
 
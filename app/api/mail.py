@@ -1,44 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException, Response
-from ..auth_helpers import get_google_credentials
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from ..auth_helpers import authorize_admin
+from ..mailer import InvalidSenderError, Mailer, get_mailer
 from ..models import MailPayload, AccessTokenPayload
 
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from google.auth.exceptions import RefreshError
-from email.message import EmailMessage
-import base64
-
 router = APIRouter()
 
-@router.post('/send-mail/')
-def send_mail(payload: MailPayload, token: AccessTokenPayload = Depends(authorize_admin)):
+
+def deliver(mailer: Mailer, payload: MailPayload):
+    """
+    Sends a single mail, failures are raised as http errors
+    """
     try:
-        creds = get_google_credentials(payload.sent_by)
+        result = mailer.send_one(payload)
     except FileNotFoundError:
         raise HTTPException(500, "Internal server error")
+    except InvalidSenderError:
+        raise HTTPException(400, 'Invalid sent_from email')
 
-    try:
-        # Call the Gmail API
-        service = build('gmail', 'v1', credentials=creds)
-        message = EmailMessage()
-
-        message['Subject'] = payload.subject
-        message.set_content(payload.content)
-        message['To'] = payload.to
-        message['From'] = payload.sent_by
-
-         # encoded message
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-
-        create_message = {
-            'raw': encoded_message
-        }
-        # pylint: disable=E1101
-        send_message = service.users().messages().send(userId="me", body=create_message).execute()
-    except HttpError as error:
+    if not result.ok:
         raise HTTPException(500, 'Internal server error when communicating with google')
-    except RefreshError:
-        raise HTTPException(400, 'Invalid sent_from email')
 
-    return Response(status_code=200)
\ No newline at end of file
+
+@router.post('/send-mail/')
+def send_mail(payload: MailPayload, request: Request, token: AccessTokenPayload = Depends(authorize_admin)):
+    deliver(get_mailer(request), payload)
+    return Response(status_code=200)
@@ -1,17 +1,21 @@
-from fastapi import APIRouter, Response, Request, HTTPException, Depends
+from fastapi import APIRouter, Response, Request, HTTPException, Depends, Query
 from pydantic.networks import EmailStr
-from werkzeug.security import generate_password_hash
 from pymongo import ReturnDocument
-from typing import List
+from typing import List, Optional
 from uuid import uuid4, UUID
 from datetime import datetime
-from .mail import send_mail
 
+from app.utils.etag import check_etag, make_etag
+from app.utils.serialization import json_response, validate_many
+from app.utils.pagination import MAX_PAGE_SIZE, decode_cursor, keyset_filter, ndjson_response, page_cursor
 from app.utils.validation import validate_uuid
 
-from ..models import Member, MemberDB, MemberInput, MemberUpdate, AccessTokenPayload, MailPayload, ForgotPasswordPayload, Role, Status
-from ..auth_helpers import authorize, authorize_admin, role_required
+from ..models import Member, MemberInput, MemberUpdate, AccessTokenPayload, MailPayload, ForgotPasswordPayload, Role, Status
+from ..auth_helpers import authorize, authorize_admin, current_member, get_cached_member, invalidate_members
 from ..db import get_database
+from ..hashing import get_password_hasher
+from ..mail_templates import get_mail_templates
+from ..outbox import enqueue_mails
 from ..utils import validate_password, passwordError
 
 router = APIRouter()
@@ -24,7 +28,7 @@ def create_new_member(request: Request, newMember: MemberInput):
         raise HTTPException(409, 'E-mail is already in use.')
     if not validate_password(newMember.password):
         raise HTTPException(400, passwordError)
-    pwd = generate_password_hash(newMember.password)
+    pwd = get_password_hasher(request).hash_sync(newMember.password)
     uid = uuid4()
     additionalFields = {
         'id': uid,
@@ -46,33 +50,38 @@ def create_new_member(request: Request, newMember: MemberInput):
         {"confirmationCode": confirmationCode, 'user_id': member['id']}
     )
     
-    if request.app.config.ENV == 'production':
-        # Send email to new user for verification
-        with open("./app/assets/mails/member_confirmation.txt", 'r') as mail_content:
-            confirmation_email = MailPayload(
-                to = [newMember.email],
-                subject = "Confirmation email",
-                content = mail_content.read().replace("$LINK$", f"{request.app.config.FRONTEND_URL}/confirmation/{confirmationCode.hex}")
-            )
-        send_mail(confirmation_email)
+    # Send email to new user for verification
+    confirmation_email = MailPayload(
+        to = [newMember.email],
+        subject = "Confirmation email",
+        content = get_mail_templates(request).render(
+            "member_confirmation", LINK=f"{request.app.config.FRONTEND_URL}/confirmation/{confirmationCode.hex}")
+    )
+    # sent by the mail worker, see app/outbox.py
+    enqueue_mails(db, [confirmation_email], keys=[f"signup:{confirmationCode.hex}"])
+
+def member_etag(request: Request, member: dict) -> str:
+    """ Members have no version field, the etag is derived from the (cached) document itself """
+    return make_etag(request.app.version, "member", sorted(member.items()))
+
 
 @router.get('/')
-def get_member_associated_with_token(request: Request, token: AccessTokenPayload = Depends(authorize)):
-    db = get_database(request)
-    currentMember = db.members.find_one({'id': UUID(token.user_id)})
+def get_member_associated_with_token(request: Request, response: Response, token: AccessTokenPayload = Depends(authorize)):
+    currentMember = get_cached_member(request, UUID(token.user_id))
     if not currentMember:
         raise HTTPException(404, "User could not be found")
-    return Member.model_validate(currentMember)
+    check_etag(request, response, member_etag(request, currentMember))
+    return json_response(Member.model_validate(currentMember), headers=dict(response.headers))
 
 
 @router.get('/{id}', response_model=Member, responses={404: {"model": None}}, dependencies=[Depends(validate_uuid)])
-def get_member_by_id(request: Request, id: str, token: dict = Depends(authorize)):
+def get_member_by_id(request: Request, response: Response, id: str, token: dict = Depends(authorize)):
     '''Returns a user object associated with id passed in'''
-    db = get_database(request)
-    member = db.members.find_one({'id': UUID(id)})
+    member = get_cached_member(request, UUID(id))
     if not member:
         raise HTTPException(404, 'Member not found')
-    return Member.model_validate(member)
+    check_etag(request, response, member_etag(request, member))
+    return json_response(Member.model_validate(member), headers=dict(response.headers))
 
 @router.get('/email/{email}')
 def get_member_by_email(request: Request, email: EmailStr, token: AccessTokenPayload = Depends(authorize_admin)):
@@ -82,21 +91,86 @@ def get_member_by_email(request: Request, email: EmailStr, token: AccessTokenPay
         raise HTTPException(404, 'Member not found')
     return {'id': member['id'].hex}
 
+# unique, makes the member order usable for keyset pagination
+MEMBERS_SORT = [('id', 1)]
+
+
+def member_list_query(role: Optional[Role], status: Optional[Status], classof: Optional[str],
+                      graduated: Optional[bool], penalty: Optional[int], fields: Optional[List[str]],
+                      cursor: Optional[str]):
+    ''' Returns filter and projection of a member listing '''
+    search_filter = {}
+    for key, value in [('role', role), ('status', status), ('classof', classof),
+                       ('graduated', graduated), ('penalty', penalty)]:
+        if value is not None:
+            search_filter[key] = f'{value}' if isinstance(value, (Role, Status)) else value
+    if cursor:
+        search_filter = {"$and": [search_filter, keyset_filter(
+            MEMBERS_SORT, decode_cursor(cursor, len(MEMBERS_SORT)))]}
+
+    # never read passwords
+    projection = {'_id': 0, 'password': 0}
+    if fields:
+        unknown = set(fields) - set(Member.model_fields)
+        if unknown:
+            raise HTTPException(400, f"Unknown member fields: {', '.join(sorted(unknown))}")
+        # id is needed for the cursor
+        projection = {'_id': 0, 'id': 1, **{f: 1 for f in fields}}
+    return search_filter, projection
+
+
 @router.get("s/", response_model=List[Member])
-def get_all_members(request: Request, token: AccessTokenPayload = Depends(authorize_admin)):
-    '''List all members objects'''
+def get_all_members(request: Request, token: AccessTokenPayload = Depends(authorize_admin),
+                    role: Optional[Role] = None, status: Optional[Status] = None, classof: Optional[str] = None,
+                    graduated: Optional[bool] = None, penalty: Optional[int] = None,
+                    fields: Optional[List[str]] = Query(None),
+                    cursor: Optional[str] = None, limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE)):
+    '''
+    List members objects, optionally filtered on role, status, classof, graduated and penalty. \n
+    fields: only return these member fields (id is always included) \n
+    limit: return pages of at most limit members, all members are returned without limit and cursor \n
+    cursor: X-Next-Cursor header of the previous page, omit for the first page.
+    The header is not set on the last page
+    '''
+    db = get_database(request)
+    search_filter, projection = member_list_query(role, status, classof, graduated, penalty, fields, cursor)
+    members = db.members.find(search_filter, projection).sort(MEMBERS_SORT)
+
+    headers = {}
+    if limit is not None or cursor:
+        limit = limit or MAX_PAGE_SIZE
+        # reads one member more than requested to know whether there is a next page
+        members, next_cursor = page_cursor(list(members.limit(limit + 1)), MEMBERS_SORT, limit)
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+
+    members = validate_many(Member, members) if not fields else list(members)
+    return json_response(members, headers=headers)
+
+
+@router.get("s/stream")
+def stream_all_members(request: Request, token: AccessTokenPayload = Depends(authorize_admin),
+                       role: Optional[Role] = None, status: Optional[Status] = None, classof: Optional[str] = None,
+                       graduated: Optional[bool] = None, penalty: Optional[int] = None,
+                       fields: Optional[List[str]] = Query(None), cursor: Optional[str] = None):
+    ''' Streams all members matching the filters (see GET /members/) as newline delimited json '''
     db = get_database(request)
-    return [Member.model_validate(m) for m in db.members.find()]
+    search_filter, projection = member_list_query(role, status, classof, graduated, penalty, fields, cursor)
+
+    members = db.members.find(search_filter, projection).sort(MEMBERS_SORT)
+    if not fields:
+        members = (Member.model_validate(m) for m in members)
+    return ndjson_response(members)
 
 @router.post('/activate')
-def change_status(request: Request, token: AccessTokenPayload = Depends(authorize)):
+def change_status(request: Request, token: AccessTokenPayload = Depends(authorize),
+                  member: Optional[dict] = Depends(current_member)):
     '''Sets the member status to active'''
     db = get_database(request)
-    member = db.members.find_one({'id': UUID(token.user_id)})
     if not member:
         raise HTTPException(404, 'Member not found')
 
-    member = MemberDB.model_validate(member)
+    member = Member.model_validate(member)
     if member.status == Status.active:
         raise HTTPException(400, "member already activated")
 
@@ -106,6 +180,7 @@ def change_status(request: Request, token: AccessTokenPayload = Depends(authoriz
     )
     if not result:
         raise HTTPException(500)
+    invalidate_members(request, [member.id])
     return Response(status_code=200)
 
 
@@ -130,6 +205,7 @@ def confirm_email(request: Request, code: str):
     if not user:
         # User associated with confirmation token does not exist.
         raise NotMatchedError
+    invalidate_members(request, [user['id']])
 
     return Response(status_code=200)
 
@@ -167,15 +243,15 @@ def generate_new_confirmation_code(request: Request, email: str):
         # An error occured when updating the user with the confirmation code
         raise HTTPException(500)
 
-    if request.app.config.ENV == 'production':
-        # Send email to new user for verification
-        with open("./app/assets/mails/member_confirmation.txt", 'r') as mail_content:
-            confirmation_email = MailPayload(
-                to = [email],
-                subject = "Confirmation email",
-                content = mail_content.read().replace("$LINK$", f"{request.app.config.FRONTEND_URL}/confirmation/{newConfirmationCode.hex}")
-            )
-        send_mail(confirmation_email)
+    # Send email to new user for verification
+    confirmation_email = MailPayload(
+        to = [email],
+        subject = "Confirmation email",
+        content = get_mail_templates(request).render(
+            "member_confirmation", LINK=f"{request.app.config.FRONTEND_URL}/confirmation/{newConfirmationCode.hex}")
+    )
+    # sent by the mail worker, see app/outbox.py
+    enqueue_mails(db, [confirmation_email], keys=[f"signup:{newConfirmationCode.hex}"])
     return Response(status_code=200)
 
 @router.post('/reset-password/code/{email}')
@@ -204,14 +280,14 @@ def generate_new_reset_password_code(request: Request, email: str):
         # An error occured when updating the user with the confirmation code
         raise HTTPException(500)
 
-    if request.app.config.ENV == 'production':
-        with open("./app/assets/mails/restore_password.txt", 'r') as mail_content:
-            resetPasswordEmail = MailPayload(
-                to = [email],
-                subject = "TD Website reset password",
-                content = mail_content.read().replace("$LINK$", f"{request.app.config.FRONTEND_URL}/reset-password/{newCode.hex}")
-            )
-        send_mail(resetPasswordEmail)
+    resetPasswordEmail = MailPayload(
+        to = [email],
+        subject = "TD Website reset password",
+        content = get_mail_templates(request).render(
+            "restore_password", LINK=f"{request.app.config.FRONTEND_URL}/reset-password/{newCode.hex}")
+    )
+    # sent by the mail worker, see app/outbox.py
+    enqueue_mails(db, [resetPasswordEmail], keys=[f"reset:{newCode.hex}"])
 
     return Response(status_code=200)
 
@@ -236,7 +312,7 @@ def reset_password(request: Request, newPasswordPayload : ForgotPasswordPayload
         raise NotMatchedError
 
     # Generate hash of new password
-    pwd = generate_password_hash(newPasswordPayload.newPassword)
+    pwd = get_password_hasher(request).hash_sync(newPasswordPayload.newPassword)
 
     # Update member with new hash
     user = db.members.find_one_and_update(
@@ -273,6 +349,7 @@ def update_member(request: Request, memberData: MemberUpdate, token: AccessToken
 
     if not result:
         raise HTTPException(500)
+    invalidate_members(request, [member["id"]])
 
     return Response(status_code=201)
 
@@ -5,11 +5,10 @@ from typing import Optional
 from uuid import UUID
 from app.api.utils import find_object_title_from_path
 from fastapi import APIRouter, Depends, HTTPException, Request, BackgroundTasks, Response
-from app.auth_helpers import authorize, authorize_admin
+from app.auth_helpers import authorize, authorize_admin, get_cached_member
 from app.db import get_database
-import pickle as pkl
+from app.telemetry import get_visit_buffer
 from app.utils.date import Interval, add_continous_datapoints_to_log, format_date
-from pybloom_live import ScalableBloomFilter
 
 from app.models import AccessTokenPayload, PageVisit
 
@@ -74,73 +73,30 @@ def get_number_of_unique_visitors(request: Request, start: Optional[str] = None,
         start_date = format_date(visits[0]["date"], query_format)
     return add_continous_datapoints_to_log(visits, start_date, end_date, interval)
 
-def register_new_visit(db, user_id):
-    member = db.members.find_one({'id': UUID(user_id)})
-    if not member:
-        logging.error(f"404 - User with {user_id} could not be found")
-        return
-    today = datetime.today().strftime('%Y-%m-%d')
-    stats = db.uniqueFilter.find_one({'entry_date': today})
-    update_dict = {}
-    # checks if bloomfilter is added for the day
-    if not stats:
-        update_dict = {
-            "createdAt": datetime.utcnow(),
-            "entry_date": today,
-        }
-        # adds a fresh bloomfilter
-        bf = ScalableBloomFilter(initial_capacity=1000, error_rate=0.001, mode=ScalableBloomFilter.SMALL_SET_GROWTH)
-    else:
-        # load the existing filter into memory
-        bf = pkl.loads(stats["bloom_filter"])
-
-    # add returns True if key exists in filter and false on successful insert(for some reason)
-    exists = bf.add(user_id)
-    if exists:
+def queue_unique_visit(request: Request, user_id: str):
+    buffer = get_visit_buffer(request)
+    # repeated visits of a member are counted without a database read or write
+    if buffer.counted_today(user_id):
         return
-
-    # stores time object instead of string representation since we don't need to format
-    # 26 bytes per entry timestamp and _id
-    ts = datetime.now()
-    res = db.uniqueVisitLog.insert_one({"timestamp": ts})
-    if not res:
-        logging.error(f"could not insert timestamp: {ts}")
+    if not get_cached_member(request, UUID(user_id)):
+        logging.error(f"404 - User with {user_id} could not be found")
         return
-
-    update_dict.update({"bloom_filter": pkl.dumps(bf)})
-
-    # upsert=True to create the document if non is found for this date
-    res = db.uniqueFilter.update_one({'entry_date': today}, {"$set": update_dict}, upsert=True)
-    if not res:
-        logging.error(f"could not update bloom_filter with: {today}, {update_dict}")
+    buffer.add_unique_visit(user_id)
 
 @router.post('/unique-visit')
 async def add_unique_member_visit(request: Request, background_task: BackgroundTasks, token: AccessTokenPayload = Depends(authorize)):
     ''' endpoint to track unique visitors per day. Uses background_tasks as we want to return 200 ok at once.
         The reason is that this endpoint should have minimal effect on the user and errors should only be logged.
+        Visits are written in batches, see app/telemetry.py
     '''
-    db = get_database(request)
-    background_task.add_task(register_new_visit, db, token.user_id)
+    background_task.add_task(queue_unique_visit, request, token.user_id)
     return Response(status_code=200)
 
-def register_page_visit(db, page):
-    # keywords the api should not track 
-    untrackable_keywords = ["admin", "archive"]
-
-    for keyword in untrackable_keywords:
-        if keyword in page:
-            return
-
-    ts = datetime.now()
-    res = db.pageVisitLog.insert_one({"timestamp": ts, "metaData": page})
-    if not res:
-        logging.error(f"could not insert visit on page: {page}")
-
 # builds on top of the react-router-dom location.pathname for identifying the page
 @router.post('/page-visit')
 async def add_page_visit(request: Request, payload: PageVisit, background_task: BackgroundTasks):
-    db = get_database(request)
-    background_task.add_task(register_page_visit, db, payload.page)
+    ''' Visits are buffered and written in batches, see app/telemetry.py. A full batch is written by the background task '''
+    background_task.add_task(get_visit_buffer(request).add_page_visit, payload.page)
     return Response(status_code=200)
 
 # gets the numbers of visit for a page between start and end
@@ -247,3 +203,9 @@ def get_most_visited_page(request: Request, token: AccessTokenPayload = Depends(
             title = path
         page.update({"title": title})
     return pages
+
+
+@router.get('/metrics')
+def get_metrics(request: Request, token: AccessTokenPayload = Depends(authorize_admin)):
+    ''' Current values of in-process metrics of the api process answering, e.g. cache hit/miss counters '''
+    return {name: metric() for name, metric in request.app.metrics.items()}
@@ -1,102 +1,156 @@
-from typing import Dict
+from typing import List
 from fastapi import HTTPException
 from uuid import UUID
 from datetime import datetime
 
-from pymongo import UpdateOne
 from pymongo.collection import Collection
 
-from app.models import EventDB
+from app.concurrency import with_version_bump
+from app.models import EventDB, EventHeader, EventWithCounts
+from app.registrations import get_participants, deprioritize_registrations, uses_registrations, \
+    find_participant, count_participants
+from app.utils.event_utils import move_participants_last_update
 
-import asyncio
 
-lock = asyncio.Lock()
-
-def get_event_or_404(db, eid: str):
-    event = db.events.find_one({'eid': UUID(eid)})
+async def get_event_or_404(db, eid: str):
+    event = await db.events.find_one({'eid': UUID(eid)})
 
     if not event:
         raise HTTPException(404, "Event could not be found")
 
+    # participants are read from the registrations collection for events using it
+    event['participants'] = await get_participants(db, event)
+
     return EventDB.model_validate(event).model_dump()
 
 
+# The fetchers below only read the parts of the event an endpoint needs,
+# use them over get_event_or_404 when the full participant list is not needed
+
+
+async def get_event_header_or_404(db, eid: str):
+    """ Returns event without participants """
+    event = await db.events.find_one({'eid': UUID(eid)}, {'participants': 0})
+
+    if not event:
+        raise HTTPException(404, "Event could not be found")
+
+    return EventHeader.model_validate(event).model_dump()
+
+
+async def get_event_with_participant_or_404(db, eid: str, member_id: UUID):
+    """
+    Returns event without participants and the participant entry of member.
+    Participant is None if member has not joined the event
+    """
+    # a projection of only participants.$elemMatch is an inclusion projection, which would leave out
+    # the event fields, so the participant is read by a second (indexed) query
+    event = await db.events.find_one({'eid': UUID(eid)}, {'participants': 0})
+
+    if not event:
+        raise HTTPException(404, "Event could not be found")
+
+    participant = await find_participant(db, event, member_id)
+
+    return EventHeader.model_validate(event).model_dump(), participant
+
+
+async def get_event_with_counts_or_404(db, eid: str):
+    """ Returns event without participants, but with the number of (confirmed/deprioritized) participants """
+    participants = {'$ifNull': ['$participants', []]}
+    pipeline = [
+        {'$match': {'eid': UUID(eid)}},
+        {'$addFields': {'participantCounts': {
+            'participants': {'$size': participants},
+            'confirmed': {'$size': {'$filter': {
+                'input': participants, 'cond': {'$eq': ['$$this.confirmed', True]}}}},
+            'deprioritized': {'$size': {'$filter': {
+                'input': participants, 'cond': {'$gt': ['$$this.penalty', 1]}}}},
+        }}},
+        {'$project': {'participants': 0}},
+    ]
+    res = await (await db.events.aggregate(pipeline)).to_list()
+
+    if not res:
+        raise HTTPException(404, "Event could not be found")
+
+    event = res[0]
+    if uses_registrations(event):
+        event['participantCounts'] = await count_participants(db, event)
+
+    return EventWithCounts.model_validate(event).model_dump()
+
+
 async def penalize(db, uid: UUID):
-    """ Apply penalty to member. Applies to member db and all joined event participant lists """
-
-    async with lock:
-        member = db.members.find_one({'id': uid})
-
-        if not member:
-            raise HTTPException(404, "Member not found")
-        
-        
-        should_deprioritize = bool(member['penalty'] >= 1)
-
-        # Apply penalty to member db
-        res = db.members.update_one({"id": uid}, {"$inc": {"penalty": 1}})
-
-        if not res:
-            raise HTTPException(500)
-        
-        # Apply penalty to all joined events
-        now = datetime.now()
-
-        date_str = now.strftime("%Y-%m-%d %H:%M:%S")
-        date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
-
-        pipeline = [
-            {"$match": {"date": {"$gt": date}}},
-            {"$unwind": "$participants"},
-            {"$match": {"participants.id": {"$eq": uid}}}
-        ]
-        joined = db.events.aggregate(pipeline)
-
-
-        if not joined:
-            raise HTTPException(500)
-        
-        updates = []
-        updated = False
-        for event in joined:
-            # Update penalty on event
-            res = db.events.update_one({"eid": event["eid"], "participants.id": uid}, {
-                "$inc": {"participants.$.penalty": 1}
-            })
-
-
-            if not res:
-                raise HTTPException(500)
-
-            # Deprioritize for this event
-            if should_deprioritize and not event["confirmed"]:
-                # Pull member from event
-                updates.append(UpdateOne({"eid": event["eid"]}, {
-                    "$pull": {"participants": {"id": uid}}
-                }))
-                
-                participant = event["participants"]
-
-                # Add penalty
-                if not updated:
-                    participant["penalty"] += 1
-                    updated = True
-
-                if not participant:
-                    raise HTTPException(500)
-                
-                updates.append(UpdateOne({"eid": event["eid"]}, {
-                    "$push": {"participants": participant}
-                }))
-
-
-        if len(updates) == 0:
-            return
-
-        res = db.events.bulk_write(updates)
-
-        if not res:
-            raise HTTPException(500)
+    """
+    Apply penalty to member. Applies to member db and all joined event participant lists.
+    db must be an async database, see get_async_database
+    """
+    if await penalize_members(db, [uid]) == 0:
+        raise HTTPException(404, "Member not found")
+
+
+async def penalize_members(db, member_ids: List[UUID]) -> int:
+    """
+    Apply penalty to all members in member_ids, in the member db and all joined upcoming events.
+    Members reaching penalty 2 or more are moved to the end of the participant list of unconfirmed events.
+    The number of round trips does not depend on the number of members or (embedded) events.
+    Returns the number of members penalized
+    db must be an async database, see get_async_database
+    """
+    member_ids = list(dict.fromkeys(member_ids))
+    if not member_ids:
+        return 0
+
+    # Apply penalty to member db
+    res = await db.members.update_many({"id": {"$in": member_ids}}, {"$inc": {"penalty": 1}})
+    if res.matched_count == 0:
+        return 0
+
+    # penalties are read after the increment, members had at least one penalty before when >= 2
+    cursor = db.members.find({"id": {"$in": member_ids}, "penalty": {"$gte": 2}}, {"id": 1})
+    deprioritized_ids = [m["id"] async for m in cursor]
+
+    now = datetime.now()
+
+    date_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    date = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
+
+    # Apply penalty to the participant entries of all joined events
+    await db.events.update_many(
+        {"date": {"$gt": date}, "participants.id": {"$in": member_ids}},
+        with_version_bump({"$inc": {"participants.$[participant].penalty": 1}}),
+        array_filters=[{"participant.id": {"$in": member_ids}}])
+
+    # Deprioritize on unconfirmed events
+    if deprioritized_ids:
+        await db.events.update_many(
+            {"date": {"$gt": date}, "confirmed": {"$ne": True}, "participants.id": {"$in": deprioritized_ids}},
+            with_version_bump(move_participants_last_update(deprioritized_ids)))
+
+    # Apply penalty to joined events storing participants in the registrations collection
+    cursor = db.registrations.find({"member_id": {"$in": member_ids}}, {"eid": 1, "member_id": 1})
+    joined = [r async for r in cursor]
+    if not joined:
+        return res.matched_count
+
+    cursor = db.events.find({"eid": {"$in": list({r["eid"] for r in joined})}, "date": {"$gt": date}},
+                            {"eid": 1, "confirmed": 1})
+    upcoming = {e["eid"]: e async for e in cursor}
+    if upcoming:
+        await db.registrations.update_many(
+            {"member_id": {"$in": member_ids}, "eid": {"$in": list(upcoming)}},
+            {"$inc": {"penalty": 1}})
+        await db.events.update_many({"eid": {"$in": list(upcoming)}}, with_version_bump({}))
+
+    deprioritized = {}
+    for r in joined:
+        event = upcoming.get(r["eid"])
+        if event and not event.get("confirmed") and r["member_id"] in deprioritized_ids:
+            deprioritized.setdefault(r["eid"], []).append(r["member_id"])
+    await deprioritize_registrations(db, deprioritized)
+
+    return res.matched_count
 
 def get_uuid(id: str):
     try:
@@ -1,11 +1,11 @@
-from fastapi import HTTPException, Request, Response
+from fastapi import Depends, HTTPException, Request, Response
 import os
+import time
 from fastapi.security import HTTPBearer
-from pymongo.database import Database
 from datetime import datetime, timedelta
+from typing import Iterable, Optional
 from jwt import encode, decode, ExpiredSignatureError, DecodeError
-from uuid import uuid4
-from google.oauth2 import service_account
+from uuid import UUID, uuid4
 
 
 from .config import Config
@@ -14,23 +14,13 @@ from .models import MemberDB, RefreshTokenPayload, AccessTokenPayload, Role
 security_scheme = HTTPBearer()
 optional_security = HTTPBearer(auto_error=False)
 
+# lifetime of access tokens created by create_token
+ACCESS_TOKEN_LIFETIME = timedelta(hours=1)
+
 SCOPES = ["https://www.googleapis.com/auth/gmail.compose"]
 KEY_PATH = ".config/mail_credentials.json"
 
 
-def get_google_credentials(impersonate_email: str):
-    """
-    Gets credantials from google used for sending email trough a service acount
-    Paramaters:
-        impersonate_email
-            - Mail for service email to impersonate when sending emails.
-    """
-    credentials = service_account.Credentials.from_service_account_file(
-        KEY_PATH, scopes=SCOPES
-    ).with_subject(impersonate_email)
-    return credentials
-
-
 def authorize_admin(request: Request):
     payload = authorize(request)
 
@@ -58,9 +48,7 @@ def authorize(request: Request):
     if not access_token:
         raise HTTPException(401, "Access token is not present")
 
-    payload = AccessTokenPayload.model_validate(
-        decode_token(access_token, request.app.config)
-    )
+    payload = decode_access_token(request, access_token)
 
     if not payload.access_token:
         raise HTTPException(
@@ -77,13 +65,8 @@ def optional_authentication(request: Request):
     access_token = request.cookies.get("access_token")
     if access_token:
         try:
-            # Don't use decode_token function as it raises an exception which we
-            # do not want on optional authentication
-            payload = AccessTokenPayload.model_validate(
-                decode(
-                    access_token, request.app.config.SECRET_KEY, algorithms=["HS256"]
-                )
-            )
+            # exceptions raised for invalid tokens are ignored on optional authentication
+            payload = decode_access_token(request, access_token)
             return payload.access_token and payload or None
         except:
             return None
@@ -91,6 +74,52 @@ def optional_authentication(request: Request):
     return None
 
 
+def current_member(request: Request, token: AccessTokenPayload = Depends(authorize)) -> Optional[dict]:
+    """
+    Member document of the authenticated user, None if the member does not exist.
+    FastAPI resolves the dependency once per request, and the document is served from the
+    process local member cache when possible
+    """
+    return get_cached_member(request, UUID(token.user_id))
+
+
+def get_cached_member(request: Request, member_id: UUID) -> Optional[dict]:
+    """
+    Member document without password. Documents are cached for MEMBER_CACHE_TTL seconds,
+    writes to members must call invalidate_members
+    """
+    cache = request.app.member_cache
+    member = cache.get(member_id)
+    if member is None:
+        generation = cache.generation
+        member = request.app.db.members.find_one({'id': member_id}, {'_id': 0, 'password': 0})
+        if member is None:
+            return None
+        cache.set(member_id, member, generation)
+    # callers may modify the returned document
+    return dict(member)
+
+
+def invalidate_members(request: Request, member_ids: Iterable[UUID]):
+    """ Removes members from the member cache of this process, call after updating or deleting members """
+    request.app.member_cache.invalidate(list(member_ids))
+
+
+def decode_access_token(request: Request, token: str) -> AccessTokenPayload:
+    """
+    Decodes and validates an access token, raising the same errors as decode_token.
+    Verified payloads are kept in the token cache of the app until the token expires,
+    as the same token is sent on every request during its lifetime. Invalid tokens are never cached
+    """
+    cache = request.app.token_cache
+    payload = cache.get(token)
+    # expired tokens are decoded again to raise the expired error
+    if payload is None or payload.exp <= time.time():
+        payload = AccessTokenPayload.model_validate(decode_token(token, request.app.config))
+        cache.set(token, payload)
+    return payload
+
+
 def role_required(accessToken: AccessTokenPayload, role: Role):
     if accessToken.role != role:
         raise HTTPException(403, "No privileges to access this resource")
@@ -128,7 +157,7 @@ def delete_auth_cookies(response: Response):
 def create_token(user: MemberDB, config: Config):
     payload = {
         # Token lifetime
-        "exp": datetime.utcnow() + timedelta(days=0, hours=1),
+        "exp": datetime.utcnow() + ACCESS_TOKEN_LIFETIME,
         "iat": datetime.utcnow(),
         "user_id": user.id.hex,
         "role": user.role,
@@ -164,18 +193,18 @@ def decode_token(token: str, config: Config) -> dict:
     #    raise HTTPException(401, 'Unknown error')
 
 
-def blacklist_token(refreshToken: RefreshTokenPayload, db: Database):
+def blacklist_token(refreshToken: RefreshTokenPayload, request: Request):
     """
     Blacklists the provided (decoded) refresh token.
     """
-    # Insert token into database
-    db.tokens.insert_one(refreshToken.model_dump())
+    # Insert token into database, other processes read it on their next blacklist refresh
+    request.app.db.tokens.insert_one(refreshToken.model_dump())
+    request.app.token_blacklist.add(refreshToken.jti, refreshToken.exp)
 
 
-def is_blacklisted(refreshToken: RefreshTokenPayload, db: Database):
+def is_blacklisted(refreshToken: RefreshTokenPayload, request: Request):
     """
     Check if the provided (decoded) refresh token is blacklisted.
+    Checked against the blacklisted tokens kept in process, see app/blacklist.py
     """
-    if db.tokens.find_one({"jti": refreshToken.jti}):
-        return True
-    return False
+    return request.app.token_blacklist.contains(refreshToken.jti, request.app.db)
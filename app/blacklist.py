@@ -0,0 +1,80 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from bson import ObjectId
+from pymongo.database import Database
+
+# ids of tokens are created by the api processes, a token inserted late can have an id older than
+# the last refresh, so each refresh reads the tokens inserted shortly before it again
+REFRESH_OVERLAP = timedelta(seconds=30)
+
+
+class TokenBlacklist:
+    """
+    Blacklisted refresh token ids (jti) of the tokens collection, kept in each api process so renewals
+    are checked without a database query. Tokens inserted since the last refresh are read at most every
+    refresh_interval seconds, a token blacklisted by another process is rejected at the latest
+    refresh_interval seconds after it was blacklisted. Tokens blacklisted by this process are added
+    right away. Expired tokens can not be used anyway, they are dropped on refresh.
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        # jti -> exp
+        self._jtis: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        # time of the last refresh and the time the tokens were read from
+        self._refreshed: Optional[float] = None
+        self._since: Optional[datetime] = None
+        self.lookups = 0
+        self.hits = 0
+        self.refreshes = 0
+
+    def add(self, jti: str, exp: int):
+        with self._lock:
+            self._jtis[jti] = exp
+
+    def _refresh(self, db: Database):
+        """ Reads the tokens inserted since the last refresh, one thread at a time reads them """
+        now = time.monotonic()
+        with self._lock:
+            if self._refreshed is not None and now - self._refreshed < self.refresh_interval:
+                return
+            self._refreshed = now
+            since = self._since
+
+        started = datetime.now(timezone.utc)
+        query = {"exp": {"$gt": int(time.time())}}
+        if since is not None:
+            query["_id"] = {"$gte": ObjectId.from_datetime(since - REFRESH_OVERLAP)}
+        try:
+            tokens = list(db.tokens.find(query, {"_id": 0, "jti": 1, "exp": 1}))
+        except Exception:
+            # the next check reads the tokens again instead of trusting the local copy
+            with self._lock:
+                self._refreshed = None
+            raise
+
+        with self._lock:
+            self._since = started
+            self._jtis.update((token["jti"], token["exp"]) for token in tokens)
+            expired = int(time.time())
+            for jti in [jti for jti, exp in self._jtis.items() if exp <= expired]:
+                del self._jtis[jti]
+            self.refreshes += 1
+
+    def contains(self, jti: str, db: Database) -> bool:
+        self._refresh(db)
+        with self._lock:
+            self.lookups += 1
+            if jti in self._jtis:
+                self.hits += 1
+                return True
+            return False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"size": len(self._jtis), "lookups": self.lookups, "hits": self.hits,
+                    "refreshes": self.refreshes, "refresh_interval": self.refresh_interval}
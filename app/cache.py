@@ -0,0 +1,68 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class TTLCache:
+    """
+    In-process TTL/LRU cache, e.g. for serialized responses or member documents.
+    Entries expire after ttl seconds and the least recently used entry is dropped when
+    the cache holds maxsize entries. Each api process has its own cache, writes should call
+    invalidate and the ttl bounds how long other processes can serve stale responses.
+    Safe to use from both the event loop and threadpool handlers.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        # incremented on invalidate, values computed before an invalidation are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                self.misses += 1
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, generation: Optional[int] = None):
+        """ generation should be read before computing value, the value is dropped if the cache was invalidated since """
+        with self._lock:
+            if self.ttl <= 0 or (generation is not None and generation != self.generation):
+                return
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys=None):
+        """ Removes the given keys, or all entries if keys is None """
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+            else:
+                for key in keys:
+                    self._entries.pop(key, None)
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
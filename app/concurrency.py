@@ -0,0 +1,59 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Hashable
+
+# Events carry a version field that is incremented on every write to the event document.
+# Read-modify-write operations read the version with the event and only write if it is unchanged
+# (optimistic concurrency), which holds across multiple api processes. KeyedLock is only used
+# to avoid needless retries between requests handled by the same process.
+VERSION_FIELD = "version"
+
+# attempts of a read-modify-write operation before giving up with 409
+MAX_UPDATE_RETRIES = 3
+
+
+def with_version_bump(update):
+    """ Adds a version increment to an update document or an update pipeline """
+    if isinstance(update, list):
+        # missing version is treated as 0 for events created before the field existed
+        return update + [{"$set": {VERSION_FIELD: {"$add": [{"$ifNull": [f"${VERSION_FIELD}", 0]}, 1]}}}]
+    return {**update, "$inc": {**update.get("$inc", {}), VERSION_FIELD: 1}}
+
+
+def version_filter(event) -> Dict:
+    """
+    Filter matching event only if it has not been written since it was read.
+    A version of None matches events without the field
+    """
+    return {"eid": event["eid"], VERSION_FIELD: event.get(VERSION_FIELD)}
+
+
+class KeyedLock:
+    """
+    asyncio lock per key, e.g. per event. Locks are created on first use and removed
+    when no request holds or waits for them.
+
+    usage:
+        async with event_locks(eid):
+            ...
+    """
+
+    def __init__(self):
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._users: Dict[Hashable, int] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if self._users[key] == 0:
+                del self._users[key]
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
@@ -8,6 +8,52 @@ class Config:
     MONGO_DBNAME: str
     MONGO_URI: str
     FRONTEND_URL: str
+    # use the native async mongo driver for async handlers instead of running pymongo in the threadpool
+    MONGO_ASYNC: bool = os.environ.get('MONGO_ASYNC', '').lower() in ('1', 'true')
+    # where participants of new events are stored, 'embedded' in the event document or in the
+    # 'registrations' collection (see app/registrations.py)
+    PARTICIPANT_STORAGE: str = os.environ.get('PARTICIPANT_STORAGE') or 'embedded'
+    # seconds public event listings are cached in each api process, 0 disables the cache
+    EVENT_CACHE_TTL: float = float(os.environ.get('EVENT_CACHE_TTL') or 30)
+    # max number of cached listings, e.g. pages of past events per role
+    EVENT_CACHE_SIZE: int = int(os.environ.get('EVENT_CACHE_SIZE') or 256)
+    # seconds member documents are cached in each api process, 0 disables the cache
+    MEMBER_CACHE_TTL: float = float(os.environ.get('MEMBER_CACHE_TTL') or 10)
+    MEMBER_CACHE_SIZE: int = int(os.environ.get('MEMBER_CACHE_SIZE') or 1024)
+    # max number of verified access tokens kept, see auth_helpers.decode_access_token
+    TOKEN_CACHE_SIZE: int = int(os.environ.get('TOKEN_CACHE_SIZE') or 4096)
+    # max seconds before a refresh token blacklisted by another api process is rejected, see app/blacklist.py
+    TOKEN_BLACKLIST_REFRESH: float = float(os.environ.get('TOKEN_BLACKLIST_REFRESH') or 5)
+    # werkzeug method for new password hashes, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+    PASSWORD_HASH_METHOD: str = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    # processes hashing passwords, defaults to the number of cores
+    PASSWORD_HASH_WORKERS: int = int(os.environ.get('PASSWORD_HASH_WORKERS') or 0)
+    # queued or running hash operations before requests are rejected with 503
+    PASSWORD_HASH_MAX_PENDING: int = int(os.environ.get('PASSWORD_HASH_MAX_PENDING') or 64)
+    # rendered registration qr pdfs kept in each api process
+    QR_CACHE_SIZE: int = int(os.environ.get('QR_CACHE_SIZE') or 128)
+    QR_CACHE_TTL: float = float(os.environ.get('QR_CACHE_TTL') or 24 * 60 * 60)
+    # uploaded images larger than this are rejected with 413
+    MAX_IMAGE_BYTES: int = int(os.environ.get('MAX_IMAGE_BYTES') or 20 * 1024 * 1024)
+    # processes rendering image variants, defaults to the number of cores
+    IMAGE_WORKERS: int = int(os.environ.get('IMAGE_WORKERS') or 0)
+    # response class encoding content returned by handlers, 'orjson' or 'json' (the FastAPI default)
+    JSON_RESPONSE: str = os.environ.get('JSON_RESPONSE') or 'orjson'
+    # page and unique visits are written in batches of STATS_FLUSH_SIZE or every STATS_FLUSH_INTERVAL seconds,
+    # visits beyond STATS_BUFFER_SIZE buffered visits are dropped, see app/telemetry.py
+    STATS_FLUSH_SIZE: int = int(os.environ.get('STATS_FLUSH_SIZE') or 500)
+    STATS_FLUSH_INTERVAL: float = float(os.environ.get('STATS_FLUSH_INTERVAL') or 5)
+    STATS_BUFFER_SIZE: int = int(os.environ.get('STATS_BUFFER_SIZE') or 10000)
+    # 'gmail' sends through the gmail api, 'stub' keeps sent mails in memory, see app/mailer.py.
+    # Only production sends mails unless MAIL_TRANSPORT is set
+    MAIL_TRANSPORT: str = os.environ.get('MAIL_TRANSPORT') or 'stub'
+    # messages per gmail batch request
+    MAIL_BATCH_SIZE: int = int(os.environ.get('MAIL_BATCH_SIZE') or 50)
+    # retries of messages failing with rate limits or server errors
+    MAIL_MAX_RETRIES: int = int(os.environ.get('MAIL_MAX_RETRIES') or 5)
+    # max seconds a mail sent during a request (POST /api/mail/send-mail) spends on retries,
+    # mails sent through the outbox are retried by the mail worker instead
+    MAIL_REQUEST_DEADLINE: float = float(os.environ.get('MAIL_REQUEST_DEADLINE') or 5)
 
 
 class DevelopmentConfig(Config):
@@ -23,6 +69,7 @@ class DevelopmentConfig(Config):
 class ProductionConfig(Config):
     SECRET_KEY = os.environ.get('SECRET_KEY') or ''
     ENV = 'production'
+    MAIL_TRANSPORT = os.environ.get('MAIL_TRANSPORT') or 'gmail'
     MONGO_HOST = os.environ.get('DB_HOSTNAME') or ''
     MONGO_PORT = int(os.environ.get('DB_PORT') or 27017)
     MONGO_DBNAME = os.environ.get('DB')
@@ -40,6 +87,9 @@ class ProductionConfig(Config):
 class TestConfig(Config):
     SECRET_KEY = "test"
     ENV = 'test'
+    MAIL_TRANSPORT = 'stub'
+    # visits are written by the request adding them
+    STATS_FLUSH_SIZE = 1
     MONGO_HOST = os.environ.get('TEST_DB_HOSTNAME') or '127.0.0.1'
     MONGO_PORT = int(os.environ.get('TEST_DB_PORT') or 27018)
     MONGO_DBNAME = "test"
@@ -1,13 +1,110 @@
+from collections import deque
+from itertools import islice
+from typing import List
 from pymongo.database import Database
 from app.config import config
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from app.indexes import ensure_indexes
 
 
 def get_database(request: Request) -> Database:
     return request.app.db
 
 
+def _next_batch(cursor, size: int) -> List:
+    return list(islice(cursor, size))
+
+
+class ThreadedCursor:
+    """
+    Wraps a blocking pymongo cursor with the async cursor interface,
+    fetching documents in the threadpool, batch_size documents per threadpool call
+    """
+
+    def __init__(self, cursor, batch_size: int = 100):
+        self._cursor = cursor
+        self._batch_size = batch_size
+        self._buffer = deque()
+        self._exhausted = False
+
+    def sort(self, *args, **kwargs):
+        self._cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, *args, **kwargs):
+        self._cursor.skip(*args, **kwargs)
+        return self
+
+    def limit(self, *args, **kwargs):
+        self._cursor.limit(*args, **kwargs)
+        return self
+
+    async def to_list(self, length=None):
+        if length is None:
+            return await run_in_threadpool(list, self._cursor)
+        return await run_in_threadpool(self._cursor.to_list, length)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer and not self._exhausted:
+            batch = await run_in_threadpool(_next_batch, self._cursor, self._batch_size)
+            self._exhausted = len(batch) < self._batch_size
+            self._buffer.extend(batch)
+        if not self._buffer:
+            raise StopAsyncIteration
+        return self._buffer.popleft()
+
+
+class ThreadedCollection:
+    """
+    Exposes a blocking pymongo collection with the same interface as an AsyncCollection.
+    Every operation runs in the threadpool so it only holds a thread for the duration of the query
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        return ThreadedCursor(self._collection.find(*args, **kwargs))
+
+    async def aggregate(self, *args, **kwargs):
+        cursor = await run_in_threadpool(self._collection.aggregate, *args, **kwargs)
+        return ThreadedCursor(cursor)
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+        return call
+
+
+class ThreadedDatabase:
+    def __init__(self, db: Database):
+        self._db = db
+        self.name = db.name
+
+    def __getitem__(self, name):
+        return ThreadedCollection(self._db[name])
+
+    def __getattr__(self, name):
+        return ThreadedCollection(self._db[name])
+
+
+def get_async_database(request: Request):
+    """
+    Database used by async handlers. Uses the native async driver when MONGO_ASYNC is set in config,
+    otherwise the blocking client is wrapped so queries do not block the event loop
+    """
+    if request.app.async_db is not None:
+        return request.app.async_db
+    return ThreadedDatabase(request.app.db)
+
+
 def get_image_path(request: Request) -> str:
     return request.app.image_path
 
@@ -15,10 +112,6 @@ def get_image_path(request: Request) -> str:
 def get_JobImage_path(request: Request) -> str:
     return request.app.jobImage_path
 
-def get_qr_path(request: Request) -> str:
-    return request.app.qr_path
-
-
 def get_export_path(request: Request) -> str:
     return request.app.export_path
 
@@ -34,12 +127,13 @@ def setup_stats_collections(app):
         # create timeseries collection for logging unique users
         app.db.create_collection(page_vists_collection_name, timeseries={"timeField": "timestamp", "metaField": "metaData"})
 
-    # bloom_filter will be removed after 24 hours as its not used after the day is over
-    app.db.uniqueFilter.create_index("createdAt", expireAfterSeconds=24*60*60 )
-
 def setup_db(app):
     app.db = MongoClient(app.config.MONGO_URI, uuidRepresentation="standard")[
         app.config.MONGO_DBNAME]
+    app.async_db = None
+    if app.config.MONGO_ASYNC:
+        app.async_db = AsyncMongoClient(app.config.MONGO_URI, uuidRepresentation="standard")[
+            app.config.MONGO_DBNAME]
     file_storage_path = "db/file_storage"
     app.image_path = f'{file_storage_path}/event_images'
     app.jobImage_path = f'{file_storage_path}/job_images'
@@ -48,9 +142,9 @@ def setup_db(app):
     # setup all collections needed for tracking user activity
     setup_stats_collections(app)
     
-    # Expire reset password codes after 10 minutes
-    app.db.passwordResets.create_index("createdAt", expireAfterSeconds=60 * 10)
-    app.qr_path = f'{file_storage_path}/qr'
+    # builds all indexes in the registry, including ttl indexes for tokens,
+    # reset password codes and daily unique visitors (see app/indexes.py)
+    ensure_indexes(app.db)
     if app.config.MONGO_DBNAME == 'test':
         app.image_path = 'db/test_event_images'
         return
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict
+
+from fastapi import HTTPException, Request
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from .utils.processes import LazyProcessPool
+
+
+def normalize_method(method: str) -> str:
+    """
+    Fills in the werkzeug defaults of a hash method, so methods can be compared,
+    e.g. scrypt -> scrypt:32768:8:1 and pbkdf2 -> pbkdf2:sha256:<default iterations>
+    """
+    name, *args = method.split(":")
+    if name == "scrypt":
+        defaults = ["32768", "8", "1"]
+    elif name == "pbkdf2":
+        defaults = ["sha256", str(DEFAULT_PBKDF2_ITERATIONS)]
+    else:
+        return method
+    return ":".join([name, *args, *defaults[len(args):]])
+
+
+def method_of(pwhash: str) -> str:
+    """ Normalized method a werkzeug hash ("method$salt$hash") was created with """
+    return normalize_method(pwhash.split("$", 1)[0])
+
+
+def needs_rehash(pwhash: str, target_method: str) -> bool:
+    return method_of(pwhash) != normalize_method(target_method)
+
+
+class PasswordHasher:
+    """
+    Runs werkzeug password hashing in a dedicated process pool, keeping the cpu heavy
+    scrypt/pbkdf2 calls off the event loop, the request threadpool and the GIL.
+
+    At most max_pending hash operations are queued or running, further requests are rejected
+    with 503 so a burst of logins does not build up an unbounded queue of work.
+
+    async handlers await hash/verify, sync handlers call hash_sync/verify_sync which only block
+    their own threadpool thread while waiting for the pool.
+    """
+
+    def __init__(self, method: str, workers: int, max_pending: int):
+        # werkzeug method string used for new hashes, e.g. scrypt:32768:8:1 or pbkdf2:sha256:600000
+        self.method = method
+        self.pool = LazyProcessPool(workers)
+        self.workers = self.pool.workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        # total seconds from submit to result, for the average latency
+        self._total_seconds = 0.0
+
+    def _submit(self, fn, *args) -> Future:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(503, "Server is busy, please try again", headers={"Retry-After": "1"})
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+
+        submitted = time.monotonic()
+
+        def done(_):
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self._total_seconds += time.monotonic() - submitted
+
+        try:
+            future = self.pool.submit(fn, *args)
+        except BaseException:
+            done(None)
+            raise
+        future.add_done_callback(done)
+        return future
+
+    async def hash(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(generate_password_hash, password, self.method))
+
+    async def verify(self, pwhash: str, password: str) -> bool:
+        return await asyncio.wrap_future(self._submit(check_password_hash, pwhash, password))
+
+    def hash_sync(self, password: str) -> str:
+        return self._submit(generate_password_hash, password, self.method).result()
+
+    def verify_sync(self, pwhash: str, password: str) -> bool:
+        return self._submit(check_password_hash, pwhash, password).result()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "method": self.method,
+                "pending": self.pending,
+                "peak_pending": self.peak_pending,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_seconds": self._total_seconds / self.completed if self.completed else 0,
+            }
+
+
+def get_password_hasher(request: Request) -> PasswordHasher:
+    return request.app.password_hasher
@@ -0,0 +1,268 @@
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .utils.etag import is_not_modified, not_modified_response
+from .utils.processes import LazyProcessPool
+
+# Uploaded images are decoded, validated and re-encoded without metadata into a variant per size
+# and format. Variants are stored content addressed, {path}/{key}/{digest}/{size}.{format}, and
+# {path}/{key}.json points to the current digest, so a new upload never changes the files of the
+# previous one and responses can carry the digest as a strong etag.
+
+# max width and height of each size, images are never upscaled
+SIZES = {"small": 320, "medium": 800, "large": 1600}
+MEDIA_TYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+# modern formats in order of preference, jpeg (png for images with transparency) is the fallback
+MODERN_FORMATS = [f for f in ("avif", "webp") if features.check(f)]
+SAVE_OPTIONS = {
+    "avif": {"quality": 55, "speed": 8},
+    "webp": {"quality": 80, "method": 4},
+    "jpeg": {"quality": 85, "optimize": True, "progressive": True},
+    "png": {"optimize": True},
+}
+
+# variants are immutable when requested with their digest (?v=), otherwise clients revalidate them
+# with the etag on every use, so a new upload is shown right away
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+CACHE_CONTROL = "public, no-cache"
+
+
+class InvalidImageError(Exception):
+    """ The upload could not be decoded as an image """
+
+
+def render_variants(data: bytes) -> Dict:
+    """
+    Decodes an image and encodes every size and format variant. Runs in the image process pool.
+    Returns the digest of the upload, the fallback format, the original dimensions and the variants
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as upload:
+            upload.load()
+            # applies the exif orientation, the exif data itself is not copied to the variants
+            image = ImageOps.exif_transpose(upload)
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError, SyntaxError, ValueError):
+        raise InvalidImageError()
+
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+    fallback = "png" if has_alpha else "jpeg"
+
+    variants = {}
+    for size, max_side in SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((max_side, max_side), Image.LANCZOS)
+        for image_format in MODERN_FORMATS + [fallback]:
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format.upper(), **SAVE_OPTIONS[image_format])
+            variants[f"{size}.{image_format}"] = buffer.getvalue()
+
+    return {
+        "digest": hashlib.sha256(data).hexdigest()[:32],
+        "fallback": fallback,
+        "width": image.width,
+        "height": image.height,
+        "variants": variants,
+    }
+
+
+class ImageProcessor:
+    """
+    Process pool rendering image variants, keeping the decoding and encoding
+    off the request threads and the GIL
+    """
+
+    def __init__(self, workers: int):
+        self.pool = LazyProcessPool(workers)
+        self.workers = self.pool.workers
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.rejected = 0
+
+    def process_sync(self, data: bytes) -> Dict:
+        try:
+            rendered = self.pool.submit(render_variants, data).result()
+        except InvalidImageError:
+            with self._lock:
+                self.rejected += 1
+            raise
+        with self._lock:
+            self.processed += 1
+        return rendered
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"workers": self.workers, "processed": self.processed, "rejected": self.rejected,
+                    "formats": MODERN_FORMATS}
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+class ImageStore:
+    """ Image variants of a directory, e.g. the event images, by key (event or job id) """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _manifest_path(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.json")
+
+    def legacy_path(self, key: str) -> str:
+        """ Original upload stored before variants existed, also where seeded images are copied """
+        return os.path.join(self.path, f"{key}.png")
+
+    def manifest(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self._manifest_path(key)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def variant_path(self, key: str, manifest: Dict, size: str, image_format: str) -> str:
+        return os.path.join(self.path, key, manifest["digest"], f"{size}.{image_format}")
+
+    @contextmanager
+    def _locked(self, key: str):
+        """
+        Exclusive lock of key across threads and api processes. flock locks belong to the open file,
+        so every caller opens the lock file itself
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, f"{key}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self, key: str, rendered: Dict) -> Dict:
+        """
+        Writes the variants, then points the manifest at them and removes older digests.
+        Saves of the same key are serialized, so a save never removes the digest another save
+        just pointed the manifest at
+        """
+        with self._locked(key):
+            return self._save(key, rendered)
+
+    def _save(self, key: str, rendered: Dict) -> Dict:
+        digest_dir = os.path.join(self.path, key, rendered["digest"])
+        os.makedirs(digest_dir, exist_ok=True)
+        for name, data in rendered["variants"].items():
+            _write_atomic(os.path.join(digest_dir, name), data)
+
+        manifest = {
+            "digest": rendered["digest"],
+            "fallback": rendered["fallback"],
+            "formats": MODERN_FORMATS + [rendered["fallback"]],
+            "width": rendered["width"],
+            "height": rendered["height"],
+        }
+        _write_atomic(self._manifest_path(key), json.dumps(manifest).encode())
+
+        for digest in os.listdir(os.path.join(self.path, key)):
+            if digest != rendered["digest"]:
+                shutil.rmtree(os.path.join(self.path, key, digest), ignore_errors=True)
+        return manifest
+
+
+def accepted_types(accept: str) -> Dict[str, float]:
+    """ Quality of each media range of an Accept header, e.g. {"image/webp": 1.0, "*/*": 0.8} """
+    qualities = {}
+    for media_range in accept.split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            qualities[media_type.lower()] = quality
+    return qualities
+
+
+def negotiate_format(request: Request, manifest: Dict, requested: Optional[str]) -> str:
+    """
+    Requested format if available, otherwise the modern format the client accepts with the highest
+    quality (in order of preference on ties). Modern formats must be listed explicitly, wildcards
+    only get the fallback format
+    """
+    formats = manifest["formats"]
+    if requested in formats:
+        return requested
+    qualities = accepted_types(request.headers.get("accept", ""))
+    best, best_quality = manifest["fallback"], 0.0
+    for image_format in formats:
+        quality = qualities.get(MEDIA_TYPES[image_format], 0.0)
+        if image_format != manifest["fallback"] and quality > best_quality:
+            best, best_quality = image_format, quality
+    return best
+
+
+def upload_image(request: Request, store: ImageStore, key: str, file: BinaryIO) -> Dict:
+    """ Validates and processes an uploaded file, raises 400 for files that are not images """
+    # reads at most one byte more than allowed, larger uploads are not read into memory
+    max_bytes = request.app.config.MAX_IMAGE_BYTES
+    data = file.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise HTTPException(413, "Image is too large")
+    try:
+        rendered = request.app.image_processor.process_sync(data)
+    except InvalidImageError:
+        raise HTTPException(400, "Unsupported file type")
+    os.makedirs(store.path, exist_ok=True)
+    return store.save(key, rendered)
+
+
+def image_response(request: Request, store: ImageStore, key: str, size: str,
+                   requested_format: Optional[str], version: Optional[str]) -> Response:
+    manifest = store.manifest(key)
+    if manifest is None:
+        # images uploaded before variants existed are processed on their first request
+        if not os.path.exists(store.legacy_path(key)):
+            raise HTTPException(404, "picture not found")
+        with open(store.legacy_path(key), "rb") as file:
+            data = file.read()
+        try:
+            manifest = store.save(key, request.app.image_processor.process_sync(data))
+        except InvalidImageError:
+            # served as uploaded, like before variants existed
+            return FileResponse(store.legacy_path(key))
+
+    image_format = negotiate_format(request, manifest, requested_format)
+    etag = f'"{manifest["digest"]}-{size}-{image_format}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if version == manifest["digest"] else CACHE_CONTROL,
+        # the digest of the current image, clients can request ?v=<digest> to cache it as immutable
+        "X-Image-Version": manifest["digest"],
+    }
+    if requested_format is None:
+        headers["Vary"] = "Accept"
+
+    if is_not_modified(request, etag):
+        return not_modified_response(etag, headers)
+    return FileResponse(store.variant_path(key, manifest, size, image_format),
+                        media_type=MEDIA_TYPES[image_format], headers=headers)
@@ -0,0 +1,130 @@
+import logging
+from typing import Dict, List, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+# Declarative registry of every index the api relies on, grouped by collection.
+# Each entry is (keys, options) and maps directly to pymongo's IndexModel.
+# Index names are left to mongo's default "<field>_<direction>" scheme so
+# indexes created before the registry existed are recognised as the same index.
+INDEXES: Dict[str, List[Tuple[List[Tuple[str, int]], dict]]] = {
+    "members": [
+        # looked up on nearly every authenticated route
+        ([("id", ASCENDING)], {"unique": True}),
+        # login, signup and password reset
+        ([("email", ASCENDING)], {"unique": True}),
+    ],
+    "events": [
+        # get_event_or_404
+        ([("eid", ASCENDING)], {"unique": True}),
+        # /upcoming, /past-events and /past-events/count for regular members,
+        # eid is part of the keyset pagination order of past events
+        ([("public", ASCENDING), ("date", DESCENDING), ("eid", DESCENDING)], {}),
+        # same listings for admins, which do not filter on public
+        ([("date", DESCENDING), ("eid", DESCENDING)], {}),
+        # /joined-events and penalize
+        ([("participants.id", ASCENDING)], {}),
+        # attendance registration through qr code
+        ([("register_id", ASCENDING)], {"sparse": True}),
+    ],
+    "registrations": [
+        # participant list of an event in order
+        ([("eid", ASCENDING), ("position", ASCENDING)], {}),
+        # joined check, ensures a member only joins an event once
+        ([("member_id", ASCENDING), ("eid", ASCENDING)], {"unique": True}),
+    ],
+    "tokens": [
+        # blacklisted refresh tokens
+        ([("jti", ASCENDING)], {}),
+        # tokens expire at "exp"
+        ([("exp", ASCENDING)], {"expireAfterSeconds": 0}),
+    ],
+    "confirmations": [
+        ([("confirmationCode", ASCENDING)], {}),
+        ([("user_id", ASCENDING)], {}),
+    ],
+    "passwordResets": [
+        ([("code", ASCENDING)], {}),
+        ([("user_id", ASCENDING)], {}),
+        # expire reset password codes after 10 minutes
+        ([("createdAt", ASCENDING)], {"expireAfterSeconds": 60 * 10}),
+    ],
+    "uniqueVisitors": [
+        # one document per visitor and day, the upsert in telemetry.register_unique_visits relies on it
+        ([("day", ASCENDING), ("visitor", ASCENDING)], {"unique": True}),
+        # visitors are only looked up for the current day
+        ([("createdAt", ASCENDING)], {"expireAfterSeconds": 24 * 60 * 60}),
+    ],
+    "jobs": [
+        ([("id", ASCENDING)], {"unique": True}),
+    ],
+    "kioskSuggestions": [
+        ([("id", ASCENDING)], {"unique": True}),
+    ],
+    "outbox": [
+        # claim_batch, mails that are due or whose claim expired
+        ([("status", ASCENDING), ("nextAttemptAt", ASCENDING)], {}),
+        ([("claim", ASCENDING)], {"sparse": True}),
+        # idempotent enqueue, mails without a key are never duplicates
+        ([("key", ASCENDING)], {"unique": True, "partialFilterExpression": {"key": {"$exists": True}}}),
+        # sent mails are kept for 30 days
+        ([("sentAt", ASCENDING)], {"expireAfterSeconds": 30 * 24 * 60 * 60}),
+    ],
+}
+
+
+def index_name(keys: List[Tuple[str, int]]) -> str:
+    """ Default name mongo gives an index on keys, e.g. public_1_date_-1 """
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def ensure_indexes(db: Database, registry=INDEXES):
+    """
+    Creates all indexes in the registry. Creating an index that already exists with
+    the same options is a no-op, so this is safe to run on every startup.
+    Failures (e.g. duplicates preventing a unique index) are logged and do not stop
+    the remaining indexes from being built.
+    """
+    for collection, specs in registry.items():
+        models = [IndexModel(keys, **options) for keys, options in specs]
+        try:
+            db[collection].create_indexes(models)
+        except OperationFailure:
+            # retry one by one to find out which index failed
+            for keys, options in specs:
+                try:
+                    db[collection].create_index(keys, **options)
+                except OperationFailure as e:
+                    logging.error(
+                        f"could not create index {index_name(keys)} on {collection}: {e}")
+
+
+def index_report(db: Database, registry=INDEXES):
+    """
+    Compares the indexes present in the database with the registry.
+    Returns a dict per collection with:
+        missing: indexes in the registry not present in the database
+        unused: indexes never used since the server started (from $indexStats)
+        unregistered: indexes present in the database, but not in the registry
+        usage: number of operations that used each index
+    """
+    report = {}
+    existing_collections = db.list_collection_names()
+    for collection, specs in registry.items():
+        expected = [index_name(keys) for keys, _ in specs]
+        usage = {}
+        if collection in existing_collections:
+            stats = db[collection].aggregate([{"$indexStats": {}}])
+            usage = {s["name"]: s["accesses"]["ops"] for s in stats}
+        # _id index is always present
+        usage.pop("_id_", None)
+
+        report[collection] = {
+            "missing": [name for name in expected if name not in usage],
+            "unused": [name for name, ops in usage.items() if ops == 0],
+            "unregistered": [name for name in usage if name not in expected],
+            "usage": usage,
+        }
+    return report
@@ -0,0 +1,107 @@
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Union
+
+from fastapi import Request
+
+# placeholders are written as $NAME$ in the templates in app/assets/mails
+PLACEHOLDER = re.compile(r"\$([A-Z_]+)\$")
+MAIL_TEMPLATE_PATH = "./app/assets/mails"
+
+
+class Placeholder(str):
+    """ Name of a placeholder in the parts of a compiled template """
+
+
+class MailTemplate:
+    """
+    Template compiled into literal parts and placeholders, rendered by a single join.
+
+    usage:
+        template.render(LINK=link)
+        # values shared by all recipients are substituted once
+        event_template = template.partial(EVENT_NAME=title, ...)
+        contents = [event_template.render(NAME=name) for name in names]
+    """
+
+    def __init__(self, parts: List[Union[str, Placeholder]]):
+        self.parts = parts
+        self.placeholders = {part for part in parts if isinstance(part, Placeholder)}
+
+    @classmethod
+    def compile(cls, text: str) -> "MailTemplate":
+        parts = []
+        # split alternates literal text and placeholder names
+        for i, part in enumerate(PLACEHOLDER.split(text)):
+            if i % 2:
+                parts.append(Placeholder(part))
+            elif part:
+                parts.append(part)
+        return cls(parts)
+
+    def partial(self, **values) -> "MailTemplate":
+        """ Template with the given placeholders substituted, adjacent literals are merged """
+        parts = []
+        for part in self.parts:
+            if isinstance(part, Placeholder) and part in values:
+                part = str(values[part])
+            if parts and not isinstance(part, Placeholder) and not isinstance(parts[-1], Placeholder):
+                parts[-1] += part
+            else:
+                parts.append(part)
+        return MailTemplate(parts)
+
+    def render(self, **values) -> str:
+        """ Raises KeyError if a placeholder has no value """
+        return "".join(str(values[part]) if isinstance(part, Placeholder) else part for part in self.parts)
+
+    def render_many(self, recipients: Iterable[Dict], **common) -> List[str]:
+        """ Renders the template for each recipient's values, common values are only substituted once """
+        template = self.partial(**common)
+        return [template.render(**values) for values in recipients]
+
+
+class MailTemplates:
+    """
+    Compiled templates of a directory, by file name without extension, e.g. "event_confirmation".
+    Templates are loaded once, with reload set (in development) a changed file is compiled again.
+    """
+
+    def __init__(self, path: str = MAIL_TEMPLATE_PATH, reload: bool = False):
+        self.path = path
+        self.reload = reload
+        self._templates: Dict[str, MailTemplate] = {}
+        self._mtimes: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        for filename in os.listdir(path):
+            name, extension = os.path.splitext(filename)
+            if extension == ".txt":
+                self._load(name)
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.txt")
+
+    def _load(self, name: str):
+        with open(self._file(name), 'r') as template_file:
+            mtime = os.fstat(template_file.fileno()).st_mtime
+            template = MailTemplate.compile(template_file.read())
+        with self._lock:
+            self._templates[name] = template
+            self._mtimes[name] = mtime
+
+    def get(self, name: str) -> MailTemplate:
+        """ Raises FileNotFoundError for unknown templates """
+        if self.reload and (name not in self._mtimes or os.path.getmtime(self._file(name)) != self._mtimes[name]):
+            self._load(name)
+        try:
+            return self._templates[name]
+        except KeyError:
+            raise FileNotFoundError(self._file(name))
+
+    def render(self, name: str, **values) -> str:
+        return self.get(name).render(**values)
+
+
+def get_mail_templates(request: Request) -> MailTemplates:
+    return request.app.mail_templates
@@ -0,0 +1,228 @@
+import base64
+import random
+import threading
+import time
+from dataclasses import dataclass
+from email.message import EmailMessage
+from typing import Callable, Dict, List, Optional
+
+from fastapi import Request
+from google.auth.exceptions import RefreshError
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+
+from .auth_helpers import KEY_PATH, SCOPES
+from .models import MailPayload
+
+# http statuses of messages that are sent again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# 403 reasons gmail uses for rate limits
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+@dataclass
+class SendResult:
+    """ Result of sending one message, status is the http status of the failed send """
+    to: List[str]
+    ok: bool
+    status: Optional[int] = None
+    error: Optional[str] = None
+    retry_after: Optional[float] = None
+
+    @property
+    def retryable(self) -> bool:
+        return not self.ok and self.status in RETRY_STATUSES
+
+
+class InvalidSenderError(Exception):
+    """ The sender address can not be impersonated by the service account """
+
+
+def build_message(payload: MailPayload) -> EmailMessage:
+    message = EmailMessage()
+    message['Subject'] = payload.subject
+    message.set_content(payload.content)
+    message['To'] = ", ".join(payload.to)
+    message['From'] = payload.sent_by
+    return message
+
+
+class GmailTransport:
+    """
+    Sends messages through the gmail api with a service account impersonating the sender.
+    The service account key is read once, credentials and the built service are cached per sender,
+    and the messages of a call are sent as gmail batch requests of up to batch_size messages.
+    """
+
+    def __init__(self, key_path: str, scopes: List[str]):
+        self.key_path = key_path
+        self.scopes = scopes
+        self._base_credentials = None
+        self._services: Dict[str, object] = {}
+        # the http client of a service is not thread safe, batches of a sender are sent one at a time
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def _service(self, sender: str):
+        with self._lock:
+            if sender not in self._services:
+                if self._base_credentials is None:
+                    self._base_credentials = service_account.Credentials.from_service_account_file(
+                        self.key_path, scopes=self.scopes)
+                credentials = self._base_credentials.with_subject(sender)
+                # discovery document shipped with the client, nothing is fetched
+                self._services[sender] = build(
+                    'gmail', 'v1', credentials=credentials, static_discovery=True, cache_discovery=False)
+                self._locks[sender] = threading.Lock()
+            return self._services[sender], self._locks[sender]
+
+    def send_batch(self, sender: str, messages: List[EmailMessage]) -> List[SendResult]:
+        service, lock = self._service(sender)
+        results: List[Optional[SendResult]] = [None] * len(messages)
+
+        def callback(request_id, response, exception):
+            i = int(request_id)
+            to = messages[i].get_all('To', [])
+            if exception is None:
+                results[i] = SendResult(to, True)
+            elif isinstance(exception, HttpError):
+                status = exception.status_code
+                reasons = {detail.get("reason") for detail in exception.error_details or []
+                           if isinstance(detail, dict)}
+                if status == 403 and reasons & RATE_LIMIT_REASONS:
+                    status = 429
+                retry_after = exception.resp.get("retry-after")
+                results[i] = SendResult(to, False, status, str(exception),
+                                        float(retry_after) if retry_after and retry_after.isdigit() else None)
+            else:
+                results[i] = SendResult(to, False, None, str(exception))
+
+        # pylint: disable=E1101
+        batch = service.new_batch_http_request(callback=callback)
+        for i, message in enumerate(messages):
+            raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+            batch.add(service.users().messages().send(userId="me", body={'raw': raw}), request_id=str(i))
+        try:
+            with lock:
+                batch.execute()
+        except RefreshError:
+            raise InvalidSenderError(sender)
+        except HttpError as error:
+            # the batch request itself failed, every message in it can be sent again
+            return [SendResult(message.get_all('To', []), False, error.status_code, str(error))
+                    for message in messages]
+        return results
+
+
+class StubTransport:
+    """
+    Transport keeping sent messages in memory, for tests and local development.
+    failures maps a recipient to the http statuses its next sends fail with, e.g. {"a@b.no": [429]}
+    """
+
+    def __init__(self):
+        self.sent: List[EmailMessage] = []
+        self.batches = 0
+        self.failures: Dict[str, List[int]] = {}
+
+    def send_batch(self, sender: str, messages: List[EmailMessage]) -> List[SendResult]:
+        self.batches += 1
+        results = []
+        for message in messages:
+            to = message.get_all('To', [])
+            statuses = self.failures.get(to[0] if to else "")
+            if statuses:
+                results.append(SendResult(to, False, statuses.pop(0), "stub failure"))
+            else:
+                self.sent.append(message)
+                results.append(SendResult(to, True))
+        return results
+
+
+class Mailer:
+    """
+    Sends mails in batches through a transport, retrying messages failing with rate limits or
+    server errors with exponential backoff (or the returned Retry-After) and jitter.
+    With a deadline, retries stop when waiting for the next one would exceed deadline seconds
+    since the send started, so mails sent during a request do not hold its thread for long.
+    """
+
+    def __init__(self, transport, batch_size: int = 50, max_retries: int = 5, backoff: float = 1,
+                 max_backoff: float = 32, sleep: Callable[[float], None] = time.sleep,
+                 deadline: Optional[float] = None):
+        self.transport = transport
+        # gmail recommends at most 50 requests per batch
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._sleep = sleep
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+
+    def _delay(self, attempt: int, results: List[SendResult]) -> float:
+        retry_after = max((r.retry_after or 0 for r in results), default=0)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return max(retry_after, delay * random.uniform(0.5, 1))
+
+    def send(self, payloads: List[MailPayload]) -> List[SendResult]:
+        """
+        Sends the payloads, results are in the order of the payloads.
+        Raises InvalidSenderError if a sender can not be used
+        """
+        results: List[Optional[SendResult]] = [None] * len(payloads)
+        started = time.monotonic()
+        by_sender: Dict[str, List[int]] = {}
+        for i, payload in enumerate(payloads):
+            by_sender.setdefault(payload.sent_by, []).append(i)
+
+        for sender, indices in by_sender.items():
+            for start in range(0, len(indices), self.batch_size):
+                pending = indices[start:start + self.batch_size]
+                for attempt in range(self.max_retries + 1):
+                    batch_results = self.transport.send_batch(sender, [build_message(payloads[i]) for i in pending])
+                    for i, result in zip(pending, batch_results):
+                        results[i] = result
+                    failed = [r for r in batch_results if r.retryable]
+                    pending = [i for i, r in zip(pending, batch_results) if r.retryable]
+                    if not pending or attempt == self.max_retries:
+                        break
+                    delay = self._delay(attempt, failed)
+                    if self.deadline is not None and time.monotonic() - started + delay > self.deadline:
+                        break
+                    with self._lock:
+                        self.retries += len(pending)
+                    self._sleep(delay)
+
+        with self._lock:
+            self.sent += sum(r.ok for r in results)
+            self.failed += sum(not r.ok for r in results)
+        return results
+
+    def send_one(self, payload: MailPayload) -> SendResult:
+        return self.send([payload])[0]
+
+    def stats(self) -> Dict:
+        return {
+            "batch_size": self.batch_size,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+        }
+
+
+def create_mailer(config, max_retries: Optional[int] = None, deadline: Optional[float] = None) -> Mailer:
+    if config.MAIL_TRANSPORT == "stub":
+        transport = StubTransport()
+    else:
+        transport = GmailTransport(KEY_PATH, SCOPES)
+    return Mailer(transport, config.MAIL_BATCH_SIZE,
+                  config.MAIL_MAX_RETRIES if max_retries is None else max_retries, deadline=deadline)
+
+
+def get_mailer(request: Request) -> Mailer:
+    return request.app.mailer
@@ -210,7 +210,31 @@ class EventMailMessage(BaseModel):
     confirmedOnly: Optional[bool] = False
 
 
-class EventDB(Event):
+class EventHeader(Event):
+    """ Event fields without participants """
+    # 'registrations' when participants are stored in the registrations collection
+    participantStorage: Optional[str] = None
+    # incremented on every write to the event, None for events created before versioning
+    version: Optional[int] = None
+
+
+class ParticipantCounts(BaseModel):
+    participants: int = 0
+    confirmed: int = 0
+    # participants with penalty > 1
+    deprioritized: int = 0
+
+
+class EventWithCounts(EventHeader):
+    participantCounts: ParticipantCounts
+
+
+class EventDB(EventHeader):
+    participants: List[Participant]
+
+
+class EventAdminView(Event):
+    """ Event with participants as returned to admins, without the internal storage and version fields """
     participants: List[Participant]
 
 
@@ -285,13 +309,6 @@ class JobItem(JobItemPayload):
     id: UUID4
 
 
-class UniqueVisitsStructure(BaseModel):
-    entry_date: date
-    # bloom filter object
-    bloom_filter: bytes
-    timestamps: List[date]
-
-
 class PageVisitsStructure(BaseModel):
     # tracks
     url_dict: Dict[str, int]
@@ -0,0 +1,157 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+from .mailer import InvalidSenderError, Mailer, SendResult
+from .models import MailPayload
+
+# Mails are not sent by the api processes. Handlers insert one outbox document per recipient and
+# the mail worker (worker.py) claims pending documents in batches, sends them and records the result
+# on each document. Delivery is at least once: a worker dying between sending and recording leaves
+# the claim to expire after CLAIM_LEASE, after which another worker sends the mail again.
+#
+# status: pending -> sending -> sent
+#                            -> pending (retryable failure, retried at nextAttemptAt)
+#                            -> failed (permanent failure or MAX_ATTEMPTS reached)
+PENDING, SENDING, SENT, FAILED = "pending", "sending", "sent", "failed"
+
+# a claimed mail not recorded as sent or failed within the lease is claimed again
+CLAIM_LEASE = timedelta(minutes=5)
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = timedelta(seconds=30)
+
+DUPLICATE_KEY_ERROR = 11000
+
+log = logging.getLogger(__name__)
+
+
+def outbox_documents(payloads: List[MailPayload], keys: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Outbox documents of the payloads. A key makes the enqueue idempotent,
+    a mail with a key that is already in the outbox is not added again
+    """
+    now = datetime.utcnow()
+    documents = []
+    for i, payload in enumerate(payloads):
+        document = {
+            **payload.model_dump(),
+            "status": PENDING,
+            "attempts": 0,
+            "createdAt": now,
+            "nextAttemptAt": now,
+        }
+        if keys:
+            document["key"] = keys[i]
+        documents.append(document)
+    return documents
+
+
+def _raise_unless_duplicates(error: BulkWriteError):
+    if any(e["code"] != DUPLICATE_KEY_ERROR for e in error.details.get("writeErrors", [])):
+        raise error
+
+
+def enqueue_mails(db: Database, payloads: List[MailPayload], keys: Optional[List[str]] = None):
+    if not payloads:
+        return
+    try:
+        db.outbox.insert_many(outbox_documents(payloads, keys), ordered=False)
+    except BulkWriteError as error:
+        _raise_unless_duplicates(error)
+
+
+async def enqueue_mails_async(db, payloads: List[MailPayload], keys: Optional[List[str]] = None):
+    """ enqueue_mails for the database of async handlers, see db.get_async_database """
+    if not payloads:
+        return
+    try:
+        await db.outbox.insert_many(outbox_documents(payloads, keys), ordered=False)
+    except BulkWriteError as error:
+        _raise_unless_duplicates(error)
+
+
+def claim_batch(db: Database, worker_id: str, limit: int) -> List[Dict]:
+    """
+    Claims up to limit mails that are due, or whose claim has expired.
+    The update re-checks the filter per document, so concurrent workers never claim the same mail
+    """
+    now = datetime.utcnow()
+    claimable = {"$or": [
+        {"status": PENDING, "nextAttemptAt": {"$lte": now}},
+        {"status": SENDING, "claimedAt": {"$lt": now - CLAIM_LEASE}},
+    ]}
+    ids = [d["_id"] for d in db.outbox.find(claimable, {"_id": 1}).sort("nextAttemptAt", 1).limit(limit)]
+    if not ids:
+        return []
+
+    claim = f"{worker_id}:{uuid4().hex}"
+    db.outbox.update_many(
+        {"_id": {"$in": ids}, **claimable},
+        {"$set": {"status": SENDING, "claim": claim, "claimedAt": now}, "$inc": {"attempts": 1}},
+    )
+    return list(db.outbox.find({"claim": claim}))
+
+
+def result_update(document: Dict, result: SendResult, now: datetime) -> Dict:
+    if result.ok:
+        return {"$set": {"status": SENT, "sentAt": now, "error": None}, "$unset": {"claim": ""}}
+    if result.retryable and document["attempts"] < MAX_ATTEMPTS:
+        delay = RETRY_BACKOFF * 2 ** (document["attempts"] - 1)
+        if result.retry_after:
+            delay = max(delay, timedelta(seconds=result.retry_after))
+        return {"$set": {"status": PENDING, "nextAttemptAt": now + delay, "error": result.error},
+                "$unset": {"claim": ""}}
+    return {"$set": {"status": FAILED, "error": result.error}, "$unset": {"claim": ""}}
+
+
+def send_claimed(db: Database, mailer: Mailer, documents: List[Dict]) -> Dict[str, int]:
+    """ Sends claimed mails and records the result of each, returns the number of mails per new status """
+    by_sender: Dict[str, List[Dict]] = {}
+    for document in documents:
+        by_sender.setdefault(document["sent_by"], []).append(document)
+
+    updates = []
+    counts = {SENT: 0, PENDING: 0, FAILED: 0}
+    for sender, sender_documents in by_sender.items():
+        payloads = [MailPayload(to=d["to"], subject=d["subject"], content=d["content"], sent_by=d["sent_by"])
+                    for d in sender_documents]
+        try:
+            results = mailer.send(payloads)
+        except InvalidSenderError:
+            results = [SendResult(p.to, False, 400, f"Invalid sender {sender}") for p in payloads]
+        except Exception as error:
+            # e.g. missing credentials or network errors, retried like a server error
+            log.exception("Sending mails from %s failed", sender)
+            results = [SendResult(p.to, False, 503, str(error)) for p in payloads]
+
+        now = datetime.utcnow()
+        for document, result in zip(sender_documents, results):
+            update = result_update(document, result, now)
+            counts[update["$set"]["status"]] += 1
+            # only recorded if the claim was not taken over by another worker in the meantime
+            updates.append(UpdateOne({"_id": document["_id"], "claim": document["claim"]}, update))
+
+    if updates:
+        db.outbox.bulk_write(updates, ordered=False)
+    return counts
+
+
+def process_batch(db: Database, mailer: Mailer, worker_id: str, limit: int) -> int:
+    """ Claims, sends and records one batch, returns the number of claimed mails """
+    documents = claim_batch(db, worker_id, limit)
+    if documents:
+        counts = send_claimed(db, mailer, documents)
+        log.info("Processed %d mails: %s", len(documents), counts)
+    return len(documents)
+
+
+def outbox_stats(db: Database) -> Dict:
+    counts = {status: 0 for status in (PENDING, SENDING, SENT, FAILED)}
+    for row in db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+        counts[row["_id"]] = row["count"]
+    return counts
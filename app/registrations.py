@@ -0,0 +1,297 @@
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .concurrency import version_filter, with_version_bump
+from .config import Config
+from .utils.event_utils import insert_participant_update
+
+# Participants are either embedded in the event document (participants array) or stored as one
+# document per participant in the registrations collection. The storage is decided per event by
+# the participantStorage field, which lets old embedded events be read while new events use the
+# collection. Config.PARTICIPANT_STORAGE decides the storage of new events.
+EMBEDDED = "embedded"
+REGISTRATIONS = "registrations"
+
+# positions of deprioritized participants are offset so they are always sorted behind
+# participants joining later, the same way they are kept at the end of the embedded list
+DEPRIORITIZED_OFFSET = 1 << 32
+
+# result of insert_participant
+JOINED = "joined"
+ALREADY_JOINED = "already_joined"
+NO_MATCH = "no_match"
+
+
+def uses_registrations(event) -> bool:
+    return event.get("participantStorage") == REGISTRATIONS
+
+
+def storage_of(event) -> str:
+    return REGISTRATIONS if uses_registrations(event) else EMBEDDED
+
+
+def storage_fields(config: Config) -> Dict:
+    """ Fields added to new events to select participant storage """
+    if config.PARTICIPANT_STORAGE == REGISTRATIONS:
+        return {"participants": [], "participantStorage": REGISTRATIONS, "registrationSeq": 0}
+    return {"participants": [], "participantStorage": EMBEDDED}
+
+
+def registration_position(position: int, penalty: int) -> int:
+    """ Position of a participant at index position in the participant list """
+    if penalty > 1:
+        return DEPRIORITIZED_OFFSET + position
+    return position
+
+
+def to_registration(eid: UUID, participant: Dict, position: int) -> Dict:
+    registration = {k: v for k, v in participant.items() if k != "id"}
+    registration.update({
+        "eid": eid,
+        "member_id": participant["id"],
+        "position": position,
+    })
+    return registration
+
+
+def to_participant(registration: Dict) -> Dict:
+    participant = {k: v for k, v in registration.items() if k not in ("_id", "eid", "member_id", "position")}
+    participant["id"] = registration["member_id"]
+    return participant
+
+
+async def touch_event(db, event):
+    """
+    Increments the version of an event after writing its registrations, the version covers the
+    participant list as well so etags and version checks see changes to registrations.
+    Writes claiming the version before writing registrations touch the event again afterwards, a
+    participant list read in between would otherwise be cached under the final version
+    """
+    await db.events.update_one({"eid": event["eid"]}, with_version_bump({}))
+
+
+async def get_participants(db, event, fields: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Returns the participant list of event in order.
+    fields limits the participant fields read, id is always included
+    """
+    if uses_registrations(event):
+        projection = None
+        if fields:
+            projection = {"member_id": 1, **{f: 1 for f in fields if f != "id"}}
+        cursor = db.registrations.find({"eid": event["eid"]}, projection).sort("position", 1)
+        return [to_participant(r) async for r in cursor]
+
+    # participants already read with the event
+    if fields is None and "participants" in event:
+        return event["participants"]
+
+    projection = {"participants": 1}
+    if fields:
+        projection = {"participants.id": 1, **{f"participants.{f}": 1 for f in fields}}
+    res = await db.events.find_one({"eid": event["eid"]}, projection)
+    return res.get("participants", []) if res else []
+
+
+def participant_pipeline(event) -> Tuple[str, List[Dict]]:
+    """
+    Collection and aggregation stages producing the participants of event in order,
+    shaped as the embedded participants, i.e. with id and without registration fields
+    """
+    if uses_registrations(event):
+        return "registrations", [
+            {"$match": {"eid": event["eid"]}},
+            {"$sort": {"position": 1}},
+            {"$set": {"id": "$member_id"}},
+            {"$unset": ["_id", "eid", "member_id", "position"]},
+        ]
+    return "events", [
+        {"$match": {"eid": event["eid"]}},
+        {"$unwind": "$participants"},
+        {"$replaceRoot": {"newRoot": "$participants"}},
+    ]
+
+
+async def iter_participants(db, event, fields: Optional[List[str]] = None) -> AsyncIterator[Dict]:
+    """
+    Iterates the participant list of event in order while it is read from the cursor,
+    for lists that should not be read into memory at once. fields limits the fields read
+    """
+    collection, pipeline = participant_pipeline(event)
+    if fields:
+        pipeline = pipeline + [{"$project": {"_id": 0, "id": 1, **{f: 1 for f in fields}}}]
+    async for participant in await db[collection].aggregate(pipeline):
+        yield participant
+
+
+async def count_participants(db, event) -> Dict:
+    """ Counts participants, confirmed and deprioritized participants of an event using registrations """
+    pipeline = [
+        {"$match": {"eid": event["eid"]}},
+        {"$group": {
+            "_id": None,
+            "participants": {"$sum": 1},
+            "confirmed": {"$sum": {"$cond": [{"$eq": ["$confirmed", True]}, 1, 0]}},
+            "deprioritized": {"$sum": {"$cond": [{"$gt": ["$penalty", 1]}, 1, 0]}},
+        }},
+    ]
+    res = await (await db.registrations.aggregate(pipeline)).to_list()
+    if not res:
+        return {"participants": 0, "confirmed": 0, "deprioritized": 0}
+    res[0].pop("_id")
+    return res[0]
+
+
+async def find_participant(db, event, member_id: UUID) -> Optional[Dict]:
+    """ Returns the participant entry of member in event, None if member has not joined """
+    if uses_registrations(event):
+        registration = await db.registrations.find_one({"member_id": member_id, "eid": event["eid"]})
+        return registration and to_participant(registration)
+
+    user_event = await db.events.find_one({"eid": event["eid"]}, {"participants": {
+        "$elemMatch": {"id": member_id}}})
+    if not user_event or "participants" not in user_event:
+        return None
+    return user_event["participants"][0]
+
+
+async def update_participant(db, event, member_id: UUID, values: Dict) -> bool:
+    """ Sets values on the participant entry of member, returns False if member has not joined """
+    if uses_registrations(event):
+        res = await db.registrations.update_one({"member_id": member_id, "eid": event["eid"]}, {"$set": values})
+        if res.modified_count:
+            await touch_event(db, event)
+    else:
+        update = {f"participants.$.{key}": value for key, value in values.items()}
+        res = await db.events.update_one({"eid": event["eid"], "participants.id": member_id},
+                                         with_version_bump({"$set": update}))
+    return res.matched_count != 0
+
+
+async def delete_participant(db, event, member_id: UUID) -> bool:
+    if uses_registrations(event):
+        res = await db.registrations.delete_one({"member_id": member_id, "eid": event["eid"]})
+        if res.deleted_count:
+            await touch_event(db, event)
+        return res.deleted_count != 0
+    res = await db.events.update_one({"eid": event["eid"]}, with_version_bump({
+        "$pull": {"participants": {"id": member_id}}}))
+    return res.modified_count != 0
+
+
+async def delete_event_participants(db, event):
+    if uses_registrations(event):
+        await db.registrations.delete_many({"eid": event["eid"]})
+
+
+async def set_participant_order(db, event, participants: List[Dict]) -> bool:
+    """
+    Stores participants in the given order. Returns False without writing anything if the event
+    was changed since it was read, the order should then be recomputed from a fresh read
+    """
+    if not uses_registrations(event):
+        res = await db.events.update_one(version_filter(event), with_version_bump(
+            {"$set": {"participants": participants}}))
+        return res.matched_count != 0
+
+    # claim the event version before writing the positions
+    res = await db.events.update_one(version_filter(event), with_version_bump({}))
+    if res.matched_count == 0:
+        return False
+
+    updates = [UpdateOne(
+        {"member_id": p["id"], "eid": event["eid"]},
+        {"$set": {"position": registration_position(i, p["penalty"])}}
+    ) for i, p in enumerate(participants)]
+    if updates:
+        await db.registrations.bulk_write(updates)
+        await touch_event(db, event)
+    return True
+
+
+async def confirm_participants(db, event, emails: List[str]):
+    """ Marks participants with the given emails as confirmed """
+    if uses_registrations(event):
+        await db.registrations.update_many(
+            {"eid": event["eid"], "email": {"$in": emails}},
+            {"$set": {"confirmed": True}})
+        await touch_event(db, event)
+        return
+
+    await db.events.update_many(
+        {"eid": event["eid"]},
+        with_version_bump({"$set": {"participants.$[element].confirmed": True}}),
+        array_filters=[{"element.email": {"$in": emails}}],
+    )
+
+
+async def insert_participant(db, storage: str, join_filter: Dict, participant: Dict, deprioritized: bool) -> str:
+    """
+    Inserts participant into the event matching join_filter. join_filter should only contain event conditions.
+    Embedded: a single pipeline update checking for duplicates and placing the participant in front of
+    deprioritized participants.
+    Registrations: claims the next position on the event and inserts the registration, duplicates are
+    rejected by the unique (member_id, eid) index.
+    """
+    if storage == EMBEDDED:
+        embedded_filter = {**join_filter,
+                           "participantStorage": {"$ne": REGISTRATIONS},
+                           "participants.id": {"$ne": participant["id"]}}
+        res = await db.events.update_one(embedded_filter, with_version_bump(
+            insert_participant_update(participant, deprioritized)))
+        return JOINED if res.matched_count == 1 else NO_MATCH
+
+    event = await db.events.find_one_and_update(
+        {**join_filter, "participantStorage": REGISTRATIONS},
+        with_version_bump({"$inc": {"registrationSeq": 1}}),
+        projection={"eid": 1, "registrationSeq": 1},
+        return_document=ReturnDocument.AFTER)
+    if not event:
+        return NO_MATCH
+
+    position = event["registrationSeq"]
+    if deprioritized:
+        position += DEPRIORITIZED_OFFSET
+    registration = to_registration(event["eid"], participant, position)
+    try:
+        await db.registrations.insert_one(registration)
+    except DuplicateKeyError:
+        return ALREADY_JOINED
+    await touch_event(db, event)
+    return JOINED
+
+
+async def registered_event_ids(db, member_id: UUID) -> List[UUID]:
+    """ eids of all events using the registrations collection member has joined """
+    cursor = db.registrations.find({"member_id": member_id}, {"eid": 1})
+    return [r["eid"] async for r in cursor]
+
+
+async def deprioritize_registrations(db, deprioritized: Dict[UUID, List[UUID]]):
+    """
+    Moves members to the end of the participant lists of events.
+    deprioritized maps eid to the member ids to move in that event
+    """
+    updates = []
+    claimed = []
+    for eid, member_ids in deprioritized.items():
+        # claim one new position per member at the end of the list
+        event = await db.events.find_one_and_update(
+            {"eid": eid}, with_version_bump({"$inc": {"registrationSeq": len(member_ids)}}),
+            projection={"eid": 1, "registrationSeq": 1}, return_document=ReturnDocument.AFTER)
+        if not event:
+            continue
+        claimed.append(event)
+        first = event["registrationSeq"] - len(member_ids) + 1
+        updates += [UpdateOne(
+            {"member_id": member_id, "eid": eid},
+            {"$set": {"position": DEPRIORITIZED_OFFSET + first + i}}
+        ) for i, member_id in enumerate(member_ids)]
+
+    if updates:
+        await db.registrations.bulk_write(updates)
+        for event in claimed:
+            await touch_event(db, event)
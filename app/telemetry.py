@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from uuid import UUID
+
+from fastapi import Request
+from pymongo import UpdateOne
+from pymongo.database import Database
+from pymongo.errors import BulkWriteError
+
+# Page and unique visits are not written per request. Handlers add them to the VisitBuffer of the
+# api process, which writes them in batches: when flush_size visits are buffered, every
+# flush_interval seconds and on shutdown. Visits keep the time they were added at. Telemetry is
+# best effort, visits are dropped (and counted) when the buffer is full or a flush fails.
+
+DUPLICATE_KEY_ERROR = 11000
+
+# pages the api does not track
+UNTRACKABLE_KEYWORDS = ["admin", "archive"]
+
+log = logging.getLogger(__name__)
+
+
+def is_trackable(page: str) -> bool:
+    return not any(keyword in page for keyword in UNTRACKABLE_KEYWORDS)
+
+
+def visitor_key(user_id: str, day: str) -> bytes:
+    """ Member ids are not stored with the visits, only a hash that differs from day to day """
+    return hashlib.sha256(f"{day}:{UUID(user_id)}".encode()).digest()[:16]
+
+
+def register_unique_visits(db: Database, visits: List[Tuple[str, datetime]]) -> int:
+    """
+    Counts the first visit of the day of each member, visits are (user id, timestamp).
+    The upsert only inserts for the first visit of the day, concurrent visits by the same member
+    are resolved by the unique (day, visitor) index, so exactly one of them is logged.
+    Returns the number of visits logged
+    """
+    if not visits:
+        return 0
+    now = datetime.utcnow()
+    updates = [UpdateOne({'day': ts.strftime('%Y-%m-%d'), 'visitor': visitor_key(user_id, ts.strftime('%Y-%m-%d'))},
+                         {"$setOnInsert": {"createdAt": now}}, upsert=True)
+               for user_id, ts in visits]
+    try:
+        upserted = db.uniqueVisitors.bulk_write(updates, ordered=False).upserted_ids
+    except BulkWriteError as error:
+        # concurrent upserts of another process inserted some of the documents first
+        if any(e["code"] != DUPLICATE_KEY_ERROR for e in error.details.get("writeErrors", [])):
+            raise
+        upserted = {u["index"]: u["_id"] for u in error.details.get("upserted", [])}
+
+    # stores time object instead of string representation since we don't need to format
+    # 26 bytes per entry timestamp and _id
+    timestamps = [{"timestamp": visits[i][1]} for i in sorted(upserted)]
+    if timestamps:
+        db.uniqueVisitLog.insert_many(timestamps)
+    return len(timestamps)
+
+
+class VisitBuffer:
+    """
+    Buffered page and unique visits of an api process.
+    get_db returns the database at flush time, the database of the app can be replaced in tests
+    """
+
+    def __init__(self, get_db: Callable[[], Database], max_size: int, flush_size: int, flush_interval: float):
+        self.get_db = get_db
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._page_visits: List[Dict] = []
+        # (day, user id) -> time of the first visit of the day, not yet written
+        self._unique_visits: Dict[Tuple[str, str], datetime] = {}
+        # members whose visit today is written, these visits need no database write
+        self._counted_day = None
+        self._counted = set()
+        self._lock = threading.Lock()
+        # one flush at a time, visits added during a flush go to the next one
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.page_visits = 0
+        self.unique_visits = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.max_depth = 0
+
+    def _start(self):
+        """ Starts the interval flush on first use, called with the lock held """
+        if self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, name="visit-buffer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def _depth(self) -> int:
+        return len(self._page_visits) + len(self._unique_visits)
+
+    def _added(self) -> bool:
+        """ Called with the lock held after adding a visit, returns whether the buffer should be flushed """
+        depth = self._depth()
+        self.max_depth = max(self.max_depth, depth)
+        self._start()
+        return depth >= self.flush_size
+
+    def add_page_visit(self, page: str):
+        if not is_trackable(page):
+            return
+        with self._lock:
+            if self._depth() >= self.max_size:
+                self.dropped += 1
+                return
+            self._page_visits.append({"timestamp": datetime.now(), "metaData": page})
+            self.page_visits += 1
+            full = self._added()
+        if full:
+            self.flush()
+
+    def counted_today(self, user_id: str) -> bool:
+        """ Whether a visit of member today is already written or buffered """
+        with self._lock:
+            return self._is_counted(user_id)
+
+    def _is_counted(self, user_id: str) -> bool:
+        today = datetime.today().strftime('%Y-%m-%d')
+        if self._counted_day != today:
+            self._counted_day = today
+            self._counted = set()
+        return user_id in self._counted or (today, user_id) in self._unique_visits
+
+    def add_unique_visit(self, user_id: str):
+        with self._lock:
+            if self._is_counted(user_id):
+                return
+            if self._depth() >= self.max_size:
+                self.dropped += 1
+                return
+            now = datetime.now()
+            self._unique_visits[(now.strftime('%Y-%m-%d'), user_id)] = now
+            self.unique_visits += 1
+            full = self._added()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                page_visits, self._page_visits = self._page_visits, []
+                unique_visits, self._unique_visits = self._unique_visits, {}
+            if not page_visits and not unique_visits:
+                return
+
+            db = self.get_db()
+            self.flushes += 1
+            if page_visits:
+                try:
+                    db.pageVisitLog.insert_many(page_visits, ordered=False)
+                except Exception:
+                    log.exception("Could not write %d page visits", len(page_visits))
+                    self.failed += len(page_visits)
+            if unique_visits:
+                try:
+                    register_unique_visits(db, [(user_id, ts) for (_, user_id), ts in unique_visits.items()])
+                except Exception:
+                    log.exception("Could not write %d unique visits", len(unique_visits))
+                    self.failed += len(unique_visits)
+                else:
+                    with self._lock:
+                        self._counted.update(user_id for day, user_id in unique_visits if day == self._counted_day)
+
+    def close(self):
+        """ Stops the interval flush and writes the remaining visits """
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread:
+            thread.join()
+        self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending_page_visits = len(self._page_visits)
+            pending_unique_visits = len(self._unique_visits)
+        return {
+            "pending_page_visits": pending_page_visits,
+            "pending_unique_visits": pending_unique_visits,
+            "max_depth": self.max_depth,
+            "max_size": self.max_size,
+            "page_visits": self.page_visits,
+            "unique_visits": self.unique_visits,
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+def get_visit_buffer(request: Request) -> VisitBuffer:
+    return request.app.visit_buffer
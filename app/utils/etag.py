@@ -0,0 +1,63 @@
+import hashlib
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+
+# api json responses are revalidated on every use, the etag makes revalidation cheap
+REVALIDATE = "private, no-cache"
+
+
+class NotModified(Exception):
+    """
+    Raised by check_etag when the client already has the current representation,
+    answered with 304 by the handler registered in create_app
+    """
+
+    def __init__(self, etag: str, headers: Optional[Dict] = None):
+        self.etag = etag
+        self.headers = headers or {}
+
+
+def make_etag(*parts) -> str:
+    """ Strong etag derived from the values a response is rendered from """
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def document_etag(request: Request, kind: str, key, version: Optional[int], *extra) -> str:
+    """
+    Etag of a document with a version field incremented on every write. Documents without the
+    field have not been written since versioning was added, their version is 0 until the next write.
+    The api version is included so representations change with it
+    """
+    return make_etag(request.app.version, kind, key, version or 0, *extra)
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    """ True if the If-None-Match header of the request matches etag (weak comparison, as for GET) """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def not_modified_response(etag: str, headers=None) -> Response:
+    return Response(status_code=304, headers={**(headers or {}), "ETag": etag})
+
+
+def check_etag(request: Request, response: Response, etag: str, cache_control: str = REVALIDATE):
+    """
+    Sets the validator on the response and raises NotModified if the client's copy is current,
+    call it before reading and serializing anything the etag does not depend on
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+    if is_not_modified(request, etag):
+        raise NotModified(etag, {"Cache-Control": cache_control})
+
+
+async def not_modified_handler(request: Request, exc: NotModified) -> Response:
+    return not_modified_response(exc.etag, exc.headers)
@@ -2,7 +2,8 @@ from datetime import datetime
 from uuid import UUID
 from fastapi import HTTPException
 from datetime import datetime, timedelta
-from ..api.mail import send_mail
+from ..mail_templates import MailTemplates
+from ..outbox import enqueue_mails_async
 from ..models import MailPayload
 
 
@@ -124,30 +125,74 @@ def num_of_deprioritized_participants(participants):
     return sum(p["penalty"] > 1 for p in participants)
 
 
+def insert_participant_update(participant, deprioritized):
+    """
+    Pipeline update inserting participant into the participant list of an event.
+    The position is computed server side from the current list, so the insert is done in
+    a single atomic update without reading the participant list first.
+    Members that are not deprioritized are placed in front of all deprioritized (penalty > 1)
+    participants, deprioritized members are placed at the end of the list.
+    """
+    size = {"$size": "$participants"}
+    pos = size
+    if not deprioritized:
+        num_deprioritized = {"$size": {"$filter": {
+            "input": "$participants",
+            "cond": {"$gt": ["$$this.penalty", 1]}
+        }}}
+        pos = {"$subtract": [size, num_deprioritized]}
+
+    return [{"$set": {"participants": {"$let": {
+        "vars": {"pos": pos},
+        "in": {"$concatArrays": [
+            # participants in front of pos
+            {"$slice": ["$participants", "$$pos"]},
+            # $literal as user input starting with $ would otherwise be read as a field path
+            [{"$literal": participant}],
+            # participants after pos i.e the last (size - pos) elements
+            {"$slice": ["$participants", {"$subtract": ["$$pos", size]}]},
+        ]}
+    }}}}]
+
+
+def move_participants_last_update(member_ids):
+    """
+    Pipeline update moving the participants with the given ids to the end of the participant list,
+    keeping the order both within the moved and the remaining participants
+    """
+    is_moved = {"$in": ["$$this.id", member_ids]}
+    return [{"$set": {"participants": {"$concatArrays": [
+        {"$filter": {"input": "$participants", "cond": {"$not": [is_moved]}}},
+        {"$filter": {"input": "$participants", "cond": is_moved}},
+    ]}}}]
+
+
 def num_of_confirmed_participants(participants):
     return sum(p["confirmed"] == True for p in participants)
 
 
-def get_default_confirmation(event):
-    with open("./app/assets/mails/event_confirmation.txt", 'r') as mail_content:
-        content = mail_content.read().replace(
-            "$EVENT_NAME$", event['title'])
-        content = content.replace(
-            "$DATE$", event['date'].strftime("%d %B, %Y"))
-        content = content.replace("$TIME$", event['date'].strftime("%H:%M"))
-        content = content.replace("$LOCATION$", event['address'])
-
-        return content
+def get_default_confirmation(templates: MailTemplates, event):
+    return templates.render(
+        "event_confirmation",
+        EVENT_NAME=event['title'],
+        DATE=event['date'].strftime("%d %B, %Y"),
+        TIME=event['date'].strftime("%H:%M"),
+        LOCATION=event['address'],
+    )
 
 
-def send_emails(mailing_list, subject, content):
+async def send_emails(db, mailing_list, subject, content, key_prefix=None):
     """
-    Send emails to addresses in mailing list with given subject and content.
+    Queue emails to addresses in mailing list with given subject and content, see app/outbox.py.
+    Each address gets its own mail. With a key_prefix an address only gets one mail per prefix,
+    even if this is called again.
     """
-    for address in mailing_list:
-        email = MailPayload(
+    payloads = [
+        MailPayload(
             to=[address],
             subject=subject,
             content=content
-        )
-        send_mail(email)
+        ) for address in mailing_list
+    ]
+    keys = [f"{key_prefix}:{address}" for address in mailing_list] if key_prefix else None
+    await enqueue_mails_async(db, payloads, keys)
@@ -0,0 +1,181 @@
+import csv
+import io
+import tempfile
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterator, List
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from xlsxwriter import Workbook
+
+from .. import registrations
+from .pagination import ndjson_response
+
+# participant columns of exports, in order
+EXPORT_FIELDS = ["realName", "email", "classof", "phone", "role", "food", "transportation",
+                 "dietaryRestrictions", "submitDate", "penalty", "confirmed", "attended"]
+
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# participants written to the workbook per threadpool call
+XLSX_CHUNK_ROWS = 500
+# bytes per chunk when streaming a finished workbook
+FILE_CHUNK_SIZE = 64 * 1024
+
+# rows of the sheet layout, 0 indexed
+DETAILS_ROW = 3
+TOTALS_ROW = 8
+PARTICIPANTS_ROW = 13
+
+
+async def participant_totals(db, event) -> Dict:
+    collection, pipeline = registrations.participant_pipeline(event)
+    pipeline = pipeline + [{"$group": {
+        "_id": None,
+        "Total participants": {"$sum": 1},
+        "Total to eat": {"$sum": {"$cond": [{"$eq": ["$food", True]}, 1, 0]}},
+        "Total to transportation": {"$sum": {"$cond": [{"$eq": ["$transportation", True]}, 1, 0]}},
+    }}]
+    res = await (await db[collection].aggregate(pipeline)).to_list()
+    totals = res[0] if res else {"Total participants": 0, "Total to eat": 0, "Total to transportation": 0}
+    totals.pop("_id", None)
+    return totals
+
+
+async def export_participants(db, event) -> AsyncIterator[Dict]:
+    """ Participants with the export fields, in order, the member id is not exported """
+    async for participant in registrations.iter_participants(db, event, EXPORT_FIELDS):
+        yield {field: participant.get(field) for field in EXPORT_FIELDS}
+
+
+async def participant_rows(db, event) -> AsyncIterator[List]:
+    async for participant in export_participants(db, event):
+        yield list(participant.values())
+
+
+def file_chunks(file) -> Iterator[bytes]:
+    """ Streams a file in chunks and closes it, temporary files are deleted on close """
+    try:
+        while chunk := file.read(FILE_CHUNK_SIZE):
+            yield chunk
+    finally:
+        file.close()
+
+
+class EventWorkbook:
+    """
+    Event details, totals and the participant list in a single sheet. The workbook is written
+    in constant memory mode, rows are flushed to a temporary file as they are written, so rows must
+    be written in order. Each export writes its own anonymous temporary file.
+    """
+
+    def __init__(self):
+        self.output = tempfile.TemporaryFile()
+        self.workbook = Workbook(self.output, {'constant_memory': True, 'remove_timezone': True})
+        self.worksheet = self.workbook.add_worksheet('Event')
+        add_format = self.workbook.add_format
+        self.title_format = add_format({'bold': True, 'font_size': 20})
+        self.header_format = add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        self.table_header_format = add_format({'bg_color': 'gray'})
+        self.date_format = add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+        # participants within maxParticipants are green, the waiting list red, alternating shades per row
+        self.row_formats = {}
+        for name, colors in (("accept", ('#b3dfc1', '#bfe2ca')), ("wait", ('#e6b9b8', '#f2dddc'))):
+            self.row_formats[name] = [
+                (add_format({'bg_color': color}), add_format({'bg_color': color, 'num_format': 'yyyy-mm-dd hh:mm:ss'}))
+                for color in colors
+            ]
+        self.written = 0
+
+    def _write_table(self, row: int, values: Dict, value_format=None):
+        self.worksheet.write_row(row, 0, list(values.keys()), self.header_format)
+        if value_format:
+            self.worksheet.set_row(row + 1, None, value_format)
+        for col, value in enumerate(values.values()):
+            self.worksheet.write(row + 1, col, value, self.date_format if isinstance(value, datetime) else None)
+
+    def write_header(self, event, totals: Dict):
+        worksheet = self.worksheet
+        worksheet.set_column(0, 8, 18)
+        worksheet.set_row(0, 25, self.title_format)
+        worksheet.write(0, 0, event['title'], self.title_format)
+
+        details = {'Title': event['title'], 'date': event['date'], 'address': event['address'], 'price': event['price'],
+                   'maxParticipants': event['maxParticipants'], 'duration': event['duration'],
+                   'transportation': str(event['transportation']), 'food': str(event['food'])}
+        self._write_table(DETAILS_ROW, details, self.table_header_format)
+        self._write_table(TOTALS_ROW, totals, self.table_header_format)
+        worksheet.write_row(PARTICIPANTS_ROW, 0, EXPORT_FIELDS, self.header_format)
+
+        self.waiting_list_from = event["maxParticipants"] or totals["Total participants"]
+
+    def write_participants(self, rows: List[List]):
+        for values in rows:
+            i = self.written
+            kind = "wait" if i >= self.waiting_list_from else "accept"
+            row_format, date_format = self.row_formats[kind][i % 2]
+            row = PARTICIPANTS_ROW + 1 + i
+            self.worksheet.set_row(row, None, row_format)
+            for col, value in enumerate(values):
+                if isinstance(value, datetime):
+                    self.worksheet.write_datetime(row, col, value, date_format)
+                elif value is not None:
+                    self.worksheet.write(row, col, value, row_format)
+            self.written += 1
+
+    def close(self):
+        """ Finishes the workbook, returns the file positioned at the start """
+        self.workbook.close()
+        self.output.seek(0)
+        return self.output
+
+
+async def xlsx_export(db, event, filename: str) -> StreamingResponse:
+    totals = await participant_totals(db, event)
+    book = EventWorkbook()
+    try:
+        book.write_header(event, totals)
+        chunk = []
+        async for row in participant_rows(db, event):
+            chunk.append(row)
+            if len(chunk) == XLSX_CHUNK_ROWS:
+                await run_in_threadpool(book.write_participants, chunk)
+                chunk = []
+        await run_in_threadpool(book.write_participants, chunk)
+        output = await run_in_threadpool(book.close)
+    except BaseException:
+        book.output.close()
+        raise
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.xlsx"'}
+    return StreamingResponse(file_chunks(output), media_type=XLSX_MEDIA_TYPE, headers=headers)
+
+
+def csv_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return str(value)
+
+
+def csv_export(db, event, filename: str) -> StreamingResponse:
+    async def lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_FIELDS)
+        async for row in participant_rows(db, event):
+            writer.writerow([csv_value(value) for value in row])
+            # one response chunk per row, the buffer only ever holds a single line
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}.csv"'}
+    return StreamingResponse(lines(), media_type="text/csv", headers=headers)
+
+
+def ndjson_export(db, event, filename: str) -> StreamingResponse:
+    response = ndjson_response(export_participants(db, event))
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.ndjson"'
+    return response
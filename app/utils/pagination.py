@@ -0,0 +1,76 @@
+import base64
+import binascii
+from typing import AsyncIterable, Dict, Iterable, List, Tuple, Union
+
+from bson import json_util
+from bson.binary import UuidRepresentation
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from .serialization import json_bytes
+
+# upper bound for client chosen page sizes
+MAX_PAGE_SIZE = 100
+
+_json_options = json_util.RELAXED_JSON_OPTIONS.with_options(uuid_representation=UuidRepresentation.STANDARD)
+
+
+def encode_cursor(values: List) -> str:
+    """ Opaque cursor holding the sort key values of the last document on a page """
+    return base64.urlsafe_b64encode(json_util.dumps(values, json_options=_json_options).encode()).decode()
+
+
+def decode_cursor(cursor: str, length: int) -> List:
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(cursor.encode()), json_options=_json_options)
+    except (ValueError, binascii.Error):
+        raise HTTPException(400, "Invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(400, "Invalid cursor")
+    return values
+
+
+def keyset_filter(sort: List[Tuple[str, int]], values: List) -> Dict:
+    """
+    Filter matching documents after values in the given sort order, e.g. for
+    sort [(date, -1), (eid, -1)]: date < d or (date == d and eid < e).
+    The last sort field must be unique for pages not to skip or repeat documents
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {f: v for (f, _), v in zip(sort[:i], values[:i])}
+        branch[field] = {"$lt" if direction < 0 else "$gt": values[i]}
+        branches.append(branch)
+    return {"$or": branches}
+
+
+def page_cursor(documents: List[Dict], sort: List[Tuple[str, int]], limit: int):
+    """
+    Splits documents read with limit + 1 into the page and the cursor of the next page,
+    the cursor is None on the last page
+    """
+    if len(documents) <= limit:
+        return documents, None
+    page = documents[:limit]
+    return page, encode_cursor([page[-1][field] for field, _ in sort])
+
+
+def ndjson_line(item) -> bytes:
+    """ Model or plain dict as a line of json """
+    return json_bytes(item) + b"\n"
+
+
+def ndjson_response(items: Union[Iterable, AsyncIterable]) -> StreamingResponse:
+    """
+    Streams models (or plain dicts) as newline delimited json while they are read from the cursor.
+    Sync iterables, e.g. a blocking pymongo cursor, are iterated in the threadpool
+    """
+    if hasattr(items, "__aiter__"):
+        async def lines():
+            async for item in items:
+                yield ndjson_line(item)
+    else:
+        def lines():
+            for item in items:
+                yield ndjson_line(item)
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
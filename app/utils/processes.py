@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+
+class LazyProcessPool:
+    """
+    Process pool started on first use, so processes are only started by apps that use it.
+    Workers are started from the forkserver, the api process has threads by then that a forked
+    child could deadlock on
+    """
+
+    def __init__(self, workers: int):
+        # defaults to the number of cores
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+            return self._executor
+
+    def submit(self, fn, *args) -> Future:
+        return self.executor.submit(fn, *args)
+
+    def shutdown(self):
+        """ Stops the workers, the pool is started again on its next use """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
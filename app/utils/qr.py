@@ -0,0 +1,51 @@
+import io
+from uuid import UUID
+
+import qrcode as qr
+from fpdf import FPDF
+
+from .etag import make_etag
+
+REGISTRATION_URL = 'https://td-uit.no/event/{register_id}/register/'
+
+
+def registration_url(register_id: UUID) -> str:
+    return REGISTRATION_URL.format(register_id=register_id)
+
+
+def qr_etag(title: str, register_id: UUID) -> str:
+    """ The pdf only depends on the title and register id, so the etag is known without rendering it """
+    return make_etag("qr", register_id, title)
+
+
+def render_qr_pdf(title: str, register_id: UUID) -> bytes:
+    """ Renders the registration qr code of an event to a pdf, entirely in memory """
+    url = registration_url(register_id)
+    img = qr.make(url)
+    png = io.BytesIO()
+    img.save(png)
+    png.seek(0)
+
+    pdf = FPDF()
+    pdf.add_page()
+
+    # Add title
+    title_h = pdf.h * 0.05
+    pdf.set_font('helvetica', size=26)
+    pdf.multi_cell(0, title_h, text=title, align='C', max_line_height=title_h)
+
+    # Get width and heigh to display image
+    w, h = img.size
+    pdf_w = pdf.w * 0.8
+    pdf_h = pdf_w * h / w
+    y = title_h + pdf.h * 0.08
+
+    # Add QR code
+    pdf.image(png, x=pdf.w * 0.1, y=y, w=pdf_w, h=pdf_h)
+
+    # Add new line of text below the image
+    pdf.set_xy(0, y + pdf_h + pdf.h * 0.05)
+    pdf.set_font('helvetica', size=10)
+    pdf.cell(0, 20, text=url, align='C')
+
+    return bytes(pdf.output())
@@ -0,0 +1,36 @@
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Type
+
+import pydantic_core
+from fastapi import Response
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, TypeAdapter
+
+# Models returned from a handler are serialized by FastAPI through jsonable_encoder, which walks
+# every value in python (slow for uuids and datetimes), and are validated again when the route
+# has a response model. Handlers on hot paths validate the documents once and return the json
+# bytes serialized by pydantic-core instead, FastAPI passes responses through untouched.
+
+
+def response_class(name: str) -> Type[JSONResponse]:
+    """ Default response class of the app for Config.JSON_RESPONSE, 'orjson' or 'json' """
+    return ORJSONResponse if name == "orjson" else JSONResponse
+
+
+@lru_cache(maxsize=None)
+def list_adapter(model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(List[model])
+
+
+def validate_many(model: Type[BaseModel], documents: Iterable[Dict]) -> List[BaseModel]:
+    """ Validates documents as a list with a cached adapter of the model """
+    return list_adapter(model).validate_python(list(documents))
+
+
+def json_bytes(content) -> bytes:
+    """ Models, lists of models and plain values (uuids, datetimes, ...) as json """
+    return pydantic_core.to_json(content)
+
+
+def json_response(content, status_code: int = 200, headers: Optional[Dict] = None) -> Response:
+    return Response(json_bytes(content), status_code=status_code, media_type="application/json", headers=headers)
@@ -25,6 +25,15 @@ Required:
 $(exec_usage)
     seed:
         seeds database using the seeding file
+    indexes:
+        builds all indexes in app/indexes.py and reports missing or unused indexes
+            - 'indexes --report' only reports without building
+    hashes:
+        reports the password hash methods members are stored with
+            - 'hashes --time' also measures the login cost of each method
+    qr:
+        renders the registration qr sheets of all events in a period to pdfs
+            - 'qr --from 2025-01-01 --to 2025-06-30 --out qr_sheets'
     test:
         runs the docker test file, and sends any additional arguments to the pytest command
             - 'seed -s' will be the same as 'pytest -s'
@@ -74,6 +83,18 @@ seed_db() {
     docker exec tdctl_api python3 -m $utils_path.seeding
 }
 
+build_indexes() {
+    docker exec tdctl_api python3 -m $utils_path.indexes $@
+}
+
+report_hashes() {
+    docker exec tdctl_api python3 -m $utils_path.password_hashes $@
+}
+
+qr_sheets() {
+    docker exec tdctl_api python3 -m $utils_path.qr_sheets $@
+}
+
 run_tests() {
     test_file=pytest_docker.py
     python3 $utils_path/$test_file $@
@@ -94,6 +115,9 @@ parse_arguments() {
         compose) shift; run_compose $@;;
         exec) shift; interactive_shell $@;;
         seed) shift; seed_db;;
+        indexes) shift; build_indexes $@;;
+        hashes) shift; report_hashes $@;;
+        qr) shift; qr_sheets $@;;
         test) shift; run_tests $@;;
         -h | --help) shift; usage;;
         * ) usage;;
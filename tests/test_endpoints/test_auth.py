@@ -4,6 +4,8 @@ from starlette.testclient import TestClient
 from tests.conftest import client_login
 from tests.utils.authentication import authentication_required
 from app.auth_helpers import decode_token
+from app.hashing import method_of, normalize_method
+from werkzeug.security import generate_password_hash
 from app.config import config
 from tests.users import regular_member
 
@@ -56,3 +58,63 @@ def test_change_password(client):
 
     response = client.post("/api/auth/login", json={"email": regular_member["email"], "password": change_password_payload["newPassword"]})
     assert response.status_code == 200
+
+
+def test_access_token_cache(client):
+    client_login(client, regular_member["email"], regular_member["password"])
+    access_token = client.cookies.get("access_token")
+
+    # the second request uses the cached payload
+    for _ in range(2):
+        response = client.get("/api/auth/token-info")
+        assert response.status_code == 200
+    cache_stats = client.app.token_cache.stats()
+    assert cache_stats["hits"] >= 1
+
+    # tampered tokens are still rejected after the valid token was cached
+    client.cookies.set("access_token", access_token[:-2] + "xx")
+    response = client.get("/api/auth/token-info")
+    assert response.status_code == 401
+
+
+def test_rehash_on_login(client: TestClient):
+    # hash created with other parameters than configured
+    old_hash = generate_password_hash(regular_member["password"], "pbkdf2:sha256:1000")
+    db.members.update_one({'email': regular_member["email"]}, {"$set": {"password": old_hash}})
+
+    response = client.post("/api/auth/login", json=regular_member)
+    assert response.status_code == 200
+
+    # the hash is replaced after the login response
+    member = db.members.find_one({'email': regular_member["email"]})
+    assert member and member["password"] != old_hash
+    assert method_of(member["password"]) == normalize_method(config["test"].PASSWORD_HASH_METHOD)
+
+    # the member can still log in with the same password
+    response = client.post("/api/auth/login", json=regular_member)
+    assert response.status_code == 200
+
+
+def test_refresh_token_blacklist(client: TestClient):
+    client_login(client, regular_member["email"], regular_member["password"])
+    refresh_token = client.cookies.get("refresh_token")
+
+    response = client.post("api/auth/renew")
+    assert response.status_code == 200
+
+    # the renewed refresh token is blacklisted, reusing it is rejected
+    client.cookies.set("refresh_token", refresh_token)
+    response = client.post("api/auth/renew")
+    assert response.status_code == 401
+
+    jti = decode_token(refresh_token, config["test"])["jti"]
+    assert db.tokens.find_one({"jti": jti})
+    assert client.app.token_blacklist.stats()["size"] >= 1
+
+    # tokens blacklisted by other processes are read from the tokens collection on refresh
+    client.app.token_blacklist.refresh_interval = 0
+    client_login(client, regular_member["email"], regular_member["password"])
+    refresh_token = client.cookies.get("refresh_token")
+    db.tokens.insert_one(decode_token(refresh_token, config["test"]))
+    response = client.post("api/auth/renew")
+    assert response.status_code == 401
@@ -2,6 +2,11 @@ import os
 import json
 from uuid import UUID, uuid4
 from app.db import get_test_db
+from app.indexes import ensure_indexes
+from app.mailer import Mailer, StubTransport
+from app.utils.export import EXPORT_FIELDS, XLSX_MEDIA_TYPE
+from app.models import MailPayload
+from app.outbox import PENDING, SENT, enqueue_mails, process_batch
 from app.utils.event_utils import num_of_confirmed_participants, num_of_deprioritized_participants
 from tests.conftest import client_login
 from datetime import datetime, timedelta
@@ -9,6 +14,7 @@ from tests.test_endpoints.test_members import payload
 from tests.users import regular_member, admin_member, second_admin, second_member
 
 from tests.utils.authentication import admin_required, authentication_required
+from utils.registrations import embed_event, migrate_event
 
 db = get_test_db()
 
@@ -122,6 +128,30 @@ def test_get_upcoming_events(client):
     response = client.get("/api/upcoming/")
     assert len(response.json()) == 1
 
+def test_event_listing_cache(client):
+    # anonymous listings are served from the cache after the first request
+    response = client.get("/api/event/")
+    assert response.status_code == 200
+    first = response.json()
+    response = client.get("/api/event/")
+    assert response.status_code == 200
+    assert response.json() == first
+
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.get("/api/stats/metrics")
+    assert response.status_code == 200
+    cache_stats = response.json()["event_cache"]
+    assert cache_stats["hits"] == 1
+
+    # creating an event invalidates cached listings
+    response = client.post("/api/event/", json=new_event)
+    assert response.status_code == 200
+    client.cookies.clear()
+    response = client.get("/api/event/")
+    assert response.status_code == 200
+    assert len(response.json()) == len(first) + 1
+
+
 def test_get_past_events_count(client):
     # Login as admin
     client_login(client, admin_member["email"], admin_member["password"])
@@ -162,6 +192,44 @@ def test_get_past_events_with_pagination(client):
         assert len(past_events) == expected_events
 
 
+def test_get_past_events_with_cursor(client):
+    client_login(client, admin_member["email"], admin_member["password"])
+
+    response = client.get('/api/event/past-events/count')
+    assert response.status_code == 200
+    total_past_events = response.json()["count"]
+
+    # follow the cursors until the last page
+    eids = []
+    cursor = None
+    while True:
+        params = {"limit": 4}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get('/api/event/past-events', params=params)
+        assert response.status_code == 200
+        page = response.json()
+        assert len(page) <= 4
+        eids += [e["eid"] for e in page]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert len(eids) == total_past_events
+    assert len(set(eids)) == total_past_events
+
+    # streamed archive contains the same events in the same order
+    response = client.get('/api/event/past-events/stream')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [e["eid"] for e in lines] == eids
+
+    response = client.get('/api/event/past-events', params={"cursor": "invalid"})
+    assert response.status_code == 400
+
+    response = client.get('/api/event/past-events', params={"limit": 1000})
+    assert response.status_code == 422
+
+
 @authentication_required("/api/event/joined-events", "get")
 def test_get_joined_events(client):
     # Login
@@ -194,8 +262,22 @@ def test_get_joined_events(client):
 def test_get_event_picture(client):
     eid = test_events[0]["eid"]
 
-    response = client.get(f'/api/event/{eid}/image')
+    response = client.get(f'/api/event/{eid}/image', headers={"Accept": "image/webp,image/*"})
     assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    # unversioned requests are revalidated, a new upload is shown right away
+    assert "no-cache" in response.headers["cache-control"]
+    etag = response.headers["etag"]
+
+    response = client.get(f'/api/event/{eid}/image', headers={"Accept": "image/webp,image/*", "If-None-Match": etag})
+    assert response.status_code == 304
+
+    # explicit size and format, cached as immutable when requested with the image version
+    version = response.headers["x-image-version"]
+    response = client.get(f'/api/event/{eid}/image', params={"size": "small", "format": "jpeg", "v": version})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/jpeg"
+    assert "immutable" in response.headers["cache-control"]
 
     response = client.get(f'/api/event/{non_existing_eid}/image')
     assert response.status_code == 404
@@ -225,6 +307,26 @@ def test_upload_event_picture(client):
     assert response.status_code == 400
     os.remove(file_name)
 
+    # content that is not an image is rejected whatever its content type
+    file = {
+        "image": ('fake.png', b"not an image", 'image/png'),
+    }
+    response = client.post(f'/api/event/{eid}/image', files=file)
+    assert response.status_code == 400
+
+
+def test_upload_event_picture_too_large(client, monkeypatch):
+    eid = test_events[0]["eid"]
+    client_login(client, admin_member["email"], admin_member["password"])
+
+    # uploads larger than MAX_IMAGE_BYTES are rejected
+    monkeypatch.setattr(client.app.config, "MAX_IMAGE_BYTES", 16)
+    file = {
+        "image": ('large.png', b"\0" * 17, 'image/png'),
+    }
+    response = client.post(f'/api/event/{eid}/image', files=file)
+    assert response.status_code == 413
+
 
 def test_get_event_by_id(client):
     eid = test_events[0]["eid"]
@@ -240,6 +342,36 @@ def test_get_event_by_id(client):
     client_login(client, admin_member["email"], admin_member["password"])
     response = client.get(f'/api/event/{eid}')
     assert response.status_code == 200
+    res = response.json()
+    assert "participants" in res
+    # internal fields are not part of the response
+    assert "version" not in res and "participantStorage" not in res
+
+
+def test_get_event_etag(client):
+    eid = test_events[0]["eid"]
+
+    response = client.get(f'/api/event/{eid}')
+    etag = response.headers["ETag"]
+    cached = client.get(f'/api/event/{eid}', headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.content == b""
+
+    # admins see participants, the representations have different etags
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.get(f'/api/event/{eid}', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    admin_etag = response.headers["ETag"]
+    assert client.get(f'/api/event/{eid}', headers={"If-None-Match": admin_etag}).status_code == 304
+
+    # any write to the event increments its version
+    db.events.update_one({"eid": UUID(eid)}, {"$inc": {"version": 1}})
+    assert client.get(f'/api/event/{eid}', headers={"If-None-Match": admin_etag}).status_code == 200
+
+    # listings are revalidated against the etag of the cached body
+    response = client.get('/api/event/')
+    cached = client.get('/api/event/', headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
 
 
 def test_get_event_participants(client):
@@ -311,6 +443,30 @@ def test_get_event_options(client):
         'dietaryRestrictions'] == joinEventPayload['dietaryRestrictions']
 
 
+def test_event_with_participant_storages(client, monkeypatch):
+    # registrations need the unique (member_id, eid) index, test database is dropped after startup
+    ensure_indexes(db)
+    client_login(client, admin_member["email"], admin_member["password"])
+
+    for storage in ("embedded", "registrations"):
+        monkeypatch.setattr(client.app.config, "PARTICIPANT_STORAGE", storage)
+        response = client.post("/api/event/", json=new_event)
+        assert response.status_code == 200
+        eid = response.json()["eid"]
+        response = client.post(f'/api/event/{eid}/join', json=joinEventPayload)
+        assert response.status_code == 200
+
+        # the event header and the participant are both read for these endpoints
+        response = client.get(f'/api/event/{eid}/joined')
+        assert response.status_code == 200 and response.json()["joined"] == True
+        response = client.get(f'/api/event/{eid}/options')
+        assert response.status_code == 200
+        assert response.json()['food'] == joinEventPayload['food']
+        response = client.put(f'/api/event/{eid}/update-options', json={**joinEventPayload, "food": False})
+        assert response.status_code == 200
+        assert client.get(f'/api/event/{eid}/options').json()['food'] == False
+
+
 @authentication_required("/api/event/{uuid}/options", "get")
 def test_update_event_options(client):
     # Login
@@ -418,6 +574,11 @@ def test_join_published_event(client):
         f'/api/event/{new_event_eid}/join', json=joinEventPayload)
     assert response.status_code == 200
 
+    # joining twice is rejected
+    response = client.post(
+        f'/api/event/{new_event_eid}/join', json=joinEventPayload)
+    assert response.status_code == 400
+
     # creates new member for joining the event
     response = client.post("/api/member/", json=payload)
     assert response.status_code == 200
@@ -425,10 +586,17 @@ def test_join_published_event(client):
     # checks response on full event
     client_login(client, payload["email"], payload["password"])
 
+    # user input is stored as is, i.e not interpreted as a field path in the join update
     response = client.post(
-        f'/api/event/{new_event_eid}/join', json=joinEventPayload)
+        f'/api/event/{new_event_eid}/join', json={**joinEventPayload, "dietaryRestrictions": "$participants"})
     assert response.status_code == 200
 
+    joined_event = db.events.find_one({"eid": UUID(new_event_eid)})
+    assert joined_event and len(joined_event["participants"]) == 2
+    # the new member is placed on the waiting list behind the first participant
+    assert joined_event["participants"][1]["email"] == payload["email"]
+    assert joined_event["participants"][1]["dietaryRestrictions"] == "$participants"
+
     # === test join ordering ===
     client_login(client, admin_member["email"], admin_member["password"])
     eid = test_events[0]["eid"]
@@ -636,6 +804,25 @@ def test_export_event(client):
 
     response = client.get(f'/api/event/{eid}/export')
     assert response.status_code == 200
+    assert response.headers["content-type"] == XLSX_MEDIA_TYPE
+    # xlsx files are zip archives
+    assert response.content[:2] == b"PK"
+
+    event = db.events.find_one({"eid": UUID(eid)})
+    response = client.get(f'/api/event/{eid}/export', params={"format": "csv"})
+    assert response.status_code == 200
+    lines = response.text.splitlines()
+    assert lines[0].split(",") == EXPORT_FIELDS
+    assert len(lines) == len(event["participants"]) + 1
+
+    response = client.get(f'/api/event/{eid}/export', params={"format": "ndjson"})
+    assert response.status_code == 200
+    participants = [json.loads(line) for line in response.text.splitlines()]
+    assert [p["email"] for p in participants] == [p["email"] for p in event["participants"]]
+    assert "id" not in participants[0]
+
+    response = client.get(f'/api/event/{eid}/export', params={"format": "pdf"})
+    assert response.status_code == 422
 
     response = client.get(f'/api/event/{non_existing_eid}/export')
     assert response.status_code == 404
@@ -764,6 +951,41 @@ def test_confirm_event(client):
         event["participants"]) == len(event["participants"])
 
 
+def test_confirmation_outbox(client):
+    # the outbox needs the unique key index, test database is dropped after startup
+    ensure_indexes(db)
+    eid = test_events[0]["eid"]
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.put(
+        f"/api/event/{eid}", json={"date": f"{future_time_str}", "maxParticipants": 1, "public": True})
+    assert response.status_code == 200
+
+    response = client.post(f'/api/event/{eid}/confirm', json={"msg": "test message"})
+    assert response.status_code == 200
+
+    # one queued mail per confirmed participant, the mails are not sent by the api
+    mails = list(db.outbox.find({"key": {"$regex": f"^confirm:{UUID(eid)}:"}}))
+    assert len(mails) == 1 and mails[0]["status"] == PENDING
+
+    # enqueueing the same confirmation again is a no-op
+    enqueue_mails(db, [MailPayload(to=mails[0]["to"], subject="again", content="again")], keys=[mails[0]["key"]])
+    assert db.outbox.count_documents({"key": mails[0]["key"]}) == 1
+
+    transport = StubTransport()
+    mailer = Mailer(transport, max_retries=0)
+    # first attempt is rate limited, the mail is retried later instead of failing
+    transport.failures = {mails[0]["to"][0]: [429]}
+    assert process_batch(db, mailer, "test", 10) >= 1
+    mail = db.outbox.find_one({"_id": mails[0]["_id"]})
+    assert mail["status"] == PENDING and mail["attempts"] == 1 and mail["nextAttemptAt"] > datetime.utcnow()
+
+    db.outbox.update_one({"_id": mail["_id"]}, {"$set": {"nextAttemptAt": datetime.utcnow()}})
+    assert process_batch(db, mailer, "test", 10) >= 1
+    mail = db.outbox.find_one({"_id": mail["_id"]})
+    assert mail["status"] == SENT and mail["attempts"] == 2
+    assert len(transport.sent) >= 1
+
+
 @admin_required("/api/event/{uuid}/updateParticipantsOrder", "put")
 def test_event_reorder(client):
     eid = test_events[0]["eid"]
@@ -802,6 +1024,8 @@ def test_event_reorder(client):
     # checks that order is actually updated
     assert participants[0]["id"] == UUID(new_order[1]["id"])
     assert participants[1]["id"] == UUID(new_order[0]["id"])
+    # the reorder is a versioned write
+    assert event_after["version"] == (event.get("version") or 0) + 1
 
     invalid_reorder = new_order
     invalid_reorder[0]["pos"] = penalty_idx
@@ -868,6 +1092,42 @@ def test_event_reorder(client):
     assert response.status_code == 400
 
 
+@admin_required("/api/event/{uuid}/qr", "get")
+def test_registration_qr(client):
+    eid = test_events[0]['eid']
+    client_login(client, admin_member["email"], admin_member["password"])
+
+    response = client.get(f'/api/event/{eid}/qr')
+    assert response.status_code == 400
+
+    response = client.post(f'/api/event/{eid}/qr')
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.content.startswith(b"%PDF")
+    etag = response.headers["etag"]
+
+    # the register id is only created once
+    response = client.post(f'/api/event/{eid}/qr')
+    assert response.status_code == 400
+
+    # served from the cache rendered on creation
+    response = client.get(f'/api/event/{eid}/qr')
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+    assert client.app.qr_cache.stats()["hits"] >= 1
+
+    response = client.get(f'/api/event/{eid}/qr', headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # the pdf shows the title, changing it changes the etag
+    response = client.put(f"/api/event/{eid}", json={"title": "new title"})
+    assert response.status_code == 200
+    response = client.get(f'/api/event/{eid}/qr', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+
 @authentication_required('/api/event/{uuid}/register', 'put')
 def test_update_attendance(client):
     eid = test_events[0]['eid']
@@ -1073,3 +1333,70 @@ def test_get_qr(client):
     # Should now get qr document
     response = client.get(f'/api/event/{eid}/qr')
     assert response.status_code == 200
+
+
+def test_registrations_participant_storage(client, monkeypatch):
+    # registrations need the unique (member_id, eid) index, test database is dropped after startup
+    ensure_indexes(db)
+    monkeypatch.setattr(client.app.config, "PARTICIPANT_STORAGE", "registrations")
+
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.post("/api/event/", json=new_event)
+    assert response.status_code == 200
+    eid = response.json()["eid"]
+
+    response = client.post(f'/api/event/{eid}/join', json=joinEventPayload)
+    assert response.status_code == 200
+    response = client.post(f'/api/event/{eid}/join', json=joinEventPayload)
+    assert response.status_code == 400
+
+    client_login(client, regular_member["email"], regular_member["password"])
+    response = client.post(f'/api/event/{eid}/join', json=joinEventPayload)
+    assert response.status_code == 200
+
+    # participants are not stored in the event document
+    event = db.events.find_one({"eid": UUID(eid)})
+    assert event and event["participants"] == []
+    assert db.registrations.count_documents({"eid": UUID(eid)}) == 2
+
+    response = client.get(f'/api/event/{eid}/joined')
+    assert response.status_code == 200 and response.json()["joined"] == True
+
+    response = client.get('/api/event/joined-events')
+    assert response.status_code == 200
+    assert eid in [e["eid"].replace("-", "") for e in response.json()]
+
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.get(f'/api/event/{eid}/participants')
+    assert response.status_code == 200
+    participants = response.json()
+    assert [p["email"] for p in participants] == [admin_member["email"], regular_member["email"]]
+
+    # moving participants between storages keeps the participant list
+    seeded_eid = test_events[0]["eid"]
+    before = client.get(f'/api/event/{seeded_eid}/participants').json()
+    migrate_event(db, db.events.find_one({"eid": UUID(seeded_eid)}))
+    assert client.get(f'/api/event/{seeded_eid}/participants').json() == before
+    embed_event(db, db.events.find_one({"eid": UUID(seeded_eid)}))
+    assert client.get(f'/api/event/{seeded_eid}/participants').json() == before
+
+    client_login(client, regular_member["email"], regular_member["password"])
+    response = client.post(f'/api/event/{eid}/leave')
+    assert response.status_code == 200
+    assert db.registrations.count_documents({"eid": UUID(eid)}) == 1
+
+
+def test_migrate_event_duplicate_participants(client):
+    ensure_indexes(db)
+    eid = test_events[0]["eid"]
+    event = db.events.find_one({"eid": UUID(eid)})
+    participants = event["participants"]
+    # a member listed twice keeps the first entry and its position
+    event["participants"] = participants + [participants[0]]
+    db.events.update_one({"eid": UUID(eid)}, {"$set": {"participants": event["participants"]}})
+
+    assert migrate_event(db, event) == len(participants)
+    # the migration can be run again
+    assert migrate_event(db, event) == len(participants)
+    registrations = list(db.registrations.find({"eid": UUID(eid)}).sort("position", 1))
+    assert [r["member_id"] for r in registrations] == [p["id"] for p in participants]
@@ -84,3 +84,28 @@ def test_update_job(client):
     _test = client.get("/api/jobs/" + response["id"])
 
     assert _test.json()["title"] == new_job_update["title"]
+
+
+def test_job_etag(client):
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.post("/api/jobs/", json=new_job)
+    assert response.status_code == 200
+    jid = response.json()["id"]
+
+    job = client.get("/api/jobs/" + jid)
+    etag = job.headers["ETag"]
+    cached = client.get("/api/jobs/" + jid, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+
+    jobs = client.get("/api/jobs/")
+    list_etag = jobs.headers["ETag"]
+    assert client.get("/api/jobs/", headers={"If-None-Match": list_etag}).status_code == 304
+
+    # updates change both the job and the listing
+    new_job_update = {**new_job, "title": "New Title"}
+    assert client.put("/api/jobs/" + jid, json=new_job_update).status_code == 200
+    job = client.get("/api/jobs/" + jid, headers={"If-None-Match": etag})
+    assert job.status_code == 200
+    assert job.json()["title"] == "New Title"
+    assert client.get("/api/jobs/", headers={"If-None-Match": list_etag}).status_code == 200
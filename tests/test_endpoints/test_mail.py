@@ -1,5 +1,61 @@
+from app.mail_templates import MailTemplate, MailTemplates
+from app.mailer import Mailer, StubTransport
+from app.models import MailPayload
+from tests.conftest import client_login
+from tests.users import admin_member
 from tests.utils.authentication import admin_required
 
 @admin_required("api/mail/send-mail/", "post")
 def test_mail_admin_required(client):
     pass
+
+
+def test_send_mail(client):
+    client_login(client, admin_member["email"], admin_member["password"])
+    response = client.post("api/mail/send-mail/", json={
+        "subject": "Test", "content": "Test content", "to": ["member@test.com"]})
+    assert response.status_code == 200
+
+    sent = client.app.mailer.transport.sent
+    assert len(sent) == 1
+    assert sent[0]["To"] == "member@test.com"
+
+
+def test_mailer_batches_and_retries():
+    transport = StubTransport()
+    delays = []
+    mailer = Mailer(transport, batch_size=50, max_retries=2, sleep=delays.append)
+    # rate limited twice, then sent
+    transport.failures = {"mail0@test.com": [429, 503]}
+    # fails on every attempt
+    transport.failures["mail1@test.com"] = [500] * 3
+
+    payloads = [MailPayload(to=[f"mail{i}@test.com"], subject="Test", content="Test") for i in range(120)]
+    results = mailer.send(payloads)
+
+    assert results[0].ok and not results[1].ok and results[1].status == 500
+    assert len(transport.sent) == 119
+    # 3 batches and 2 retries of the failing messages in the first batch
+    assert transport.batches == 5
+    assert len(delays) == 2
+
+    # retries that would exceed the deadline are not waited for
+    transport.failures = {"mail0@test.com": [503]}
+    mailer = Mailer(transport, max_retries=2, backoff=1, sleep=delays.append, deadline=0.1)
+    assert not mailer.send_one(payloads[0]).ok
+    assert len(delays) == 2
+
+
+def test_mail_templates():
+    template = MailTemplate.compile("Hei $NAME$, velkommen til $EVENT_NAME$ ($EVENT_NAME$)")
+    assert template.placeholders == {"NAME", "EVENT_NAME"}
+
+    contents = template.render_many([{"NAME": "Ola"}, {"NAME": "Kari"}], EVENT_NAME="Fest")
+    assert contents == ["Hei Ola, velkommen til Fest (Fest)", "Hei Kari, velkommen til Fest (Fest)"]
+
+    # values are inserted as is, placeholders in values are not substituted
+    assert template.render(NAME="$EVENT_NAME$", EVENT_NAME="Fest").startswith("Hei $EVENT_NAME$,")
+
+    templates = MailTemplates()
+    content = templates.render("member_confirmation", LINK="https://td-uit.no/confirmation/code")
+    assert "https://td-uit.no/confirmation/code" in content and "$LINK$" not in content
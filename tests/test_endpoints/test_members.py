@@ -37,6 +37,9 @@ def test_get_member_associated_with_token(client):
     assert response.status_code == 200
     res_json = response.json()
     assert res_json['email'] == regular_member["email"]
+
+    cached = client.get('/api/member/', headers={"If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
      
 
 @admin_required('api/members', 'get')
@@ -50,7 +53,44 @@ def test_get_members(client):
     with open("db/seeds/test_seeds/test_members.json") as seed_file:
         seed_json = json.load(seed_file)
 
+    # without limit and cursor all members are returned
     assert len(res_json) == len(seed_json)
+    assert "X-Next-Cursor" not in response.headers
+
+    # follow cursors with a page size smaller than the number of members
+    ids = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get('/api/members/', params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        ids += [m["id"] for m in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert sorted(ids) == sorted(m["id"] for m in res_json)
+
+    # server side filters
+    response = client.get('/api/members/', params={"role": "admin", "status": "active"})
+    assert response.status_code == 200
+    expected = [m for m in seed_json if m["role"] == "admin" and m["status"] == "active"]
+    assert len(response.json()) == len(expected)
+
+    # projection
+    response = client.get('/api/members/', params={"fields": ["email"]})
+    assert response.status_code == 200
+    assert all(set(m) == {"id", "email"} for m in response.json())
+    response = client.get('/api/members/', params={"fields": ["password"]})
+    assert response.status_code == 400
+
+    # streamed variant returns the same members
+    response = client.get('/api/members/stream')
+    assert response.status_code == 200
+    streamed = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(m["id"] for m in streamed) == sorted(ids)
 
 @authentication_required('api/member/{uuid}', 'get')
 def test_get_member_by_id(client):
@@ -109,3 +149,21 @@ def test_member_activation(client):
 
     response = client.post("/api/member/activate")
     assert response.status_code == 400
+
+
+def test_member_cache(client):
+    client_login(client, admin_member["email"], admin_member["password"])
+    # the member is read from the database once and then served from the cache
+    for _ in range(2):
+        response = client.get('/api/event/joined-events')
+        assert response.status_code == 200
+    response = client.get('/api/stats/metrics')
+    assert response.status_code == 200
+    cache_stats = response.json()["member_cache"]
+    assert cache_stats["hits"] >= 1
+
+    # updating the member removes it from the cache
+    response = client.put("/api/member/", json={"classof": "2016"})
+    assert response.status_code == 201
+    response = client.get('/api/stats/metrics')
+    assert response.json()["member_cache"]["invalidations"] == cache_stats["invalidations"] + 1
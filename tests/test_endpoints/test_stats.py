@@ -1,6 +1,9 @@
 import datetime
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from app.telemetry import VisitBuffer, register_unique_visits
 from app.db import get_test_db
+from app.indexes import ensure_indexes
 from tests.conftest import client_login
 from tests.users import regular_member, admin_member
 from tests.utils.authentication import admin_required, authentication_required
@@ -22,11 +25,28 @@ def test_uniquie_visit(client):
     log = db.uniqueVisitLog.find({})
     assert len(list(log)) == 1
 
-    # bloom filter can give false positives however this should always work 
     response = client.post("/api/stats/unique-visit")
     assert response.status_code == 200
     log = db.uniqueVisitLog.find({})
     assert len(list(log)) == 1
+    # member ids are not stored
+    visitor = db.uniqueVisitors.find_one({})
+    assert set(visitor) == {"_id", "day", "visitor", "createdAt"}
+
+
+def test_concurrent_unique_visits(client):
+    db = get_test_db()
+    # duplicates are resolved by the unique (day, visitor) index, test database is dropped after startup
+    ensure_indexes(db)
+    db.uniqueVisitLog.delete_many({})
+    db.uniqueVisitors.delete_many({})
+    member = db.members.find_one({}, {"id": 1})
+
+    # visits by the same member from several api workers are counted once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: register_unique_visits(db, [(member["id"].hex, datetime.now())]), range(32)))
+    assert db.uniqueVisitLog.count_documents({}) == 1
+    assert db.uniqueVisitors.count_documents({}) == 1
 
 def test_add_page_visit(client):
     db = get_test_db()
@@ -107,3 +127,23 @@ def test_most_visited_pages_last_30_days(client):
         # all paths should have the same amount of visits as their num
         assert int(num) == page["count"]
 
+
+
+def test_visit_buffer(client):
+    db = get_test_db()
+    db.pageVisitLog.delete_many({})
+    buffer = VisitBuffer(lambda: db, max_size=5, flush_size=100, flush_interval=60)
+
+    buffer.add_page_visit("/admin/members")
+    for _ in range(8):
+        buffer.add_page_visit(page_payload["page"])
+    stats = buffer.stats()
+    assert stats["pending_page_visits"] == 5
+    assert stats["dropped"] == 3
+    # nothing is written before a flush
+    assert db.pageVisitLog.count_documents({}) == 0
+
+    buffer.close()
+    assert db.pageVisitLog.count_documents({"metaData": page_payload["page"]}) == 5
+    assert buffer.stats()["pending_page_visits"] == 0
+    assert buffer.stats()["flushes"] == 1
@@ -0,0 +1,45 @@
+import argparse
+import timeit
+from types import SimpleNamespace
+from uuid import uuid4
+
+from app.auth_helpers import ACCESS_TOKEN_LIFETIME, create_token, decode_access_token, decode_token
+from app.cache import TTLCache
+from app.config import config
+from app.models import AccessTokenPayload, MemberDB
+
+
+def make_request(app_config):
+    """ Minimal stand-in for a request, decode_access_token only uses request.app """
+    app = SimpleNamespace(config=app_config, token_cache=TTLCache(
+        app_config.TOKEN_CACHE_SIZE, ACCESS_TOKEN_LIFETIME.total_seconds()))
+    return SimpleNamespace(app=app)
+
+
+def make_token(app_config):
+    member = MemberDB(id=uuid4(), realName="bench", email="bench@td-uit.no", password="-", classof="2020",
+                      graduated=False, role="member", status="active", penalty=0)
+    return create_token(member, app_config)
+
+
+# run as module from project root i.e python3 -m utils.benchmarks.jwt_decode
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare cached and uncached access token decoding")
+    parser.add_argument("-n", type=int, default=20000, help="decodes per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs, the fastest is reported")
+    args = parser.parse_args()
+
+    app_config = config["test"]
+    request = make_request(app_config)
+    token = make_token(app_config)
+
+    runs = {
+        "uncached": lambda: AccessTokenPayload.model_validate(decode_token(token, app_config)),
+        "cached": lambda: decode_access_token(request, token),
+    }
+    results = {}
+    for name, run in runs.items():
+        best = min(timeit.repeat(run, number=args.n, repeat=args.repeat))
+        results[name] = best / args.n * 1e6
+        print(f"{name:>9}: {results[name]:8.2f} us/decode")
+    print(f"  speedup: {results['uncached'] / results['cached']:.1f}x")
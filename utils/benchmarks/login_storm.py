@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+from fastapi import FastAPI
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app.config import config
+from app.hashing import PasswordHasher
+
+PASSWORD = "*validPwd1234"
+
+
+def make_app(mode: str, method: str, workers: int) -> FastAPI:
+    """
+    App with a login-like endpoint verifying a password and an unrelated cheap endpoint.
+    mode inline verifies in the request threadpool as login did before, pool uses PasswordHasher
+    """
+    app = FastAPI()
+    pwhash = generate_password_hash(PASSWORD, method)
+    hasher = PasswordHasher(method, workers, max_pending=10_000)
+    app.state.hasher = hasher
+
+    if mode == "inline":
+        @app.post("/login")
+        def login():
+            return {"ok": check_password_hash(pwhash, PASSWORD)}
+    else:
+        @app.post("/login")
+        async def login():
+            return {"ok": await hasher.verify(pwhash, PASSWORD)}
+
+    # stands in for any sync endpoint reading from the database
+    @app.get("/unrelated")
+    def unrelated():
+        return {"ok": True}
+
+    return app
+
+
+async def run(mode: str, logins: int, requests: int, method: str, workers: int):
+    app = make_app(mode, method, workers)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # start the pool before measuring
+        if mode == "pool":
+            await client.post("/login")
+
+        latencies = []
+
+        async def unrelated():
+            for _ in range(requests):
+                start = time.perf_counter()
+                await client.get("/unrelated")
+                latencies.append(time.perf_counter() - start)
+                await asyncio.sleep(0.005)
+
+        start = time.perf_counter()
+        await asyncio.gather(unrelated(), *[client.post("/login") for _ in range(logins)])
+        elapsed = time.perf_counter() - start
+
+    app.state.hasher.shutdown()
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{mode:>6}: {logins} logins in {elapsed:6.2f}s, unrelated endpoint "
+          f"p50 {statistics.median(latencies) * 1000:7.1f}ms p99 {p99 * 1000:7.1f}ms")
+
+
+# run as module from project root i.e python3 -m utils.benchmarks.login_storm
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Latency of an unrelated endpoint while a burst of logins is hashing passwords")
+    parser.add_argument("--logins", type=int, default=200, help="concurrent login requests")
+    parser.add_argument("--requests", type=int, default=200, help="requests to the unrelated endpoint")
+    parser.add_argument("--method", default=config["default"].PASSWORD_HASH_METHOD, help="werkzeug hash method")
+    parser.add_argument("--workers", type=int, default=0, help="hashing processes, defaults to cores")
+    args = parser.parse_args()
+
+    for mode in ["inline", "pool"]:
+        asyncio.run(run(mode, args.logins, args.requests, args.method, args.workers))
@@ -0,0 +1,37 @@
+import argparse
+import time
+
+from app.mailer import Mailer, StubTransport
+from app.models import MailPayload
+
+
+class LatencyTransport(StubTransport):
+    """ Stub transport where every http request, i.e. every batch, takes a fixed round trip time """
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+
+    def send_batch(self, sender, messages):
+        time.sleep(self.latency)
+        return super().send_batch(sender, messages)
+
+
+# run as module from project root i.e python3 -m utils.benchmarks.mail_batch
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare sending mails one request at a time and in batches")
+    parser.add_argument("-n", type=int, default=200, help="recipients")
+    parser.add_argument("--latency", type=float, default=0.15, help="seconds per http request")
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    payloads = [MailPayload(to=[f"member{i}@td-uit.no"], subject="Bekreftelse", content="Du har fått plass")
+                for i in range(args.n)]
+    results = {}
+    for name, batch_size in (("serial", 1), ("batched", args.batch_size)):
+        mailer = Mailer(LatencyTransport(args.latency), batch_size=batch_size)
+        start = time.perf_counter()
+        mailer.send(payloads)
+        results[name] = time.perf_counter() - start
+        print(f"{name:>8}: {results[name]:7.2f} s for {args.n} mails")
+    print(f" speedup: {results['serial'] / results['batched']:.1f}x")
@@ -0,0 +1,53 @@
+import argparse
+import time
+from datetime import datetime
+
+from app.mail_templates import MAIL_TEMPLATE_PATH, MailTemplate, MailTemplates
+
+# event confirmation personalized with the recipient's name
+GREETING = "Hei $NAME$,\n"
+
+
+def render_with_replace(event, name):
+    """ Previous approach, reading the template and replacing each placeholder per mail """
+    with open(f"{MAIL_TEMPLATE_PATH}/event_confirmation.txt", 'r') as mail_content:
+        content = mail_content.read().replace("$EVENT_NAME$", event['title'])
+        content = content.replace("$DATE$", event['date'].strftime("%d %B, %Y"))
+        content = content.replace("$TIME$", event['date'].strftime("%H:%M"))
+        content = content.replace("$LOCATION$", event['address'])
+    return GREETING.replace("$NAME$", name) + content
+
+
+def render_compiled(templates, event, names):
+    template = MailTemplate.compile(GREETING).parts + templates.get("event_confirmation").parts
+    return MailTemplate(template).render_many(
+        ({"NAME": name} for name in names),
+        EVENT_NAME=event['title'],
+        DATE=event['date'].strftime("%d %B, %Y"),
+        TIME=event['date'].strftime("%H:%M"),
+        LOCATION=event['address'],
+    )
+
+
+# run as module from project root i.e python3 -m utils.benchmarks.mail_templates
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render personalized event confirmations")
+    parser.add_argument("-n", type=int, default=10000, help="confirmations to render")
+    args = parser.parse_args()
+
+    event = {"title": "Bedriftspresentasjon", "date": datetime(2025, 3, 14, 18, 15), "address": "Teknobyen"}
+    names = [f"Medlem {i}" for i in range(args.n)]
+    templates = MailTemplates()
+
+    start = time.perf_counter()
+    replaced = [render_with_replace(event, name) for name in names]
+    replace_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    compiled = render_compiled(templates, event, names)
+    compiled_seconds = time.perf_counter() - start
+
+    assert replaced == compiled
+    print(f" replace: {replace_seconds * 1000:8.1f} ms for {args.n} mails")
+    print(f"compiled: {compiled_seconds * 1000:8.1f} ms for {args.n} mails")
+    print(f" speedup: {replace_seconds / compiled_seconds:.1f}x")
@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from app.models import Event, EventDB
+from app.utils.serialization import json_bytes, validate_many
+
+
+def event_document(i: int, participants: int = 0):
+    """ Event as read from mongo """
+    date = datetime(2025, 3, 14, 18, 15) + timedelta(days=i)
+    event = {
+        "eid": uuid4(), "title": f"Bedriftspresentasjon {i}", "date": date, "address": "Teknobyen",
+        "price": 0, "description": "Presentasjon og mat", "duration": 2, "public": True,
+        "bindingRegistration": True, "transportation": False, "food": True,
+        "extraInformation": "Ta med laptop", "maxParticipants": 40, "romNumber": "1.022", "building": "Teknologibygget",
+        "registrationOpeningDate": date - timedelta(days=7), "host": "td@list.uit.no",
+        "registeredPenalties": [uuid4() for _ in range(3)], "version": 3,
+    }
+    event["participants"] = [{
+        "id": uuid4(), "realName": f"Medlem {p}", "email": f"medlem{p}@uit.no", "classof": "2022",
+        "phone": "12345678", "role": "member", "food": True, "transportation": False,
+        "dietaryRestrictions": "", "submitDate": date - timedelta(days=3), "penalty": 0, "confirmed": False,
+    } for p in range(participants)]
+    return event
+
+
+def validate_each(model, documents):
+    return [model.model_validate(d) for d in documents]
+
+
+def fastapi_default(models, response_class=JSONResponse) -> bytes:
+    """ FastAPI encoding models returned by a handler through jsonable_encoder """
+    return response_class(jsonable_encoder(models)).body
+
+
+def fastapi_orjson(models) -> bytes:
+    return fastapi_default(models, ORJSONResponse)
+
+
+def measure(function, argument, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(argument)
+    return (time.perf_counter() - start) / repeat, result
+
+
+def report(name: str, seconds: float, baseline: float, per: int, unit: str):
+    print(f"  {name:26} {seconds * 1e6 / per:8.2f} us per {unit}  {baseline / seconds:5.1f}x")
+
+
+def compare(label: str, model, documents, per: int, unit: str, repeat: int):
+    """ Validation and serialization are measured separately, validation is dominated by EmailStr """
+    print(label)
+    each, models = measure(lambda docs: validate_each(model, docs), documents, repeat)
+    many, _ = measure(lambda docs: validate_many(model, docs), documents, repeat)
+    report("model_validate per item", each, each, per, unit)
+    report("validate_many", many, each, per, unit)
+
+    bodies = []
+    baseline = None
+    for name, function in (("jsonable_encoder + json", fastapi_default),
+                           ("jsonable_encoder + orjson", fastapi_orjson),
+                           ("to_json", json_bytes)):
+        seconds, body = measure(function, models, repeat)
+        bodies.append(json.loads(body))
+        baseline = baseline or seconds
+        report(name, seconds, baseline, per, unit)
+    assert bodies[0] == bodies[1] == bodies[2]
+
+
+# run as module from project root i.e python3 -m utils.benchmarks.serialization
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serialize event listings and participant lists")
+    parser.add_argument("--events", type=int, nargs="+", default=[10, 100, 1000], help="events per listing")
+    parser.add_argument("--participants", type=int, nargs="+", default=[10, 100, 1000], help="participants per event")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for n in args.events:
+        documents = [event_document(i) for i in range(n)]
+        for d in documents:
+            del d["participants"]
+        compare(f"listing of {n} events", Event, documents, n, "event", args.repeat)
+
+    for n in args.participants:
+        compare(f"event with {n} participants", EventDB, [event_document(0, n)], n, "participant", args.repeat)
@@ -0,0 +1,36 @@
+import argparse
+import json
+
+from app.indexes import ensure_indexes, index_report
+from utils.seeding import get_db
+
+
+def print_report(report):
+    for collection, result in report.items():
+        print(f"{collection}:")
+        for key in ["missing", "unused", "unregistered"]:
+            if result[key]:
+                print(f"    {key}: {', '.join(result[key])}")
+        for name, ops in result["usage"].items():
+            print(f"    {name}: {ops} ops")
+
+
+# run as module from project root i.e python3 -m utils.indexes
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build indexes defined in app/indexes.py and report on index usage")
+    parser.add_argument("--report", action="store_true",
+                        help="only report missing and unused indexes, does not build anything")
+    parser.add_argument("--json", action="store_true",
+                        help="print report as json")
+    args = parser.parse_args()
+
+    db = get_db()
+    if not args.report:
+        ensure_indexes(db)
+
+    report = index_report(db)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,50 @@
+import argparse
+import json
+import os
+import timeit
+from collections import Counter
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app.config import config
+from app.hashing import method_of, normalize_method
+from utils.seeding import get_db
+
+
+def hash_report(db):
+    """ Number of members per (normalized) password hash method """
+    methods = Counter(method_of(m["password"]) for m in db.members.find({}, {"password": 1}) if m.get("password"))
+    return dict(methods.most_common())
+
+
+def verify_seconds(method: str, repeat: int = 3) -> float:
+    """ Time a single login spends verifying a hash created with method """
+    pwhash = generate_password_hash("password", method)
+    return min(timeit.repeat(lambda: check_password_hash(pwhash, "password"), number=1, repeat=repeat))
+
+
+# run as module from project root i.e python3 -m utils.password_hashes
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the password hash methods and costs members are stored with")
+    parser.add_argument("--time", action="store_true",
+                        help="measure the verify time of each method on this machine")
+    parser.add_argument("--json", action="store_true", help="print report as json")
+    args = parser.parse_args()
+
+    target = normalize_method(config[os.getenv('API_ENV', 'default')].PASSWORD_HASH_METHOD)
+    report = hash_report(get_db())
+    timings = {method: verify_seconds(method) for method in report} if args.time else {}
+
+    if args.json:
+        print(json.dumps({"target": target, "methods": report, "verify_seconds": timings}, indent=2))
+    else:
+        total = sum(report.values())
+        print(f"target: {target}")
+        for method, count in report.items():
+            line = f"    {method}: {count} members ({count / total:.0%})"
+            if method in timings:
+                line += f", {timings[method] * 1000:.0f}ms per login"
+            if method != target:
+                line += ", rehashed on next login"
+            print(line)
@@ -0,0 +1,62 @@
+import argparse
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from uuid import uuid4
+
+from app.concurrency import with_version_bump
+from app.utils.qr import render_qr_pdf
+from utils.seeding import get_db
+
+
+def assign_register_ids(db, events):
+    """ Gives events without a register id one, events given an id concurrently keep that id """
+    for event in events:
+        if event.get("register_id"):
+            continue
+        register_id = uuid4()
+        res = db.events.update_one({"eid": event["eid"], "register_id": None},
+                                   with_version_bump({"$set": {"register_id": register_id}}))
+        if res.matched_count:
+            event["register_id"] = register_id
+        else:
+            event["register_id"] = db.events.find_one({"eid": event["eid"]}, {"register_id": 1})["register_id"]
+    return events
+
+
+def sheet_filename(event) -> str:
+    title = re.sub(r"[^\w-]+", "_", event["title"]).strip("_")
+    return f"{event['date']:%Y-%m-%d}_{title}_{event['eid'].hex[:8]}.pdf"
+
+
+def write_sheet(out_dir: str, event) -> str:
+    path = os.path.join(out_dir, sheet_filename(event))
+    with open(path, "wb") as sheet:
+        sheet.write(render_qr_pdf(event["title"], event["register_id"]))
+    return path
+
+
+# run as module from project root i.e python3 -m utils.qr_sheets --from 2025-01-01 --to 2025-06-30
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render the registration qr sheets of all events in a period, e.g. a semester")
+    parser.add_argument("--from", dest="start", type=datetime.fromisoformat, required=True, help="first date, YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", type=datetime.fromisoformat, required=True, help="last date, YYYY-MM-DD")
+    parser.add_argument("--out", default="qr_sheets", help="directory the pdfs are written to")
+    parser.add_argument("--workers", type=int, default=None, help="rendering processes, defaults to the number of cores")
+    args = parser.parse_args()
+
+    db = get_db()
+    end = args.end.replace(hour=23, minute=59, second=59)
+    events = list(db.events.find({"date": {"$gte": args.start, "$lte": end}},
+                                 {"_id": 0, "eid": 1, "title": 1, "date": 1, "register_id": 1}).sort("date", 1))
+    assign_register_ids(db, events)
+
+    os.makedirs(args.out, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        paths = list(pool.map(write_sheet, [args.out] * len(events), events))
+
+    for path in paths:
+        print(path)
+    print(f"{len(paths)} qr sheets written to {args.out}")
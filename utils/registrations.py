@@ -0,0 +1,79 @@
+import argparse
+from uuid import UUID
+
+from pymongo.errors import BulkWriteError
+
+from app.concurrency import with_version_bump
+from app.indexes import ensure_indexes
+from app.registrations import EMBEDDED, REGISTRATIONS, registration_position, to_participant, to_registration
+from utils.seeding import get_db
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def migrate_event(db, event):
+    """ Moves the embedded participant list of event to the registrations collection """
+    participants = event.get("participants") or []
+    # a member listed more than once keeps the first entry, positions of the others are unchanged
+    registrations = {}
+    for i, p in enumerate(participants):
+        if p["id"] not in registrations:
+            registrations[p["id"]] = to_registration(event["eid"], p, registration_position(i, p["penalty"]))
+
+    # removes leftovers from an interrupted migration
+    db.registrations.delete_many({"eid": event["eid"]})
+    if registrations:
+        try:
+            db.registrations.insert_many(list(registrations.values()), ordered=False)
+        except BulkWriteError as error:
+            # registrations already inserted are kept, e.g. by a migration running at the same time
+            if any(e["code"] != DUPLICATE_KEY_ERROR for e in error.details.get("writeErrors", [])):
+                raise
+
+    db.events.update_one({"eid": event["eid"]}, with_version_bump({"$set": {
+        "participants": [],
+        "participantStorage": REGISTRATIONS,
+        # next position given to a joining member
+        "registrationSeq": len(participants),
+    }}))
+    return len(registrations)
+
+
+def embed_event(db, event):
+    """ Moves participants of event in the registrations collection back into the event document """
+    cursor = db.registrations.find({"eid": event["eid"]}).sort("position", 1)
+    participants = [to_participant(r) for r in cursor]
+
+    db.events.update_one({"eid": event["eid"]}, with_version_bump({
+        "$set": {"participants": participants, "participantStorage": EMBEDDED},
+        "$unset": {"registrationSeq": ""},
+    }))
+    db.registrations.delete_many({"eid": event["eid"]})
+    return len(participants)
+
+
+# run as module from project root i.e python3 -m utils.registrations
+# the api should be stopped while migrating, as joins during the migration can be lost
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Migrate event participants between the event documents and the registrations collection")
+    parser.add_argument("--reverse", action="store_true",
+                        help="move participants from the registrations collection back into the events")
+    parser.add_argument("--eid", help="only migrate the event with this id")
+    args = parser.parse_args()
+
+    db = get_db()
+    # the unique (member_id, eid) index must exist before registrations are used
+    ensure_indexes(db)
+
+    search_filter = {"participantStorage": {"$ne": REGISTRATIONS}}
+    migrate = migrate_event
+    if args.reverse:
+        search_filter = {"participantStorage": REGISTRATIONS}
+        migrate = embed_event
+    if args.eid:
+        search_filter["eid"] = UUID(args.eid)
+
+    for event in db.events.find(search_filter):
+        count = migrate(db, event)
+        print(f"{event['eid'].hex}: moved {count} participants")
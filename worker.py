@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import os
+import signal
+import socket
+import threading
+
+from pymongo import MongoClient
+
+from app.config import config
+from app.mailer import create_mailer
+from app.outbox import process_batch
+
+log = logging.getLogger("worker")
+
+
+def run(db, mailer, worker_id: str, batch_size: int, poll_interval: float, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            claimed = process_batch(db, mailer, worker_id, batch_size)
+        except Exception:
+            log.exception("Processing the outbox failed")
+            claimed = 0
+        # a full batch means more mails are likely waiting
+        if claimed < batch_size:
+            stop.wait(poll_interval)
+
+
+# Sends the mails in the outbox collection, see app/outbox.py
+# run from project root i.e python3 worker.py
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send queued mails from the outbox")
+    parser.add_argument("--concurrency", type=int, default=2, help="batches sent at the same time")
+    parser.add_argument("--batch-size", type=int, default=100, help="mails claimed per batch")
+    parser.add_argument("--poll-interval", type=float, default=2, help="seconds between checks of an empty outbox")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    worker_config = config[os.getenv("API_ENV", "default")]
+    db = MongoClient(worker_config.MONGO_URI, uuidRepresentation="standard")[worker_config.MONGO_DBNAME]
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    # a mailer per thread, the gmail services of a transport are not thread safe and send one batch
+    # per sender at a time, so threads sharing a transport would send one after another.
+    # Retries are scheduled through the outbox instead of sleeping in the worker
+    threads = [
+        threading.Thread(target=run, args=(db, create_mailer(worker_config, max_retries=0), f"{worker_id}:{i}",
+                                           args.batch_size, args.poll_interval, stop))
+        for i in range(args.concurrency)
+    ]
+    log.info("Mail worker %s started with %d threads", worker_id, len(threads))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()